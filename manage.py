@@ -6,5 +6,9 @@ if __name__ == "__main__":
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "{{ project_name }}.settings.production")
 
     from django.core.management import execute_from_command_line
+    from django.utils.module_loading import import_string
 
-    execute_from_command_line(sys.argv)
+    # A command's writes pin its reads to the primary until it exits, so it
+    # reads its own writes even with replicas configured.
+    with import_string('{{ project_name }}.routers.pinning_scope')():
+        execute_from_command_line(sys.argv)
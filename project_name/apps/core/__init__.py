@@ -0,0 +1 @@
+default_app_config = '{{project_name}}.apps.core.apps.CoreConfig'
@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+
+
+class CoreConfig(AppConfig):
+    name = '{{project_name}}.apps.core'
+
+    def ready(self):
+        from django.db import router
+        # Importing connects the connection-counting signal handlers.
+        from ... import dbconnections  # noqa
+        # Load DATABASE_ROUTERS now so their execute wrappers are in place
+        # before the first connection opens.
+        router.routers
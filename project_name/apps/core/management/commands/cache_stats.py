@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from .....caching.stampede import EVENTS, stats
+
+
+class Command(BaseCommand):
+    help = 'Print hits, stale serves, waits and recomputes per cached key prefix.'
+
+    def handle(self, *args, **options):
+        self.stdout.write('{:<48} '.format('prefix') + ' '.join(
+            '{:>10}'.format(event) for event in EVENTS))
+        for prefix, counts in sorted(stats().items()):
+            self.stdout.write('{:<48} '.format(prefix[:48]) + ' '.join(
+                '{:>10}'.format(counts.get(event, 0)) for event in EVENTS))
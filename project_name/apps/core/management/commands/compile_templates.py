@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ..... import templating
+
+
+class Command(BaseCommand):
+    help = ('Compile every template, print the slowest, and fail if any '
+            'cannot be compiled.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20,
+                            help='How many of the slowest templates to list; 0 for all.')
+
+    def handle(self, *args, **options):
+        results = templating.compile_all(reset=True)
+        compiled = sorted((r for r in results if r[2] is None), key=lambda r: -r[1])
+        failed = [r for r in results if r[2] is not None]
+
+        self.stdout.write('{:>9}  {}'.format('ms', 'template'))
+        for name, seconds, _ in compiled[:options['limit'] or None]:
+            self.stdout.write('{:>9.2f}  {}'.format(seconds * 1000, name))
+        self.stdout.write('{} templates compiled in {:.1f}ms'.format(
+            len(compiled), sum(r[1] for r in compiled) * 1000))
+
+        for name, _, error in failed:
+            self.stderr.write('{}: {}: {}'.format(name, type(error).__name__, error))
+        if failed:
+            raise CommandError('{} templates failed to compile'.format(len(failed)))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from ..... import dbconnections
+
+
+class Command(BaseCommand):
+    help = 'Print database connection open/reuse/close counts for every live worker.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=300,
+                            help='Hide workers silent for longer than this many seconds.')
+        parser.add_argument('--prune', action='store_true',
+                            help='Forget workers silent for longer than --max-age.')
+
+    def handle(self, *args, **options):
+        if options['prune']:
+            dbconnections.prune(options['max_age'])
+        self.stdout.write('{:<32} {:>8} {:>8} {:>8} {:>10}'.format(
+            'worker', 'opened', 'reused', 'closed', 'unhealthy'))
+        for worker, counts in sorted(dbconnections.snapshot(options['max_age']).items()):
+            self.stdout.write('{:<32} {:>8} {:>8} {:>8} {:>10}'.format(
+                worker[:32], counts.get('opened', 0), counts.get('reused', 0),
+                counts.get('closed', 0), counts.get('unhealthy', 0)))
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from ...models import NotificationOutbox
+from ...outbox import STATS_KEY, drain_outbox
+
+
+class Command(BaseCommand):
+    help = 'Drain the notification outbox now, or report on the last drain.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--stats', action='store_true',
+            help='Only print metrics from the last drain and the current backlog.')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            stats = cache.get(STATS_KEY) or {}
+        else:
+            stats = drain_outbox(wait=False)
+
+        pending = NotificationOutbox.objects.filter(sent__isnull=True)
+        # Rows that ran out of attempts stay unsent for inspection.
+        stats['given_up'] = pending.filter(
+            attempts__gte=getattr(settings, 'NOTIFICATION_OUTBOX_MAX_ATTEMPTS', 5)).count()
+        stats['pending'] = pending.count()
+        oldest = pending.order_by('created').values_list('created', flat=True).first()
+        stats['oldest_pending'] = oldest
+
+        for key in sorted(stats):
+            self.stdout.write('{:<16} {}'.format(key, stats[key]))
@@ -0,0 +1,67 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from .....imaging import image_models
+from .....imaging import manifest
+from ..... import s3
+from ...models import DerivativeManifest, SourceVersion
+
+
+class Command(BaseCommand):
+    help = ('Delete manifest entries, and their stored objects, for source '
+            'images no model references any more.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report orphans without deleting anything.')
+        parser.add_argument('--stats', action='store_true',
+                            help='Only print manifest hit/miss counters.')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            for key, value in sorted(manifest.stats().items()):
+                self.stdout.write('{:<10} {}'.format(key, value))
+            return
+
+        live = set()
+        for model in image_models():
+            live.update(model._default_manager.exclude(image='')
+                        .values_list('image', flat=True).iterator())
+
+        orphans = []
+        live_values = set()
+        for pk, source, value in DerivativeManifest.objects.values_list(
+                'pk', 'source', 'value').iterator():
+            if source in live:
+                live_values.add(value)
+            else:
+                orphans.append((pk, value))
+
+        # A key can be shared by sources with identical bytes; keep it while
+        # any live source still points at it.
+        keys = set(value for _, value in orphans
+                   if not manifest.is_inline(value) and value not in live_values)
+
+        self.stdout.write('{} orphaned entries, {} stored objects'.format(
+            len(orphans), len(keys)))
+        if options['dry_run']:
+            for key in sorted(keys):
+                self.stdout.write(key)
+            return
+
+        keys = sorted(keys)
+        client = s3.get_client()
+        for start in range(0, len(keys), 1000):
+            client.delete_objects(
+                Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+                Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]],
+                        'Quiet': True},
+            )
+        pks = [pk for pk, _ in orphans]
+        for start in range(0, len(pks), 1000):
+            DerivativeManifest.objects.filter(pk__in=pks[start:start + 1000]).delete()
+        versions = [pk for pk, source in SourceVersion.objects.values_list(
+            'pk', 'source').iterator() if source not in live]
+        for start in range(0, len(versions), 1000):
+            SourceVersion.objects.filter(pk__in=versions[start:start + 1000]).delete()
+        self.stdout.write('Deleted.')
@@ -0,0 +1,46 @@
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ..... import sessions
+
+
+class Command(BaseCommand):
+    help = ('Copy unexpired database sessions into SESSION_ENGINE, keeping '
+            'their keys and remaining lifetime so nobody is logged out.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--delete', action='store_true',
+                            help='Delete each batch of database rows once copied.')
+
+    def handle(self, *args, **options):
+        store_class = import_module(settings.SESSION_ENGINE).SessionStore
+        if not issubclass(store_class, sessions.SessionStore):
+            raise CommandError('SESSION_ENGINE is {}; point it at {} first.'.format(
+                settings.SESSION_ENGINE, sessions.__name__))
+
+        now = timezone.now()
+        copied = skipped = 0
+        last = ''
+        while True:
+            rows = list(Session.objects.filter(expire_date__gt=now, session_key__gt=last)
+                        .order_by('session_key')[:options['batch_size']])
+            if not rows:
+                break
+            for row in rows:
+                data = row.get_decoded()
+                age = int((row.expire_date - now).total_seconds())
+                if data and age > 0 and store_class(row.session_key).restore(data, age):
+                    copied += 1
+                else:
+                    # Empty, undecodable, or already live in the new engine.
+                    skipped += 1
+            last = rows[-1].session_key
+            if options['delete']:
+                Session.objects.filter(session_key__in=[row.session_key for row in rows]).delete()
+            self.stdout.write('{} copied, {} skipped'.format(copied, skipped))
+        self.stdout.write('Done: {} copied, {} skipped'.format(copied, skipped))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from ..... import instrumentation
+
+
+class Command(BaseCommand):
+    help = 'Print latency percentiles, errors and bytes for outbound provider calls.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true',
+                            help='Clear the aggregated histograms.')
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            instrumentation.reset()
+            self.stdout.write('Cleared.')
+            return
+
+        instrumentation.recorder.flush()
+        self.stdout.write('{:<12} {:<28} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9} {:>12} {:>12}'.format(
+            'provider', 'endpoint', 'calls', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+            'bytes in', 'bytes out'))
+        for (provider, endpoint), s in sorted(instrumentation.snapshot().items()):
+            self.stdout.write(
+                '{:<12} {:<28} {:>8} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>12} {:>12}'.format(
+                    provider, endpoint[:28], s['count'], s['errors'], s['p50_ms'], s['p90_ms'],
+                    s['p99_ms'], s['max_ms'], s['bytes_in'], s['bytes_out']))
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+
+from ..... import profiling
+
+ORDERINGS = {
+    'wall': lambda s: s['wall_us'],
+    'db': lambda s: s['db_us'],
+    'queries': lambda s: s['db_count'],
+    'cache': lambda s: s['cache_us'],
+    'http': lambda s: s['http_us'],
+}
+
+
+class Command(BaseCommand):
+    help = 'Print the endpoints that cost the most across sampled requests.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--by', choices=sorted(ORDERINGS), default='wall',
+                            help='Rank by total time or query count in this category.')
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--reset', action='store_true',
+                            help='Clear the aggregated profiles.')
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            profiling.reset()
+            self.stdout.write('Cleared.')
+            return
+
+        summaries = profiling.snapshot()
+        ranked = sorted(summaries.items(), key=lambda item: -ORDERINGS[options['by']](item[1]))
+        self.stdout.write('{:<40} {:>7} {:>9} {:>8} {:>9} {:>8} {:>9} {:>9} {:>6}'.format(
+            'endpoint', 'samples', 'wall ms', 'queries', 'db ms', 'cache', 'cache ms',
+            'http ms', 'n+1'))
+        for endpoint, s in ranked[:options['limit']]:
+            n = float(s.get('samples') or 1)
+            self.stdout.write(
+                '{:<40} {:>7} {:>9.1f} {:>8.1f} {:>9.1f} {:>8.1f} {:>9.1f} {:>9.1f} {:>6}'.format(
+                    endpoint[:40], s.get('samples', 0), s.get('wall_us', 0) / n / 1000,
+                    s.get('db_count', 0) / n, s.get('db_us', 0) / n / 1000,
+                    s.get('cache_count', 0) / n, s.get('cache_us', 0) / n / 1000,
+                    s.get('http_us', 0) / n / 1000, s.get('nplusone', 0)))
+
+        self.stdout.write('\nRepeated query shapes (sampled requests affected):')
+        for endpoint, s in ranked[:options['limit']]:
+            for shape, n in sorted(s['nplusone_shapes'].items(), key=lambda item: -item[1])[:3]:
+                self.stdout.write('{:>6}  {}  {}'.format(n, endpoint, shape[:120]))
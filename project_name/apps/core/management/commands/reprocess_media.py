@@ -0,0 +1,192 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from .....imaging import image_models
+from .....imaging.reprocess import TASKS, reprocess_chunk
+
+
+CHECKPOINT_PREFIX = 'reprocess:checkpoint:'
+
+
+class Command(BaseCommand):
+    help = ('Backfill compressed, placeholder and thumbnail derivatives for '
+            'every model with an image field. Resumes from the last checkpoint, '
+            'which only advances as chunks finish, in both pool and RQ modes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', action='append', dest='models',
+                            help='app_label.Model to process; repeatable. Defaults to all.')
+        parser.add_argument('--task', action='append', dest='tasks', choices=TASKS,
+                            help='Derivative to build; repeatable. Defaults to all.')
+        parser.add_argument('--chunk-size', type=int, default=100)
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Maximum rows per second; 0 for no limit.')
+        parser.add_argument('--rq', action='store_true',
+                            help='Enqueue chunks on the default RQ queue instead '
+                                 'of using a local process pool.')
+        parser.add_argument('--retries', type=int, default=2,
+                            help='Times to resubmit rows that failed.')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore saved checkpoints and start from the first row.')
+
+    def handle(self, *args, **options):
+        models = image_models()
+        if options['models']:
+            wanted = set(label.lower() for label in options['models'])
+            models = [m for m in models if m._meta.label_lower in wanted]
+        if not models:
+            raise CommandError('No models with an image field to process.')
+
+        self.options = options
+        self.tasks = tuple(options['tasks'] or TASKS)
+        for model in models:
+            self.process(model)
+
+    def chunks(self, queryset, last_pk):
+        size = self.options['chunk_size']
+        while True:
+            pks = list(queryset.filter(pk__gt=last_pk).values_list('pk', flat=True)[:size])
+            if not pks:
+                return
+            yield pks
+            last_pk = pks[-1]
+
+    def throttle(self, submitted):
+        rate = self.options['rate']
+        if rate:
+            delay = submitted / rate - (time.time() - self.started)
+            if delay > 0:
+                time.sleep(delay)
+
+    def report(self, label, done, failed, total):
+        elapsed = time.time() - self.started
+        rate = done / elapsed if elapsed else 0.0
+        eta = (total - done) / rate if rate else 0.0
+        self.stdout.write('{} {}/{} rows, {} failed, {:.1f} rows/s, ETA {:.0f}s'.format(
+            label, done, total, failed, rate, eta))
+
+    @contextmanager
+    def executor(self, label):
+        """Yield a ``submit(pks)`` returning a handle with a ``result()``."""
+        if self.options['rq']:
+            import django_rq
+            queue = django_rq.get_queue('default')
+            yield lambda pks: QueuedChunk(queue.enqueue(reprocess_chunk, label, pks, self.tasks))
+            return
+
+        workers = self.options['workers']
+        submits = [0]
+
+        def submit(pks):
+            if submits[0] < workers:
+                # Workers fork on submit; they must not inherit the parent's
+                # database socket.
+                connections.close_all()
+            submits[0] += 1
+            return pool.submit(reprocess_chunk, label, pks, self.tasks)
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            yield submit
+
+    def run(self, submit, chunks, on_done):
+        """Keep a bounded number of chunks in flight, collecting failed pks.
+
+        ``on_done(pks, processed, failed)`` is called in submission order, so
+        a checkpoint taken there never skips past an unfinished chunk.
+        """
+        window = self.options['workers'] * 2
+        in_flight = deque()
+        failed_pks = []
+        while True:
+            while len(in_flight) < window:
+                pks = next(chunks, None)
+                if pks is None:
+                    break
+                self.submitted += len(pks)
+                self.throttle(self.submitted)
+                in_flight.append((submit(pks), pks))
+            if not in_flight:
+                return failed_pks
+
+            handle, pks = in_flight.popleft()
+            try:
+                processed, failed = handle.result()
+            except Exception as e:
+                self.stderr.write('Chunk ending at pk {} failed: {}'.format(pks[-1], e))
+                processed, failed = len(pks), list(pks)
+            failed_pks.extend(failed)
+            on_done(pks, processed, failed)
+
+    def process(self, model):
+        """Process ``model`` from its checkpoint.
+
+        The checkpoint is ``{'last_pk': pk, 'failed': [pks]}``: rows failed
+        in chunks behind ``last_pk`` are saved with it, so an interrupted run
+        retries them on resume instead of skipping past them.
+        """
+        label = model._meta.label
+        key = CHECKPOINT_PREFIX + label
+        if self.options['restart']:
+            cache.delete(key)
+        state = cache.get(key) or {'last_pk': 0, 'failed': []}
+        last_pk, carried = state['last_pk'], state['failed']
+        pending = list(carried)
+
+        queryset = model._default_manager.exclude(image='').order_by('pk')
+        total = queryset.filter(pk__gt=last_pk).count() + len(carried)
+        self.stdout.write('{}: {} rows after pk {}, {} to retry'.format(
+            label, total - len(carried), last_pk, len(carried)))
+
+        self.started = time.time()
+        self.submitted = 0
+        counts = {'done': len(carried), 'failed': len(carried)}
+
+        def checkpoint(pks, processed, failed):
+            counts['done'] += processed
+            counts['failed'] += len(failed)
+            pending.extend(failed)
+            cache.set(key, {'last_pk': pks[-1], 'failed': pending}, None)
+            self.report(label, counts['done'], counts['failed'], total)
+
+        def recovered(pks, processed, failed):
+            counts['failed'] -= processed - len(failed)
+            self.report(label, counts['done'], counts['failed'], total)
+
+        size = self.options['chunk_size']
+        with self.executor(label) as submit:
+            failed_pks = carried + self.run(submit, self.chunks(queryset, last_pk), checkpoint)
+            for attempt in range(self.options['retries']):
+                if not failed_pks:
+                    break
+                self.stdout.write('{}: retrying {} failed rows'.format(label, len(failed_pks)))
+                retry = (failed_pks[i:i + size] for i in range(0, len(failed_pks), size))
+                failed_pks = self.run(submit, retry, recovered)
+
+        if failed_pks:
+            self.stderr.write('{}: gave up on {} rows: {}'.format(
+                label, len(failed_pks), ', '.join(str(pk) for pk in failed_pks)))
+        cache.delete(key)
+
+
+class QueuedChunk(object):
+    """Future-like handle on an enqueued :func:`reprocess_chunk` job."""
+
+    poll_interval = 0.5
+
+    def __init__(self, job):
+        self.job = job
+
+    def result(self):
+        while True:
+            if self.job.is_finished:
+                return self.job.result
+            if self.job.is_failed:
+                raise RuntimeError('job {} failed'.format(self.job.id))
+            time.sleep(self.poll_interval)
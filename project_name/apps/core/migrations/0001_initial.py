@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationOutbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('segment', models.CharField(default='All', max_length=128, verbose_name='segment')),
+                ('action', models.CharField(blank=True, max_length=128, verbose_name='action')),
+                ('message', models.TextField(blank=True, verbose_name='message')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='created')),
+                ('sent', models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='sent')),
+            ],
+            options={
+                'ordering': ('created',),
+                'verbose_name': 'notification outbox entry',
+                'verbose_name_plural': 'notification outbox',
+            },
+        ),
+    ]
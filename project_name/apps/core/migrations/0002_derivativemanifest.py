@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DerivativeManifest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=1024, verbose_name='source')),
+                ('content_hash', models.CharField(max_length=64, verbose_name='content hash')),
+                ('spec', models.CharField(max_length=255, verbose_name='spec')),
+                ('value', models.TextField(verbose_name='value')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+            ],
+            options={
+                'verbose_name': 'derivative manifest entry',
+                'verbose_name_plural': 'derivative manifest',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='derivativemanifest',
+            unique_together=set([('source', 'spec')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='derivativemanifest',
+            index_together=set([('content_hash', 'spec')]),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_notificationoutbox_retries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SourceVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=1024, unique=True, verbose_name='source')),
+                ('version', models.CharField(max_length=255, verbose_name='version')),
+                ('content_hash', models.CharField(max_length=64, verbose_name='content hash')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='updated')),
+            ],
+            options={
+                'verbose_name': 'source version',
+                'verbose_name_plural': 'source versions',
+            },
+        ),
+    ]
@@ -0,0 +1,73 @@
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+
+class NotificationOutbox(models.Model):
+    """A push notification waiting to be drained by the RQ worker.
+
+    Identical rows that land inside the coalescing window are sent once,
+    and rows differing only in ``segment`` share a OneSignal call. A drain
+    claims rows until ``claimed_until``; a failed send leaves ``sent``
+    empty and backs the row off, up to ``NOTIFICATION_OUTBOX_MAX_ATTEMPTS``.
+    """
+
+    segment = models.CharField(_('segment'), max_length=128, default='All')
+    action = models.CharField(_('action'), max_length=128, blank=True)
+    message = models.TextField(_('message'), blank=True)
+    created = models.DateTimeField(_('created'), auto_now_add=True, db_index=True)
+    sent = models.DateTimeField(_('sent'), null=True, blank=True, db_index=True)
+    attempts = models.PositiveSmallIntegerField(_('attempts'), default=0)
+    claimed_until = models.DateTimeField(_('claimed until'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('notification outbox entry')
+        verbose_name_plural = _('notification outbox')
+        ordering = ('created',)
+
+    def __str__(self):
+        return '{} / {}'.format(self.segment, self.action)
+
+
+class DerivativeManifest(models.Model):
+    """Where a derivative of a source image has already been stored.
+
+    Rows are looked up by ``content_hash``, so an object overwritten in
+    place is rebuilt and the same bytes uploaded under a new URL reuse the
+    existing derivative. ``source`` records which URL each row is for.
+    """
+
+    source = models.CharField(_('source'), max_length=1024)
+    content_hash = models.CharField(_('content hash'), max_length=64)
+    spec = models.CharField(_('spec'), max_length=255)
+    value = models.TextField(_('value'))
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('derivative manifest entry')
+        verbose_name_plural = _('derivative manifest')
+        unique_together = (('source', 'spec'),)
+        index_together = (('content_hash', 'spec'),)
+
+    def __str__(self):
+        return '{} [{}]'.format(self.source, self.spec)
+
+
+class SourceVersion(models.Model):
+    """The content hash last computed for a source image.
+
+    ``version`` is the object's ETag and size when it was hashed; while a
+    HEAD request still returns them, ``content_hash`` is current and the
+    source need not be fetched again to find its derivatives.
+    """
+
+    source = models.CharField(_('source'), max_length=1024, unique=True)
+    version = models.CharField(_('version'), max_length=255)
+    content_hash = models.CharField(_('content hash'), max_length=64)
+    updated = models.DateTimeField(_('updated'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('source version')
+        verbose_name_plural = _('source versions')
+
+    def __str__(self):
+        return self.source
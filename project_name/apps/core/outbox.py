@@ -0,0 +1,188 @@
+import time
+import logging
+from datetime import timedelta
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import NotificationOutbox
+from ...routers import use_primary
+
+logger = logging.getLogger(__name__)
+
+DRAIN_SCHEDULED_KEY = 'outbox:drain-scheduled'
+STATS_KEY = 'outbox:stats'
+
+
+def _window():
+    return getattr(settings, 'NOTIFICATION_OUTBOX_WINDOW', 2)
+
+
+def _max_attempts():
+    return getattr(settings, 'NOTIFICATION_OUTBOX_MAX_ATTEMPTS', 5)
+
+
+def enqueue_notification(segment='All', action='', message=''):
+    """Record a notification for the drain worker.
+
+    The caller only pays for the INSERT; the drain job is scheduled once the
+    surrounding transaction commits.
+    """
+    entry = NotificationOutbox.objects.create(
+        segment=segment, action=action, message=message)
+    transaction.on_commit(schedule_drain)
+    return entry
+
+
+def schedule_drain():
+    """Enqueue a drain job unless one is already waiting out the window.
+
+    Runs after the caller's transaction has committed, so a broken queue is
+    logged rather than raised: the row is saved and the next drain picks it
+    up.
+    """
+    # The key outlives the window so a dead worker can't wedge the outbox
+    # forever, but the drain clears it as soon as it starts reading rows.
+    if not cache.add(DRAIN_SCHEDULED_KEY, 1, _window() * 10):
+        return
+    try:
+        import django_rq
+        django_rq.enqueue(drain_outbox)
+    except Exception:
+        cache.delete(DRAIN_SCHEDULED_KEY)
+        logger.exception('Could not enqueue the notification outbox drain')
+
+
+def claim(batch_size, claim_timeout):
+    """Claim up to ``batch_size`` due rows, oldest first.
+
+    The row locks are only held for this short transaction; the claim itself
+    is ``claimed_until``, which a crashed drain lets lapse.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        pks = list(
+            NotificationOutbox.objects.select_for_update(skip_locked=True)
+            .filter(sent__isnull=True, attempts__lt=_max_attempts())
+            .filter(Q(claimed_until__isnull=True) | Q(claimed_until__lte=now))
+            .order_by('created').values_list('pk', flat=True)[:batch_size]
+        )
+        NotificationOutbox.objects.filter(pk__in=pks).update(
+            claimed_until=now + timedelta(seconds=claim_timeout), attempts=F('attempts') + 1)
+    return list(NotificationOutbox.objects.filter(pk__in=pks).order_by('created'))
+
+
+def send_entries(entries):
+    """Send claimed rows; returns ``(sent rows, failed rows, calls made)``.
+
+    Identical rows are sent once. Payloads differing only in their segment
+    are merged by the dispatcher, and a row counts as sent only if every
+    call carrying its payloads succeeded.
+    """
+    from ...utils import notification_payloads
+    from ...notifications import dispatcher, merge_payloads, payload_key
+
+    groups = OrderedDict()
+    for entry in entries:
+        groups.setdefault((entry.segment, entry.action, entry.message), []).append(entry)
+
+    group_keys = {}
+    payloads = []
+    for group, rows in groups.items():
+        group_payloads = notification_payloads(*group)
+        group_keys[group] = set(payload_key(payload) for payload in group_payloads)
+        payloads.extend(group_payloads)
+
+    merged = merge_payloads(payloads)
+    failed_keys = set()
+    for payload, response in zip(merged, dispatcher.send_many(merged, return_exceptions=True)):
+        if isinstance(response, Exception):
+            logger.warning('OneSignal send failed: %s', response)
+        elif response.status_code >= 400:
+            logger.warning('OneSignal send failed: %s %s', response.status_code, response.reason)
+        else:
+            continue
+        failed_keys.add(payload_key(payload))
+
+    sent, failed = [], []
+    for group, rows in groups.items():
+        (failed if group_keys[group] & failed_keys else sent).extend(rows)
+    return sent, failed, len(merged)
+
+
+def drain_outbox(wait=True, batch_size=None):
+    """Send every pending notification, coalescing identical ones.
+
+    Rows are claimed in one short transaction and sent outside it, so no
+    connection sits in a transaction during network I/O. Failed rows back
+    off exponentially from the coalescing window and another drain is
+    scheduled for them, until ``NOTIFICATION_OUTBOX_MAX_ATTEMPTS``.
+
+    :param bool wait: sleep for the coalescing window before reading rows.
+    :param int batch_size: rows claimed and sent per round.
+    :return: dict of throughput and lag metrics for this run.
+    """
+    if wait:
+        time.sleep(_window())
+    cache.delete(DRAIN_SCHEDULED_KEY)
+    # Claims are read straight back; a replica might not have them yet.
+    with use_primary():
+        return _drain(batch_size)
+
+
+def _drain(batch_size):
+    batch_size = batch_size or getattr(settings, 'NOTIFICATION_OUTBOX_BATCH_SIZE', 500)
+    claim_timeout = getattr(settings, 'NOTIFICATION_OUTBOX_CLAIM_TIMEOUT', 60)
+    started = time.time()
+    drained = sends = errors = 0
+    max_lag = 0.0
+
+    while True:
+        entries = claim(batch_size, claim_timeout)
+        if not entries:
+            break
+        now = timezone.now()
+        max_lag = max(max_lag, (now - entries[0].created).total_seconds())
+
+        sent, failed, calls = send_entries(entries)
+        sends += calls
+        if sent:
+            NotificationOutbox.objects.filter(pk__in=[entry.pk for entry in sent]).update(
+                sent=now, claimed_until=None)
+        backoff = {}
+        for entry in failed:
+            backoff.setdefault(entry.attempts, []).append(entry.pk)
+            if entry.attempts >= _max_attempts():
+                logger.error('Giving up on outbox row %s after %d attempts',
+                             entry.pk, entry.attempts)
+        for attempts, pks in backoff.items():
+            # Still claimed until the backoff passes, so this run moves on.
+            NotificationOutbox.objects.filter(pk__in=pks).update(
+                claimed_until=now + timedelta(seconds=_window() * 2 ** attempts))
+        drained += len(sent)
+        errors += len(failed)
+
+    retrying = NotificationOutbox.objects.filter(
+        sent__isnull=True, attempts__lt=_max_attempts(), attempts__gt=0).exists()
+    if retrying:
+        schedule_drain()
+
+    elapsed = time.time() - started
+    stats = {
+        'drained': drained,
+        'sends': sends,
+        'errors': errors,
+        'elapsed': elapsed,
+        'rows_per_second': drained / elapsed if elapsed else 0.0,
+        'max_lag': max_lag,
+        'finished': time.time(),
+    }
+    cache.set(STATS_KEY, stats, None)
+    logger.info('Drained %(drained)d outbox rows into %(sends)d sends in '
+                '%(elapsed).3fs (%(rows_per_second).1f rows/s, max lag %(max_lag).3fs, '
+                '%(errors)d failed)', stats)
+    return stats
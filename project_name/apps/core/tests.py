@@ -0,0 +1,1890 @@
+import io
+import os
+import logging
+import time
+import shutil
+import smtplib
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+from unittest import skipUnless
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import CommandError
+from django.http import HttpResponse
+from django.template.base import Template
+from django.contrib.auth import SESSION_KEY
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.backends.db import SessionStore as DatabaseSessionStore
+from django.contrib.sessions.models import Session
+from django.db import connections, router as db_router
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import six, timezone
+from django.utils.six.moves import BaseHTTPServer, socketserver
+
+from . import outbox, views
+from .management.commands import compile_templates, migrate_sessions, reprocess_media
+from .models import DerivativeManifest, NotificationOutbox, SourceVersion
+from ... import (
+    dbconnections, instrumentation, logutils, mail, notifications, profiling, ratelimit, redis_utils, routers,
+    s3, sessions, sms, staticfiles, templating)
+from ...caching import stampede
+from ...caching import responses
+from ...caching.responses import ResponseCacheMiddleware, cache_response
+from ...caching.backends import MISSING, TwoTierRedisCache
+from ...imaging import compression, manifest, placeholders, thumbnails
+from ...imaging import fetch
+from ...imaging.fetch import SharedFetch, Source, SourceTooLarge
+from ...notifications import MAX_PLAYER_IDS, OneSignalDispatcher, merge_payloads
+
+
+class StubResponse(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.reason = 'stub'
+
+
+class StubSession(object):
+    """Answers each ``post`` with the next status code, or raises it if it
+    is an exception."""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.posts = []
+
+    def post(self, url, data=None, timeout=None):
+        self.posts.append(data)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return StubResponse(outcome)
+
+
+def stub_dispatcher(outcomes, **kwargs):
+    kwargs.setdefault('max_retries', 3)
+    kwargs.setdefault('backoff', 0)
+    dispatcher = OneSignalDispatcher(url='https://onesignal.invalid/', **kwargs)
+    # Skip _setup: no real session or thread pool.
+    dispatcher._pid = os.getpid()
+    dispatcher._session = StubSession(outcomes)
+    return dispatcher
+
+
+class MergePayloadsTests(SimpleTestCase):
+
+    def test_unions_segments_of_identical_bodies(self):
+        merged = merge_payloads([
+            {'contents': {'en': 'hi'}, 'included_segments': ['A']},
+            {'contents': {'en': 'hi'}, 'included_segments': ['B', 'A']},
+        ])
+        self.assertEqual(merged, [{'contents': {'en': 'hi'}, 'included_segments': ['A', 'B']}])
+
+    def test_keeps_different_bodies_apart_in_order(self):
+        merged = merge_payloads([
+            {'contents': {'en': 'second'}, 'included_segments': ['A']},
+            {'contents': {'en': 'first'}, 'included_segments': ['A']},
+        ])
+        self.assertEqual([p['contents']['en'] for p in merged], ['second', 'first'])
+
+    def test_player_ids_are_deduplicated_and_chunked(self):
+        ids = ['p{}'.format(n) for n in range(MAX_PLAYER_IDS + 10)]
+        merged = merge_payloads([
+            {'contents': {'en': 'hi'}, 'include_player_ids': ids[:100]},
+            {'contents': {'en': 'hi'}, 'include_player_ids': ids},
+        ])
+        self.assertEqual([len(p['include_player_ids']) for p in merged], [MAX_PLAYER_IDS, 10])
+        self.assertEqual(merged[0]['include_player_ids'] + merged[1]['include_player_ids'], ids)
+
+    def test_segment_and_player_targeting_are_not_mixed(self):
+        merged = merge_payloads([
+            {'contents': {'en': 'hi'}, 'included_segments': ['A']},
+            {'contents': {'en': 'hi'}, 'include_player_ids': ['p1']},
+        ])
+        self.assertEqual(len(merged), 2)
+        self.assertNotIn('include_player_ids', merged[0])
+        self.assertNotIn('included_segments', merged[1])
+
+
+class DispatcherRetryTests(SimpleTestCase):
+
+    def test_retries_transient_statuses(self):
+        dispatcher = stub_dispatcher([503, 429, 200])
+        self.assertEqual(dispatcher.send({'contents': {'en': 'hi'}}).status_code, 200)
+        self.assertEqual(len(dispatcher._session.posts), 3)
+
+    def test_does_not_retry_client_errors(self):
+        dispatcher = stub_dispatcher([400, 200])
+        self.assertEqual(dispatcher.send({}).status_code, 400)
+        self.assertEqual(len(dispatcher._session.posts), 1)
+
+    def test_gives_up_after_max_retries(self):
+        dispatcher = stub_dispatcher([503] * 5, max_retries=2)
+        self.assertEqual(dispatcher.send({}).status_code, 503)
+        self.assertEqual(len(dispatcher._session.posts), 3)
+
+    def test_connection_errors_are_retried_then_raised(self):
+        import requests
+        dispatcher = stub_dispatcher([requests.ConnectionError()] * 3, max_retries=2)
+        with self.assertRaises(requests.ConnectionError):
+            dispatcher.send({})
+        self.assertEqual(len(dispatcher._session.posts), 3)
+
+    def test_backoff_doubles_up_to_the_cap(self):
+        delays = []
+        sleep = notifications.time.sleep
+        notifications.time.sleep = delays.append
+        self.addCleanup(setattr, notifications.time, 'sleep', sleep)
+
+        dispatcher = stub_dispatcher([503] * 5, max_retries=4, backoff=0.1, max_backoff=0.3)
+        dispatcher.send({})
+        # Jittered down to half of 0.1, 0.2, 0.3 and 0.3 seconds.
+        for delay, ceiling in zip(delays, (0.1, 0.2, 0.3, 0.3)):
+            self.assertTrue(ceiling / 2 <= delay <= ceiling, (delay, ceiling))
+        self.assertEqual(len(delays), 4)
+
+
+class StubOneSignalHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers each POST with the server's next status, keeping the connection open."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((time.time(), self.client_address))
+        body = b'{}'
+        self.send_response(self.server.statuses.pop(0))
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, **attrs):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.requests = []
+        self.__dict__.update(attrs)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server_address[1])
+
+
+def serve(test, handler, **attrs):
+    """Run a :class:`StubHTTPServer` for the rest of ``test``."""
+    server = StubHTTPServer(handler, **attrs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    return server
+
+
+class DispatcherServerTests(SimpleTestCase):
+
+    def dispatcher(self, statuses, **kwargs):
+        self.server = serve(self, StubOneSignalHandler, statuses=list(statuses))
+        return OneSignalDispatcher(url=self.server.url, **kwargs)
+
+    def test_retries_back_off_over_one_kept_alive_connection(self):
+        dispatcher = self.dispatcher([503, 429, 200, 200], backoff=0.05, max_backoff=1.0)
+        self.assertEqual(dispatcher.send({'contents': {'en': 'hi'}}).status_code, 200)
+        self.assertEqual(dispatcher.send({'contents': {'en': 'bye'}}).status_code, 200)
+
+        times = [t for t, _ in self.server.requests]
+        self.assertEqual(len(times), 4)
+        # Jittered down to no less than half of 0.05 and 0.1 seconds.
+        self.assertGreaterEqual(times[1] - times[0], 0.025)
+        self.assertGreaterEqual(times[2] - times[1], 0.05)
+        self.assertEqual(len(set(address for _, address in self.server.requests)), 1)
+
+
+class StubDispatcher(object):
+    """Fails the payloads ``fail`` returns true for, with a 500 or by raising."""
+
+    def __init__(self, fail=lambda payload: False, raises=False):
+        self.fail = fail
+        self.raises = raises
+        self.sent = []
+
+    def send_many(self, payloads, return_exceptions=False):
+        responses = []
+        for payload in payloads:
+            self.sent.append(payload)
+            if not self.fail(payload):
+                responses.append(StubResponse(200))
+            elif self.raises:
+                responses.append(IOError('connection reset'))
+            else:
+                responses.append(StubResponse(500))
+        return responses
+
+
+def message_is(text):
+    return lambda payload: payload.get('contents', {}).get('en') == text
+
+
+class OutboxDrainTests(TestCase):
+
+    def setUp(self):
+        self.rescheduled = []
+        self.patch(outbox, 'schedule_drain', lambda: self.rescheduled.append(True))
+
+    def patch(self, obj, name, value):
+        original = getattr(obj, name)
+        setattr(obj, name, value)
+        self.addCleanup(setattr, obj, name, original)
+
+    def drain(self, dispatcher):
+        self.patch(notifications, 'dispatcher', dispatcher)
+        return outbox.drain_outbox(wait=False)
+
+    def create(self, *messages):
+        return [NotificationOutbox.objects.create(segment='All', action='news', message=message)
+                for message in messages]
+
+    def test_notification_template_only_writes_an_outbox_row(self):
+        from ... import utils
+        utils.notification_template(None, action='news', message='hello')
+        self.assertEqual(NotificationOutbox.objects.get().message, 'hello')
+
+    def test_distinct_messages_are_all_sent(self):
+        self.create('hello', 'bye', 'hello')
+        dispatcher = StubDispatcher()
+        stats = self.drain(dispatcher)
+
+        self.assertEqual(stats['drained'], 3)
+        loud = [p['contents']['en'] for p in dispatcher.sent if 'contents' in p]
+        self.assertEqual(sorted(loud), ['bye', 'hello'])
+        # Both messages share one silent push.
+        self.assertEqual(len(dispatcher.sent), 3)
+        self.assertFalse(NotificationOutbox.objects.filter(sent__isnull=True).exists())
+
+    def test_failed_sends_stay_pending_and_back_off(self):
+        hello, bye = self.create('hello', 'bye')
+        self.drain(StubDispatcher(fail=message_is('bye')))
+
+        hello.refresh_from_db()
+        bye.refresh_from_db()
+        self.assertIsNotNone(hello.sent)
+        self.assertIsNone(bye.sent)
+        self.assertEqual(bye.attempts, 1)
+        self.assertGreater(bye.claimed_until, timezone.now())
+        self.assertEqual(self.rescheduled, [True])
+
+    def test_exceptions_count_as_failures(self):
+        entry, = self.create('hello')
+        stats = self.drain(StubDispatcher(fail=message_is('hello'), raises=True))
+        entry.refresh_from_db()
+        self.assertIsNone(entry.sent)
+        self.assertEqual(stats['errors'], 1)
+
+    def test_rows_are_retried_until_max_attempts(self):
+        entry, = self.create('hello')
+        with self.settings(NOTIFICATION_OUTBOX_MAX_ATTEMPTS=2):
+            for _ in range(3):
+                NotificationOutbox.objects.update(claimed_until=None)
+                self.drain(StubDispatcher(fail=message_is('hello')))
+        entry.refresh_from_db()
+        self.assertEqual(entry.attempts, 2)
+        self.assertIsNone(entry.sent)
+
+
+class ScheduleDrainTests(SimpleTestCase):
+
+    def test_enqueue_failure_does_not_raise_or_block_rescheduling(self):
+        import django_rq
+
+        def broken(*args, **kwargs):
+            raise IOError('no redis')
+
+        enqueue = django_rq.enqueue
+        django_rq.enqueue = broken
+        self.addCleanup(setattr, django_rq, 'enqueue', enqueue)
+        cache.delete(outbox.DRAIN_SCHEDULED_KEY)
+
+        outbox.schedule_drain()
+        self.assertIsNone(cache.get(outbox.DRAIN_SCHEDULED_KEY))
+
+
+class BufferReaderTests(SimpleTestCase):
+
+    def test_reads_in_chunks_without_copying_the_buffer(self):
+        reader = s3.BufferReader(bytearray(b'abcdefgh'))
+        self.assertEqual(reader.read(3), b'abc')
+        self.assertEqual(reader.tell(), 3)
+        buf = bytearray(4)
+        self.assertEqual(reader.readinto(buf), 4)
+        self.assertEqual(bytes(buf), b'defg')
+        self.assertEqual(reader.read(), b'h')
+        self.assertEqual(reader.read(), b'')
+
+    def test_seek(self):
+        reader = s3.BufferReader(memoryview(b'abcdefgh'))
+        reader.seek(-2, os.SEEK_END)
+        self.assertEqual(reader.read(), b'gh')
+        reader.seek(1)
+        reader.seek(2, os.SEEK_CUR)
+        self.assertEqual(reader.read(2), b'de')
+
+    def test_as_fileobj_rewinds_files_and_wraps_buffers(self):
+        reader = s3.BufferReader(b'abc')
+        reader.read()
+        self.assertIs(s3.as_fileobj(reader), reader)
+        self.assertEqual(reader.tell(), 0)
+        self.assertEqual(s3.as_fileobj(b'xyz').read(), b'xyz')
+
+
+class StubS3Client(object):
+
+    def __init__(self):
+        self.signed = []
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        self.signed.append(Params['Key'])
+        return 'https://signed.invalid/{}?expires={}'.format(Params['Key'], ExpiresIn)
+
+
+@override_settings(AWS_QUERYSTRING_AUTH=True, AWS_STORAGE_BUCKET_NAME='bucket',
+                   AWS_QUERYSTRING_EXPIRE=3600, S3_URL_CACHE_MARGIN=300)
+class ResolveURLsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.client = StubS3Client()
+        clients = dict(s3._clients)
+        s3._clients.clear()
+        s3._clients[os.getpid()] = self.client
+        self.addCleanup(s3._clients.update, clients)
+        self.addCleanup(s3._clients.clear)
+        s3._urls.clear()
+        self.addCleanup(s3._urls.clear)
+        cache.clear()
+
+    def test_signs_each_key_once(self):
+        urls = s3.resolve_urls(['a.jpg', 'b.jpg'])
+        self.assertEqual(sorted(self.client.signed), ['a.jpg', 'b.jpg'])
+        self.assertEqual(urls['a.jpg'], 'https://signed.invalid/a.jpg?expires=3600')
+
+        self.assertEqual(s3.resolve_urls(['a.jpg', 'b.jpg']), urls)
+        self.assertEqual(len(self.client.signed), 2)
+
+    def test_other_processes_reuse_the_shared_cache(self):
+        url = s3.resolve_url('a.jpg')
+        # As seen from a worker with an empty in-process tier.
+        s3._urls.clear()
+        self.assertEqual(s3.resolve_urls(['a.jpg', 'c.jpg']), {
+            'a.jpg': url, 'c.jpg': 'https://signed.invalid/c.jpg?expires=3600'})
+        self.assertEqual(self.client.signed, ['a.jpg', 'c.jpg'])
+
+    @override_settings(AWS_QUERYSTRING_AUTH=False, S3_URL='https://bucket.invalid/')
+    def test_unsigned_urls_need_no_client(self):
+        self.assertEqual(s3.resolve_urls(['a.jpg']), {'a.jpg': 'https://bucket.invalid/a.jpg'})
+        self.assertEqual(self.client.signed, [])
+
+    @override_settings(AWS_QUERYSTRING_AUTH=False, S3_URL='https://bucket.invalid/')
+    def test_unsigned_keys_are_quoted(self):
+        self.assertEqual(s3.resolve_url('photos/a b#1.jpg'),
+                         'https://bucket.invalid/photos/a%20b%231.jpg')
+
+    @override_settings(S3_URL_CACHE_MARGIN=3600)
+    def test_no_caching_when_the_margin_leaves_no_time(self):
+        s3.resolve_url('a.jpg')
+        s3.resolve_url('a.jpg')
+        self.assertEqual(self.client.signed, ['a.jpg', 'a.jpg'])
+        self.assertIsNone(cache.get(s3.URL_CACHE_PREFIX + 'a.jpg'))
+
+
+class StubS3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Just enough of S3 for ``upload_fileobj``: bodies are read and discarded."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        self.server.requests.append(('PUT', self.drain()))
+        self.reply(headers=[('ETag', '"etag"')])
+
+    def do_POST(self):
+        self.drain()
+        if self.path.endswith('?uploads'):
+            self.reply(b'<InitiateMultipartUploadResult><Bucket>bucket</Bucket>'
+                       b'<Key>key</Key><UploadId>upload</UploadId></InitiateMultipartUploadResult>')
+        else:
+            self.reply(b'<CompleteMultipartUploadResult><Bucket>bucket</Bucket>'
+                       b'<Key>key</Key><ETag>"etag"</ETag></CompleteMultipartUploadResult>')
+
+    def drain(self):
+        remaining = size = int(self.headers.get('Content-Length') or 0)
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 64 * 1024)))
+        return size
+
+    def reply(self, body=b'', headers=()):
+        self.send_response(200)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(AWS_STORAGE_BUCKET_NAME='bucket', AWS_S3_MULTIPART_THRESHOLD=5 * s3.MB,
+                   AWS_S3_MULTIPART_CHUNKSIZE=5 * s3.MB, AWS_S3_MAX_CONCURRENCY=2)
+class StreamingUploadTests(SimpleTestCase):
+
+    def setUp(self):
+        import boto3
+        from botocore.config import Config
+        self.server = serve(self, StubS3Handler)
+        client = boto3.session.Session('key', 'secret', region_name='us-east-1').client(
+            's3', endpoint_url=self.server.url, config=Config(s3={'addressing_style': 'path'}))
+        clients = dict(s3._clients)
+        s3._clients.clear()
+        s3._clients[os.getpid()] = client
+        self.addCleanup(s3._clients.update, clients)
+        self.addCleanup(s3._clients.clear)
+
+    @skipUnless(tracemalloc, 'tracemalloc is Python 3.4+')
+    def test_large_body_is_streamed_a_few_parts_at_a_time(self):
+        body = bytearray(64 * s3.MB)
+        tracemalloc.start()
+        try:
+            s3.upload(body, 'big.bin')
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(sum(size for _, size in self.server.requests), len(body))
+        self.assertGreater(len(self.server.requests), 1)
+        # Two parts in flight and one read ahead, against a 64MB body.
+        self.assertLess(peak, len(body) / 3)
+
+
+def image_bytes(fmt, size=(200, 100)):
+    from PIL import Image
+    output = io.BytesIO()
+    Image.new('RGB', size, (200, 30, 30)).save(output, format=fmt)
+    return output.getvalue()
+
+
+class ThumbnailTests(SimpleTestCase):
+    specs = {'small': (50, 50, 'crop')}
+
+    @override_settings(IMAGE_DECODE_MAX_PIXELS=10000)
+    def test_large_non_jpeg_sources_are_refused(self):
+        with self.assertRaises(SourceTooLarge):
+            thumbnails.decode(image_bytes('PNG'), self.specs)
+        # JPEG is draft-decoded, so the cap doesn't apply.
+        self.assertEqual(thumbnails.decode(image_bytes('JPEG'), self.specs).size[0], 100)
+
+    def test_converted_thumbnails_take_the_output_extension(self):
+        self.assertEqual(thumbnails.output_ext('jpg'), 'jpg')
+        self.assertEqual(thumbnails.output_ext('gif'), 'png')
+        im = thumbnails.decode(image_bytes('GIF'), self.specs)
+        self.assertEqual(thumbnails.encode(im, 'gif')[1], 'PNG')
+        self.assertTrue(thumbnails.manifest_spec('small', self.specs['small'], 'gif').endswith(':png'))
+        self.assertNotIn(':jpg', thumbnails.manifest_spec('small', self.specs['small'], 'jpg'))
+
+
+def noisy_image(mode='RGB', size=(64, 64)):
+    from PIL import Image
+    channels = len(mode)
+    return Image.frombytes(mode, size, os.urandom(size[0] * size[1] * channels))
+
+
+class CompressionTests(SimpleTestCase):
+
+    def test_jpeg_search_finds_the_highest_quality_within_budget(self):
+        im = noisy_image()
+        sizes = dict((q, len(compression._save(im, 'JPEG', quality=q, optimize=True, progressive=True)))
+                     for q in range(30, 91))
+        budget = sizes[70]
+        best = max(q for q, size in sizes.items() if size <= budget)
+        data = compression._search_jpeg(im, budget, 30, 90)
+        self.assertEqual(len(data), sizes[best])
+
+    def test_jpeg_search_falls_back_to_the_minimum_quality(self):
+        im = noisy_image()
+        data = compression._search_jpeg(im, 1, 30, 90)
+        self.assertEqual(data, compression._save(im, 'JPEG', quality=30, optimize=True, progressive=True))
+
+    def test_png_is_quantized_to_a_palette(self):
+        from PIL import Image
+        im = noisy_image('RGBA')
+        data = compression._quantize_png(im)
+        self.assertEqual(Image.open(io.BytesIO(data)).mode, 'P')
+        self.assertLess(len(data), len(compression._save(im, 'PNG', optimize=True)))
+
+    def test_primary_output_is_never_larger_than_the_source(self):
+        source = image_bytes('JPEG', (64, 64))
+        outputs = compression.encode(source, 'jpg', dict(compression._options(), jpeg_target_ratio=0.01))
+        self.assertLessEqual(len(outputs['jpg']), len(source))
+
+    @override_settings(IMAGE_DECODE_MAX_PIXELS=10000)
+    def test_large_non_jpeg_sources_are_refused(self):
+        with self.assertRaises(SourceTooLarge):
+            compression.encode(image_bytes('PNG'), 'png', compression._options())
+
+
+class StubTinifyBackend(compression.TinifyBackend):
+    def __init__(self):
+        self.compressed = []
+
+    def compress(self, instance, data=None):
+        self.compressed.append(data)
+
+
+class StubImage(object):
+    image = 'https://bucket.invalid/uploads/a.png'
+    pk = None
+
+
+class TinifyManifestTests(TestCase):
+
+    def setUp(self):
+        for name in ('fetch', 'head'):
+            self.addCleanup(setattr, manifest, name, getattr(manifest, name))
+        manifest.fetch = lambda url: self.fail('the source was downloaded')
+        manifest.head = lambda url: self.version
+        self.version = '"e1":5'
+
+    def test_source_is_never_downloaded(self):
+        backend = StubTinifyBackend()
+        compression.compress(StubImage(), backend)
+        compression.compress(StubImage(), backend)
+        self.assertEqual(backend.compressed, [None])
+
+        self.version = '"e2":5'
+        compression.compress(StubImage(), backend)
+        self.assertEqual(len(backend.compressed), 2)
+
+
+class StubImageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the server's ``body``, with a ``Content-Length`` only if
+    ``send_length`` is set; HTTP/1.0, so the end of the body closes it."""
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('ETag', '"etag"')
+        self.send_header('Content-Length', str(len(self.server.body)))
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.send_response(200)
+        if self.server.send_length:
+            self.send_header('Content-Length', str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchTests(SimpleTestCase):
+
+    def serve(self, body, send_length=True):
+        self.server = serve(self, StubImageHandler, body=body, send_length=send_length)
+        return self.server.url + 'uploads/a.png'
+
+    def test_source_is_streamed_and_hashed(self):
+        import hashlib
+        body = image_bytes('PNG')
+        source = fetch.fetch(self.serve(body))
+        self.addCleanup(source.close)
+        self.assertEqual((source.digest, source.size), (hashlib.sha256(body).hexdigest(), len(body)))
+        self.assertEqual(source.read(), body)
+
+    def test_declared_length_over_the_limit_is_refused(self):
+        with self.assertRaises(SourceTooLarge):
+            fetch.fetch(self.serve(image_bytes('PNG')), max_bytes=100)
+
+    def test_undeclared_length_is_cut_off_while_streaming(self):
+        with self.assertRaises(SourceTooLarge):
+            fetch.fetch(self.serve(image_bytes('PNG'), send_length=False), max_bytes=100)
+
+    def test_pixel_limit_is_checked_from_the_header(self):
+        with self.assertRaises(SourceTooLarge):
+            fetch.fetch(self.serve(image_bytes('PNG')), max_pixels=10000)
+
+    def test_head_returns_etag_and_size(self):
+        body = image_bytes('PNG')
+        self.assertEqual(fetch.head(self.serve(body)), '"etag":{}'.format(len(body)))
+
+    def test_shared_fetch_downloads_once(self):
+        url = self.serve(image_bytes('PNG'))
+        with SharedFetch(url) as fetched:
+            first = fetched()
+            first.file.read()
+            self.assertIs(fetched(), first)
+            self.assertEqual(first.file.tell(), 0)
+        self.assertTrue(first.file.closed)
+        self.assertEqual(len(self.server.requests), 1)
+
+
+class StubField(object):
+    def __init__(self, attname):
+        self.attname = attname
+
+
+class StubOptions(object):
+    def __init__(self, *fields):
+        self.concrete_fields = [StubField(name) for name in ('id', 'image') + fields]
+
+
+class PhotoWithPlaceholder(object):
+    _meta = StubOptions('placeholder')
+    image = 'https://bucket.invalid/uploads/a.png'
+    placeholder = ''
+    pk = None
+
+
+class PhotoWithoutPlaceholder(object):
+    _meta = StubOptions()
+    image = 'https://bucket.invalid/uploads/a.png'
+    pk = None
+
+
+class PlaceholderTests(TestCase):
+
+    def setUp(self):
+        self.uploads = []
+        for module, name, value in (
+                (manifest, 'head', lambda url: None),
+                (manifest, 'fetch', lambda url: Source(url, io.BytesIO(image_bytes('PNG')), 'digest', 0)),
+                (s3, 'upload', lambda data, path, **kwargs: self.uploads.append(path)),
+                (s3, 'resolve_url', lambda key: 'https://bucket.invalid/' + key)):
+            self.addCleanup(setattr, module, name, getattr(module, name))
+            setattr(module, name, value)
+
+    @override_settings(PLACEHOLDER_MODE='inline', PLACEHOLDER_FIELD='placeholder')
+    def test_inline_placeholder_is_set_on_the_field(self):
+        photo = PhotoWithPlaceholder()
+        value = placeholders.make_placeholder(photo)
+        self.assertTrue(value.startswith('data:image/'))
+        self.assertEqual(photo.placeholder, value)
+        self.assertEqual(self.uploads, [])
+
+    @override_settings(PLACEHOLDER_MODE='inline', PLACEHOLDER_FIELD='placeholder')
+    def test_model_without_the_field_falls_back_to_s3(self):
+        value = placeholders.make_placeholder(PhotoWithoutPlaceholder())
+        self.assertEqual(self.uploads, ['uploads/a_placeholder.png'])
+        self.assertEqual(value, 'https://bucket.invalid/uploads/a_placeholder.png')
+        self.assertEqual(DerivativeManifest.objects.get().value, 'uploads/a_placeholder.png')
+
+
+class DerivativesTests(TestCase):
+    url = 'https://bucket.invalid/uploads/a.jpg'
+
+    def setUp(self):
+        self.fetched = []
+        self.digest = 'old'
+        self.version = None
+        for name in ('fetch', 'head'):
+            self.addCleanup(setattr, manifest, name, getattr(manifest, name))
+        manifest.fetch = self.fetch
+        manifest.head = lambda url: self.version
+        DerivativeManifest.objects.create(
+            source=self.url, content_hash='old', spec='thumb', value='uploads/a_thumb.jpg')
+
+    def fetch(self, url):
+        source = Source(url, io.BytesIO(b'image'), self.digest, 5)
+        self.fetched.append(source)
+        return source
+
+    def test_unchanged_source_is_found(self):
+        with manifest.Derivatives(self.url, {'thumb': 'uploads/a_thumb.jpg'}) as derivatives:
+            self.assertEqual(derivatives.resolve(), {})
+        self.assertEqual(derivatives.found, {'thumb': 'uploads/a_thumb.jpg'})
+
+    def test_source_overwritten_in_place_is_rebuilt(self):
+        self.digest = 'new'
+        with manifest.Derivatives(self.url, {'thumb': 'uploads/a_thumb.jpg'}) as derivatives:
+            self.assertEqual(derivatives.resolve(), {'thumb': 'uploads/a_thumb.jpg'})
+            derivatives.done({'thumb': 'uploads/a_thumb.jpg'})
+        self.assertEqual(DerivativeManifest.objects.get(source=self.url).content_hash, 'new')
+
+    def test_same_bytes_under_another_url_reuse_inline_values(self):
+        DerivativeManifest.objects.create(
+            source=self.url, content_hash='old', spec='placeholder', value='data:image/png,x')
+        other = 'https://bucket.invalid/uploads/b.jpg'
+        with manifest.Derivatives(other, {'placeholder': None}) as derivatives:
+            self.assertEqual(derivatives.resolve(), {})
+        self.assertEqual(DerivativeManifest.objects.get(source=other).value, 'data:image/png,x')
+
+    def test_fetched_source_is_closed(self):
+        with manifest.Derivatives(self.url, {'thumb': 'uploads/a_thumb.jpg'}) as derivatives:
+            derivatives.resolve()
+        self.assertTrue(self.fetched[0].file.closed)
+        self.assertIsNone(derivatives.data)
+
+    def test_shared_source_is_left_open_for_the_next_util(self):
+        fetched = SharedFetch(self.url)
+        fetched._source = self.fetch(self.url)
+        with manifest.Derivatives(self.url, {'other': None}, fetched=fetched) as derivatives:
+            derivatives.resolve()
+        self.assertFalse(self.fetched[0].file.closed)
+        fetched.close()
+        self.assertTrue(self.fetched[0].file.closed)
+
+    def test_unchanged_version_is_found_without_fetching(self):
+        SourceVersion.objects.create(source=self.url, version='"e1":5', content_hash='old')
+        self.version = '"e1":5'
+        with manifest.Derivatives(self.url, {'thumb': 'uploads/a_thumb.jpg'}) as derivatives:
+            self.assertEqual(derivatives.resolve(), {})
+            self.assertIsNone(derivatives.data)
+        self.assertEqual(self.fetched, [])
+
+    def test_missing_spec_of_a_known_version_fetches_to_build(self):
+        SourceVersion.objects.create(source=self.url, version='"e1":5', content_hash='old')
+        self.version = '"e1":5'
+        with manifest.Derivatives(self.url, {'thumb': 'uploads/a_thumb.jpg', 'other': None}) as derivatives:
+            self.assertEqual(derivatives.resolve(), {'other': None})
+            self.assertEqual(derivatives.data.read(), b'image')
+
+    def test_changed_version_is_hashed_again(self):
+        SourceVersion.objects.create(source=self.url, version='"e1":5', content_hash='old')
+        self.version, self.digest = '"e2":5', 'new'
+        with manifest.Derivatives(self.url, {'thumb': 'uploads/a_thumb.jpg'}) as derivatives:
+            self.assertEqual(derivatives.resolve(), {'thumb': 'uploads/a_thumb.jpg'})
+        self.assertEqual(len(self.fetched), 1)
+        self.assertEqual(SourceVersion.objects.get(source=self.url).content_hash, 'new')
+
+    def test_lookup_many_only_counts_current_hashes(self):
+        other = 'https://bucket.invalid/uploads/b.jpg'
+        SourceVersion.objects.create(source=self.url, version='"e1":5', content_hash='old')
+        SourceVersion.objects.create(source=other, version='"e2":5', content_hash='new')
+        DerivativeManifest.objects.create(
+            source=other, content_hash='old', spec='thumb', value='uploads/b_thumb.jpg')
+        with self.assertNumQueries(2):
+            found = manifest.lookup_many([self.url, other, 'unknown'], ['thumb'])
+        self.assertEqual(found, {self.url: {'thumb': 'uploads/a_thumb.jpg'}, other: {}, 'unknown': {}})
+
+
+class StubHandle(object):
+    def __init__(self, outcome):
+        self.outcome = outcome
+
+    def result(self):
+        if isinstance(self.outcome, BaseException):
+            raise self.outcome
+        return self.outcome
+
+
+class StubJob(object):
+    id = 'job'
+
+    def __init__(self, states, result=None):
+        self.states = list(states)
+        self.result = result
+
+    @property
+    def is_finished(self):
+        return self.states[0] == 'finished'
+
+    @property
+    def is_failed(self):
+        state = self.states.pop(0)
+        return state == 'failed'
+
+
+class ReprocessRunTests(SimpleTestCase):
+    def command(self):
+        command = reprocess_media.Command(stdout=six.StringIO(), stderr=six.StringIO())
+        command.options = {'workers': 1, 'rate': 0}
+        command.started = time.time()
+        command.submitted = 0
+        return command
+
+    def test_failed_rows_and_crashed_chunks_are_collected_in_order(self):
+        outcomes = {1: (2, [2]), 3: RuntimeError('worker died'), 5: (1, [])}
+        finished = []
+        failed = self.command().run(
+            lambda pks: StubHandle(outcomes[pks[0]]),
+            iter([[1, 2], [3, 4], [5]]),
+            lambda pks, processed, failed: finished.append(pks[-1]))
+        self.assertEqual(failed, [2, 3, 4])
+        self.assertEqual(finished, [2, 4, 5])
+
+    def test_queued_chunk_waits_for_the_job(self):
+        reprocess_media.QueuedChunk.poll_interval = 0
+        self.addCleanup(setattr, reprocess_media.QueuedChunk, 'poll_interval', 0.5)
+        job = StubJob(['started', 'finished'], result=(3, [7]))
+        self.assertEqual(reprocess_media.QueuedChunk(job).result(), (3, [7]))
+        with self.assertRaises(RuntimeError):
+            reprocess_media.QueuedChunk(StubJob(['started', 'failed'])).result()
+
+
+class StubRows(object):
+    def __init__(self, pks):
+        self.pks = pks
+
+    def exclude(self, **kwargs):
+        return self
+
+    def order_by(self, *fields):
+        return self
+
+    def filter(self, pk__gt):
+        return StubRows([pk for pk in self.pks if pk > pk__gt])
+
+    def values_list(self, *fields, **kwargs):
+        return self.pks
+
+    def count(self):
+        return len(self.pks)
+
+
+class StubImageModel(object):
+    class _meta:
+        label = 'core.Stub'
+
+    _default_manager = StubRows([1, 2, 3, 4, 5])
+
+
+class Interrupted(BaseException):
+    pass
+
+
+class ReprocessCheckpointTests(SimpleTestCase):
+    key = reprocess_media.CHECKPOINT_PREFIX + 'core.Stub'
+
+    def command(self, outcome):
+        command = reprocess_media.Command(stdout=six.StringIO(), stderr=six.StringIO())
+        command.options = {'workers': 1, 'rate': 0, 'chunk_size': 2, 'retries': 1,
+                           'restart': False}
+        command.submitted_pks = []
+
+        @contextmanager
+        def executor(label):
+            def submit(pks):
+                command.submitted_pks.append(list(pks))
+                return StubHandle(outcome(pks))
+            yield submit
+
+        command.executor = executor
+        self.addCleanup(cache.delete, self.key)
+        return command
+
+    def test_failed_rows_survive_an_interrupted_run(self):
+        def first_run(pks):
+            if pks[0] == 1:
+                return 2, [2]
+            return Interrupted()
+
+        with self.assertRaises(Interrupted):
+            self.command(first_run).process(StubImageModel)
+        self.assertEqual(cache.get(self.key), {'last_pk': 2, 'failed': [2]})
+
+        command = self.command(lambda pks: (len(pks), []))
+        command.process(StubImageModel)
+        self.assertEqual(command.submitted_pks, [[3, 4], [5], [2]])
+        self.assertIsNone(cache.get(self.key))
+
+
+class StubLimiter(object):
+    def __init__(self, limited=False):
+        self.limited = limited
+
+    def acquire(self, block=True):
+        if self.limited:
+            raise ratelimit.RateLimited('stub', 1.0)
+
+
+class StubProvider(sms.BaseProvider):
+    def __init__(self, name, fail=False, limited=False, delay=0):
+        super(StubProvider, self).__init__()
+        self.name = name
+        self.fail = fail
+        self.delay = delay
+        self.stub_limiter = StubLimiter(limited)
+        self.sent = []
+
+    @property
+    def limiter(self):
+        return self.stub_limiter
+
+    def send(self, destination, message):
+        time.sleep(self.delay)
+        if self.fail:
+            raise sms.SMSError('{}: down'.format(self.name))
+        self.sent.append((destination, message))
+        return '{}-id'.format(self.name)
+
+
+class SMSRouterTests(SimpleTestCase):
+    def router(self, *providers, **kwargs):
+        router = sms.SMSRouter(providers=[])
+        router.providers = list(providers)
+        router.breakers = dict((p.name, sms.CircuitBreaker(min_calls=1, cooldown=30, **kwargs))
+                               for p in providers)
+        return router
+
+    def trip(self, breaker, cooled=True):
+        while breaker.state != breaker.OPEN:
+            breaker.record(0.1, False)
+        if cooled:
+            breaker.opened -= breaker.cooldown
+
+    def test_fails_over_in_order(self):
+        first, second = StubProvider('first', fail=True), StubProvider('second')
+        router = self.router(first, second)
+        self.assertEqual(router.send('+1555', 'hi'), ('second', 'second-id'))
+        self.assertEqual(router.breakers['first'].calls, 1)
+
+    def test_open_breaker_is_skipped(self):
+        first, second = StubProvider('first'), StubProvider('second')
+        router = self.router(first, second)
+        self.trip(router.breakers['first'], cooled=False)
+        self.assertEqual(router.send('+1555', 'hi'), ('second', 'second-id'))
+        self.assertEqual(first.sent, [])
+
+    def test_later_trial_is_not_spent_when_an_earlier_provider_succeeds(self):
+        router = self.router(StubProvider('first'), StubProvider('second'))
+        self.trip(router.breakers['second'])
+        router.send('+1555', 'hi')
+        self.assertEqual(router.breakers['second'].state, sms.CircuitBreaker.OPEN)
+
+    def test_successful_trial_closes_the_breaker(self):
+        router = self.router(StubProvider('first'))
+        self.trip(router.breakers['first'])
+        self.assertEqual(router.send('+1555', 'hi'), ('first', 'first-id'))
+        self.assertEqual(router.breakers['first'].state, sms.CircuitBreaker.CLOSED)
+
+    def test_rate_limited_trial_is_released(self):
+        limited, second = StubProvider('first', limited=True), StubProvider('second')
+        router = self.router(limited, second)
+        self.trip(router.breakers['first'])
+        self.assertEqual(router.send('+1555', 'hi'), ('second', 'second-id'))
+        breaker = router.breakers['first']
+        self.assertEqual(breaker.state, sms.CircuitBreaker.OPEN)
+        self.assertTrue(breaker.allow())
+
+    def test_all_open_still_tries_in_order(self):
+        first, second = StubProvider('first', fail=True), StubProvider('second')
+        router = self.router(first, second)
+        for breaker in router.breakers.values():
+            self.trip(breaker, cooled=False)
+        self.assertEqual(router.send('+1555', 'hi'), ('second', 'second-id'))
+
+    def test_all_failing_raises(self):
+        router = self.router(StubProvider('first', fail=True), StubProvider('second', limited=True))
+        with self.assertRaises(sms.SMSError):
+            router.send('+1555', 'hi')
+
+    def test_slow_provider_is_routed_around(self):
+        slow, fast = StubProvider('slow', delay=0.05), StubProvider('fast')
+        router = self.router(slow, fast, slow=0.02)
+        used = [router.send('+1555', 'hi')[0] for _ in range(6)]
+        # The average climbs towards 0.05s and crosses 0.02s within a few
+        # calls, none of which failed.
+        self.assertEqual(used[0], 'slow')
+        self.assertEqual(used[-1], 'fast')
+        self.assertLessEqual(len(slow.sent), 3)
+        self.assertEqual(router.breakers['slow'].state, sms.CircuitBreaker.OPEN)
+        self.assertEqual(router.breakers['slow'].error_rate, 0.0)
+
+    def test_send_many_keeps_order_and_errors(self):
+        router = self.router(StubProvider('first'))
+        results = router.send_many([('+1', 'a'), ('+2', 'b')])
+        self.assertEqual(results, [('first', 'first-id')] * 2)
+        router = self.router(StubProvider('first', fail=True))
+        self.assertIsInstance(router.send_many([('+1', 'a')])[0], sms.SMSError)
+
+    def test_empty_provider_list_is_not_replaced_by_settings(self):
+        self.assertEqual(sms.SMSRouter(providers=[]).providers, [])
+
+
+class StubSMTPBackend(object):
+    def __init__(self, fail_open=False, disconnect_at=()):
+        self.fail_open = fail_open
+        self.disconnect_at = list(disconnect_at)
+        self.connection = None
+        self.sent = []
+
+    def open(self):
+        if self.fail_open:
+            self.connection = object()
+            raise smtplib.SMTPAuthenticationError(535, 'stub')
+        self.connection = object()
+
+    def close(self):
+        self.connection = None
+
+    def send_messages(self, messages):
+        if self.disconnect_at and self.disconnect_at[0] == len(self.sent):
+            self.disconnect_at.pop(0)
+            raise smtplib.SMTPServerDisconnected('stub')
+        self.sent.extend(messages)
+        return len(messages)
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    def test_checkout_times_out_when_exhausted(self):
+        pool = mail.ConnectionPool(1, StubSMTPBackend)
+        pool.get()
+        with self.assertRaises(smtplib.SMTPException):
+            pool.get(timeout=0.01)
+
+    def test_failed_reopen_keeps_the_slot(self):
+        backend = StubSMTPBackend()
+        pool = mail.ConnectionPool(1, lambda: backend)
+        pool.put(pool.get())
+        backend.close()
+        backend.fail_open = True
+        with self.assertRaises(smtplib.SMTPException):
+            pool.get()
+        backend.fail_open = False
+        self.assertIs(pool.get(timeout=0.01), backend)
+        self.assertIsNotNone(backend.connection)
+
+    def test_disconnect_resends_only_the_remainder(self):
+        backend = StubSMTPBackend(disconnect_at=[2])
+        connection = mail.PooledEmailBackend(host='smtp.invalid', port=25, username='u')
+        connection.pool = mail.ConnectionPool(1, lambda: backend)
+        self.assertEqual(connection.send_messages(['a', 'b', 'c', 'd']), 4)
+        self.assertEqual(backend.sent, ['a', 'b', 'c', 'd'])
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_lease_is_sized_from_capacity(self):
+        self.assertEqual(ratelimit.TokenBucket('a', 2, 200).lease, 20)
+        self.assertEqual(ratelimit.TokenBucket('b', 1, 5).lease, 1)
+
+    @override_settings(RATE_LIMITS={'leased': (10, 50, 8), 'plain': (10, 50)})
+    def test_lease_can_be_set_per_bucket(self):
+        self.addCleanup(ratelimit._buckets.clear)
+        self.assertEqual(ratelimit.bucket('leased', 1).lease, 8)
+        self.assertEqual(ratelimit.bucket('plain', 1).lease, 5)
+
+
+class MetricsViewTests(SimpleTestCase):
+    def get(self, user=None, token=None):
+        request = RequestFactory().get('/metrics/', HTTP_AUTHORIZATION='Bearer {}'.format(token))
+        request.user = user or AnonymousUser()
+        return views.metrics(request)
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_no_token_allows_only_staff(self):
+        self.assertEqual(self.get(token='None').status_code, 403)
+        self.assertEqual(self.get(user=User(is_staff=True)).status_code, 200)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token_allows_scraper(self):
+        self.assertEqual(self.get(token='wrong').status_code, 403)
+        self.assertEqual(self.get(token='secret').status_code, 200)
+
+
+class InstrumentSessionTests(SimpleTestCase):
+    def setUp(self):
+        self.recorded = []
+        record = instrumentation.recorder.record
+        instrumentation.recorder.record = lambda provider, endpoint, *args: (
+            self.recorded.append((provider, endpoint)))
+        self.addCleanup(setattr, instrumentation.recorder, 'record', record)
+
+    def session(self, **kwargs):
+        session = StubSession([IOError('down')])
+        session.request = lambda method, url: session.post(url)
+        return instrumentation.instrument_session(session, 'stub', **kwargs)
+
+    def test_label_is_host_not_path(self):
+        with self.assertRaises(IOError):
+            self.session().request('get', 'https://api.invalid/users/42?x=1')
+        self.assertEqual(self.recorded, [('stub', 'GET api.invalid')])
+
+    def test_label_can_be_named(self):
+        with self.assertRaises(IOError):
+            self.session(endpoint='users').request('post', 'https://api.invalid/users/42')
+        self.assertEqual(self.recorded, [('stub', 'POST users')])
+
+
+class StubRedis(object):
+    def __init__(self, hashes):
+        self.hashes = hashes
+        self.index = set(hashes)
+
+    def smembers(self, key):
+        return set(self.index)
+
+    def hgetall(self, key):
+        return self.hashes.get(key, {})
+
+    def srem(self, key, member):
+        self.index.discard(member)
+
+
+class SnapshotTests(SimpleTestCase):
+    def test_snapshot_reads_flushed_keys_and_drops_expired_ones(self):
+        live, expired = 'instr:stub:GET api.invalid', 'instr:stub:GET gone.invalid'
+        client = StubRedis({
+            cache.make_key(live): {b'count': b'2', b'total_us': b'3000', b'b20': b'2'}})
+        client.index = set([live, expired])
+        get_redis = instrumentation.get_redis
+        instrumentation.get_redis = lambda: client
+        self.addCleanup(setattr, instrumentation, 'get_redis', get_redis)
+
+        summaries = instrumentation.snapshot()
+        self.assertEqual(list(summaries), [('stub', 'GET api.invalid')])
+        self.assertEqual(summaries[('stub', 'GET api.invalid')]['count'], 2)
+        self.assertEqual(client.index, set([live]))
+
+
+class StubPipeline(object):
+    def __init__(self, fail):
+        self.fail = fail
+        self.calls = []
+
+    def __getattr__(self, command):
+        return lambda *args: self.calls.append((command,) + args)
+
+    def execute(self):
+        if self.fail:
+            raise IOError('redis down')
+
+
+class StubPipelineClient(object):
+    def __init__(self, fail=False):
+        self.pipe = StubPipeline(fail)
+
+    def pipeline(self, transaction=True):
+        return self.pipe
+
+
+class HashCountersTests(SimpleTestCase):
+    def counters(self, client, **kwargs):
+        get_redis = redis_utils.get_redis
+        redis_utils.get_redis = lambda alias: client
+        self.addCleanup(setattr, redis_utils, 'get_redis', get_redis)
+        return redis_utils.HashCounters('test', **kwargs)
+
+    def test_flush_sends_one_batch(self):
+        client = StubPipelineClient()
+        counters = self.counters(client, index='test:index', ttl=60)
+        counters.add('test:a', {'hits': 2, 'misses': 0})
+        counters.incr('test:a', 'hits')
+        counters.set('test:a', 'seen', 100)
+        counters.flush()
+        key = cache.make_key('test:a')
+        self.assertEqual(sorted(client.pipe.calls), sorted([
+            ('hincrby', key, 'hits', 3),
+            ('hmset', key, {'seen': 100}),
+            ('sadd', cache.make_key('test:index'), 'test:a'),
+            ('expire', key, 60),
+            ('expire', cache.make_key('test:index'), 60),
+        ]))
+        client.pipe.calls = []
+        counters.flush()
+        self.assertEqual(client.pipe.calls, [])
+
+    def test_failed_flush_is_not_raised(self):
+        counters = self.counters(StubPipelineClient(fail=True))
+        counters.incr('test:a', 'hits')
+        counters.flush()
+
+
+class StubConnection(object):
+    def __init__(self, usable=True, idle=0):
+        self.connection = object()
+        self.usable = usable
+        self._last_used = time.time() - idle
+
+    def is_usable(self):
+        return self.usable
+
+    def close(self):
+        self.connection = None
+
+
+class StubConnections(object):
+    def __init__(self, *connections):
+        self.connections = connections
+
+    def all(self):
+        return list(self.connections)
+
+
+class ConnectionStatsTests(SimpleTestCase):
+    def setUp(self):
+        stats = dbconnections.ConnectionStats()
+        stats.counters.flush = lambda: None
+        for name, value in (('stats', stats), ('connections', StubConnections())):
+            self.addCleanup(setattr, dbconnections, name, getattr(dbconnections, name))
+            setattr(dbconnections, name, value)
+        self.stats = stats
+
+    def test_forked_worker_starts_from_zero(self):
+        self.stats.incr('opened')
+        self.stats._pid = -1
+        self.stats.incr('reused')
+        self.assertEqual(self.stats.counts, dict(opened=0, reused=1, closed=0, unhealthy=0))
+        self.stats.counters._pid = -1
+        self.stats.counters.incr('test:a', 'hits')
+        self.assertEqual(self.stats.counters._counts, {'test:a': {'hits': 1}})
+
+    @override_settings(DATABASE_HEALTH_CHECK_AFTER=30)
+    def test_only_idle_dead_connections_are_replaced(self):
+        fresh, idle, dead = StubConnection(usable=False), StubConnection(idle=60), StubConnection(False, 60)
+        dbconnections.connections = StubConnections(fresh, idle, dead)
+        dbconnections.check_connections()
+        self.assertIsNotNone(fresh.connection)
+        self.assertIsNotNone(idle.connection)
+        self.assertIsNone(dead.connection)
+        self.assertEqual(self.stats.counts['reused'], 2)
+        self.assertEqual(self.stats.counts['unhealthy'], 1)
+
+
+class CompressedStorageTests(SimpleTestCase):
+    def test_post_process_writes_hashed_and_compressed_files(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        storage = staticfiles.CompressedManifestStaticFilesStorage(location=root)
+        with open(os.path.join(root, 'app.css'), 'w') as f:
+            f.write('body { color: red; }\n' * 50)
+
+        list(storage.post_process({'app.css': (storage, 'app.css')}))
+        hashed = os.path.join(root, storage.stored_name('app.css'))
+        self.assertNotEqual(hashed, os.path.join(root, 'app.css'))
+        self.assertTrue(os.path.exists(hashed))
+        with open(hashed, 'rb') as f:
+            data = f.read()
+        with open(hashed + '.gz', 'rb') as f:
+            self.assertEqual(f.read(), staticfiles.gzip_bytes(data))
+        has_brotli = staticfiles.brotli_bytes(b'') is not None
+        self.assertEqual(os.path.exists(hashed + '.br'), has_brotli)
+
+    def test_small_files_get_no_variants(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, 'tiny.js')
+        with open(path, 'w') as f:
+            f.write('x=1;')
+        staticfiles.write_variants(path)
+        self.assertEqual(os.listdir(root), ['tiny.js'])
+
+
+class StubPublisher(object):
+    def __init__(self):
+        self.published = []
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+
+
+class TwoTierInvalidationTests(SimpleTestCase):
+    def backend(self, publisher):
+        backend = TwoTierRedisCache('localhost:6379', {'KEY_PREFIX': 'test'})
+        backend.get_master_client = lambda: publisher
+        return backend
+
+    def test_write_in_one_process_drops_the_peer_copy(self):
+        publisher = StubPublisher()
+        writer, peer = self.backend(publisher), self.backend(publisher)
+        peer._local_set(peer.make_key('greeting'), 'hello')
+
+        writer._invalidate(writer.make_key('greeting'))
+        self.assertEqual(len(publisher.published), 1)
+        channel, payload = publisher.published[0]
+        self.assertEqual(channel, peer.channel)
+
+        peer._handle(payload.encode('utf-8'))
+        self.assertIs(peer._local_get(peer.make_key('greeting')), MISSING)
+
+    def test_own_invalidations_are_ignored(self):
+        publisher = StubPublisher()
+        backend = self.backend(publisher)
+        backend._invalidate(backend.make_key('greeting'))
+        backend._local_set(backend.make_key('greeting'), 'hello')
+        backend._handle(publisher.published[0][1])
+        self.assertEqual(backend._local_get(backend.make_key('greeting')), 'hello')
+
+
+class StubRedisStore(StubPublisher):
+    """Strings with expiry, a pipeline and publish, for TwoTierRedisCache."""
+
+    def __init__(self):
+        super(StubRedisStore, self).__init__()
+        self.data = {}
+        self.round_trips = 0
+
+    def set(self, key, value):
+        self.data[str(key)] = (value, None)
+        return True
+
+    def setex(self, key, value, timeout):
+        self.data[str(key)] = (value, time.time() + timeout)
+        return True
+
+    def mget(self, keys):
+        self.round_trips += 1
+        return [self.get(key) for key in keys]
+
+    def get(self, key):
+        value, expires = self.data.get(str(key), (None, None))
+        return None if expires is not None and expires <= time.time() else value
+
+    def pttl(self, key):
+        if self.get(key) is None:
+            return -2
+        expires = self.data[str(key)][1]
+        return -1 if expires is None else int((expires - time.time()) * 1000)
+
+    def pipeline(self, transaction=True):
+        return StubStorePipeline(self)
+
+
+class StubStorePipeline(object):
+    def __init__(self, store):
+        self.store = store
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append(lambda: self.store.get(key))
+
+    def pttl(self, key):
+        self.calls.append(lambda: self.store.pttl(key))
+
+    def execute(self):
+        self.store.round_trips += 1
+        return [call() for call in self.calls]
+
+
+class TwoTierTTLTests(SimpleTestCase):
+    def setUp(self):
+        self.store = StubRedisStore()
+        backend = TwoTierRedisCache('localhost:6379', {
+            'KEY_PREFIX': 'test', 'OPTIONS': {'LOCAL_TIMEOUT': 5}})
+        backend.get_master_client = lambda: self.store
+        backend.get_client = lambda key, write=False: self.store
+        backend.master_client = self.store
+        backend._listener_pid = os.getpid()
+        self.backend = backend
+
+    def test_local_copy_expires_with_the_redis_key(self):
+        key = self.backend.make_key('greeting')
+        self.store.setex(key, self.backend.prep_value('hello'), 0.05)
+        self.assertEqual(self.backend.get('greeting'), 'hello')
+        self.assertEqual(self.backend.get('greeting'), 'hello')
+        self.assertEqual(self.store.round_trips, 1)
+        time.sleep(0.06)
+        self.assertIsNone(self.backend.get('greeting'))
+
+    def test_get_many_fills_the_local_tier_in_one_round_trip(self):
+        self.backend.set('a', 1, 60)
+        self.backend.set('b', {'x': 1}, 60)
+        self.assertEqual(self.backend.get_many(['a', 'b', 'c']), {'a': 1, 'b': {'x': 1}})
+        self.assertEqual(self.store.round_trips, 1)
+        self.assertEqual(self.backend.get_many(['a', 'b']), {'a': 1, 'b': {'x': 1}})
+        self.assertEqual(self.store.round_trips, 1)
+
+    def test_local_opt_out_always_reads_redis(self):
+        self.backend.set('a', 1, 60)
+        self.backend.get_many(['a'], local=False)
+        self.backend.get('a', local=False)
+        self.assertIs(self.backend._local_get(self.backend.make_key('a')), MISSING)
+        self.assertEqual(self.store.round_trips, 1)
+
+    def test_write_drops_the_local_copy_and_publishes(self):
+        self.backend.set('a', 1, 60)
+        self.backend.get('a')
+        self.backend.set('a', 2, 60)
+        self.assertEqual(self.backend.get('a'), 2)
+        self.assertEqual(len(self.store.published), 2)
+
+
+class StampedeLockTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_expired_lock_is_not_released_over_the_next_owner(self):
+        def compute():
+            # Our lock lapses mid-compute and another worker takes it.
+            cache.delete('report:lock')
+            cache.add('report:lock', 'other-worker', 30)
+            return 42
+
+        self.assertEqual(stampede.get_or_compute('report:1', compute), 42)
+        self.assertEqual(cache.get('report:lock'), 'other-worker')
+
+    def test_own_lock_is_released(self):
+        self.assertEqual(stampede.get_or_compute('report:2', lambda: 7), 7)
+        self.assertIsNone(cache.get('report:2:lock'))
+
+    def test_held_lock_is_not_acquired(self):
+        token = stampede.acquire_lock('default', 'report:3:lock', 30)
+        self.assertIsNotNone(token)
+        self.assertIsNone(stampede.acquire_lock('default', 'report:3:lock', 30))
+        stampede.release_lock('default', 'report:3:lock', 'stale-token')
+        self.assertEqual(cache.get('report:3:lock'), token)
+
+
+class ProfilerCacheTests(SimpleTestCase):
+    def setUp(self):
+        import redis
+        self.pool = redis.ConnectionPool()
+        profiling.instrument_pool(self.pool)
+        profiling.instrument_pool(self.pool)
+
+    def checkout(self):
+        self.pool.release(self.pool.get_connection('GET'))
+
+    def test_sampled_round_trips_are_counted(self):
+        profiling._local.profile = profile = profiling.Profile()
+        self.addCleanup(setattr, profiling._local, 'profile', None)
+        self.checkout()
+        self.checkout()
+        self.assertEqual(profile.cache_count, 2)
+
+    def test_unsampled_round_trips_cost_nothing(self):
+        self.checkout()
+        self.assertIsNone(getattr(profiling._local, 'checked_out', None))
+
+
+class StubCurrentJob(object):
+    id = 'abc123'
+
+
+class ContextFilterTests(SimpleTestCase):
+    def stub_current_job(self, current_job):
+        import rq
+        self.addCleanup(setattr, rq, 'get_current_job', rq.get_current_job)
+        rq.get_current_job = current_job
+
+    def filtered(self):
+        record = logging.LogRecord('test', logging.INFO, __file__, 1, 'message', None, None)
+        logutils.ContextFilter().filter(record)
+        return record
+
+    def test_job_id_inside_an_rq_job(self):
+        self.stub_current_job(lambda: StubCurrentJob())
+        self.assertEqual(self.filtered().request_id, 'job:abc123')
+
+    def test_no_job_and_broken_lookup_leave_it_unset(self):
+        self.stub_current_job(lambda: None)
+        self.assertIsNone(self.filtered().request_id)
+
+        def broken():
+            raise IOError('redis down')
+        self.stub_current_job(broken)
+        self.assertIsNone(self.filtered().request_id)
+
+
+def reset_pinning(test):
+    """Leave the scope ``manage.py test`` itself runs in for this test."""
+    test.addCleanup(routers._state.__dict__.update, dict(routers._state.__dict__))
+    routers._state.scoped = routers._state.pinned = False
+
+
+class ReplicaRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.router = routers.ReplicaRouter()
+        self.router.replicas = ['replica1']
+        self.router._lag = {'replica1': (time.time(), 0.0)}
+        reset_pinning(self)
+
+    def test_reads_go_to_a_current_replica(self):
+        self.assertEqual(self.router.db_for_read(NotificationOutbox), 'replica1')
+
+    def test_lagging_or_failing_replica_is_skipped(self):
+        self.router._lag['replica1'] = (time.time(), 60.0)
+        self.assertEqual(self.router.db_for_read(NotificationOutbox), 'default')
+
+        def broken(alias):
+            raise IOError('down')
+        self.addCleanup(setattr, routers, 'replication_lag', routers.replication_lag)
+        routers.replication_lag = broken
+        self.router._lag['replica1'] = (0, 0.0)
+        self.assertEqual(self.router.db_for_read(NotificationOutbox), 'default')
+
+    def test_writes_outside_a_scope_do_not_pin(self):
+        self.router.db_for_write(NotificationOutbox)
+        self.assertEqual(self.router.db_for_read(NotificationOutbox), 'replica1')
+
+    def test_writes_pin_until_the_scope_ends(self):
+        with routers.pinning_scope():
+            self.assertEqual(self.router.db_for_read(NotificationOutbox), 'replica1')
+            self.router.db_for_write(NotificationOutbox)
+            self.assertEqual(self.router.db_for_read(NotificationOutbox), 'default')
+        self.assertFalse(routers.is_pinned())
+        self.assertEqual(self.router.db_for_read(NotificationOutbox), 'replica1')
+
+    def test_middleware_pins_unsafe_requests(self):
+        seen = []
+        middleware = routers.PrimaryPinningMiddleware(
+            lambda request: seen.append(self.router.db_for_read(NotificationOutbox)))
+        middleware(RequestFactory().post('/'))
+        middleware(RequestFactory().get('/'))
+        self.assertEqual(seen, ['default', 'replica1'])
+        self.assertFalse(routers.is_pinned())
+
+    def test_use_primary_restores_the_previous_state(self):
+        with routers.use_primary():
+            self.assertEqual(self.router.db_for_read(NotificationOutbox), 'default')
+        self.assertEqual(self.router.db_for_read(NotificationOutbox), 'replica1')
+
+
+class StubLagCursor(object):
+    def __init__(self, executed, row):
+        self.executed = executed
+        self.row = row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql.strip())
+
+    def fetchone(self):
+        return self.row
+
+
+class StubPostgresConnection(object):
+    vendor = 'postgresql'
+
+    def __init__(self, pg_version, row):
+        self.pg_version = pg_version
+        self.row = row
+        self.executed = []
+
+    def cursor(self):
+        return StubLagCursor(self.executed, self.row)
+
+
+class ReplicationLagTests(SimpleTestCase):
+    def check(self, pg_version, row):
+        connection = StubPostgresConnection(pg_version, row)
+        self.addCleanup(setattr, routers, 'connections', routers.connections)
+        routers.connections = {'replica1': connection}
+        return routers.replication_lag('replica1', timeout=0.5), connection.executed
+
+    def test_lag_requires_a_streaming_receiver(self):
+        lag, executed = self.check(100000, (0,))
+        self.assertEqual(lag, 0.0)
+        self.assertIn("status = 'streaming'", executed[1])
+        self.assertIn('pg_last_wal_replay_lsn', executed[1])
+        self.assertIn("status = 'streaming'", self.check(90600, (0,))[1][1])
+
+    def test_check_runs_under_a_statement_timeout(self):
+        executed = self.check(100000, (1.5,))[1]
+        self.assertEqual(executed[0], 'SET statement_timeout = %s')
+        self.assertEqual(executed[-1], 'RESET statement_timeout')
+
+    def test_unknown_lag_takes_the_replica_out(self):
+        self.assertIsNone(self.check(90500, (None,))[0])
+        replica_router = routers.ReplicaRouter()
+        replica_router.replicas = ['replica1']
+        self.assertEqual(replica_router.healthy(), [])
+
+
+class ReplicaAliasTests(TransactionTestCase):
+    """A real second alias onto the test database, as a streaming replica."""
+
+    def setUp(self):
+        reset_pinning(self)
+        connections.databases['replica1'] = dict(connections.databases['default'])
+        self.addCleanup(connections.databases.pop, 'replica1')
+        self.addCleanup(lambda: connections['replica1'].close())
+        self.router = routers.ReplicaRouter()
+        self.router.replicas = ['replica1']
+        self.addCleanup(setattr, db_router, 'routers', db_router.routers)
+        db_router.routers = [self.router]
+
+    def read_from(self):
+        with CaptureQueriesContext(connections['default']) as primary:
+            with CaptureQueriesContext(connections['replica1']) as replica:
+                messages = list(NotificationOutbox.objects.values_list('message', flat=True))
+        return messages, len(primary), len(replica)
+
+    def test_scoped_writes_read_back_from_the_primary(self):
+        with routers.pinning_scope():
+            self.assertEqual(self.read_from(), ([], 0, 1))
+            NotificationOutbox.objects.create(message='hello')
+            self.assertEqual(self.read_from(), (['hello'], 1, 0))
+        self.assertEqual(self.read_from(), (['hello'], 0, 1))
+
+    def test_worker_runs_each_job_in_a_scope(self):
+        from rq import Worker
+        from ... import workers
+
+        def perform_job(worker, job, queue):
+            NotificationOutbox.objects.create(message=job)
+            return self.read_from()
+        self.addCleanup(setattr, Worker, 'perform_job', Worker.perform_job)
+        Worker.perform_job = perform_job
+        worker = workers.PinningWorker.__new__(workers.PinningWorker)
+        self.assertEqual(worker.perform_job('first', None), (['first'], 1, 0))
+        self.assertEqual(self.read_from(), (['first'], 0, 1))
+
+
+@cache_response(timeout=60)
+def cached_view(request):
+    return None
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def process_view(self, **headers):
+        request = RequestFactory().get('/report/', **headers)
+        request.user = AnonymousUser()
+        middleware = ResponseCacheMiddleware(lambda request: None)
+        middleware.process_view(request, cached_view, (), {})
+        return request
+
+    def test_anonymous_request_is_cached(self):
+        self.assertIsNotNone(getattr(self.process_view(), '_response_cache', None))
+
+    def test_token_authenticated_request_is_not_cached(self):
+        request = self.process_view(HTTP_AUTHORIZATION='Token abc')
+        self.assertIsNone(getattr(request, '_response_cache', None))
+
+
+class StubExecutor(object):
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn):
+        self.submitted.append(fn)
+
+
+@cache_response(timeout=60, stale=60, tags=('article:{pk}',), per_user=False)
+def article_view(request, pk):
+    article_view.calls += 1
+    return HttpResponse('version {}'.format(article_view.calls))
+
+
+@override_settings(STAMPEDE_WAIT=0.1)
+class ResponseCacheFlowTests(SimpleTestCase):
+    """Requests through the middleware as Django's handler would send them."""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        article_view.calls = 0
+        self.executor = StubExecutor()
+        get_executor = responses.get_executor
+        responses.get_executor = lambda: self.executor
+        self.addCleanup(setattr, responses, 'get_executor', get_executor)
+
+        def handler(request):
+            return (self.middleware.process_view(request, article_view, (), {'pk': 1})
+                    or article_view(request, pk=1))
+        self.middleware = ResponseCacheMiddleware(handler)
+
+    def get(self, **headers):
+        request = RequestFactory().get('/articles/1/', **headers)
+        request.user = AnonymousUser()
+        return self.middleware(request)
+
+    def expire(self):
+        key = article_view.response_cache.key(RequestFactory().get('/articles/1/'))
+        entry = cache.get(key)
+        entry['expires'] = time.time() - 1
+        cache.set(key, entry)
+
+    def test_hit_and_conditional_request(self):
+        first = self.get()
+        self.assertEqual((first['X-Cache'], first.content), ('MISS', b'version 1'))
+        second = self.get()
+        self.assertEqual((second['X-Cache'], second.content), ('HIT', b'version 1'))
+        not_modified = self.get(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(article_view.calls, 1)
+
+    def test_stale_entry_is_served_while_one_refresh_is_queued(self):
+        self.get()
+        self.expire()
+        for _ in range(3):
+            response = self.get()
+            self.assertEqual((response['X-Cache'], response.content), ('STALE', b'version 1'))
+        self.assertEqual(len(self.executor.submitted), 1)
+        self.assertEqual(article_view.calls, 1)
+
+        self.executor.submitted[0]()
+        response = self.get()
+        self.assertEqual((response['X-Cache'], response.content), ('HIT', b'version 2'))
+
+    def test_invalidate_forces_a_miss(self):
+        self.get()
+        responses.invalidate('article:1')
+        response = self.get()
+        self.assertEqual((response['X-Cache'], response.content), ('MISS', b'version 2'))
+
+    def test_concurrent_miss_waits_for_the_lock_holder(self):
+        holder = RequestFactory().get('/articles/1/')
+        holder.user = AnonymousUser()
+        self.assertIsNone(self.middleware.process_view(holder, article_view, (), {'pk': 1}))
+        self.assertIsNotNone(holder._response_cache.lock_token)
+        # Lock held and nothing stored: a second request waits, then runs
+        # the view uncached rather than failing.
+        response = self.get()
+        self.assertEqual((response['X-Cache'], article_view.calls), ('MISS', 1))
+
+
+@override_settings(SESSION_ENGINE=sessions.__name__)
+class SessionStoreTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def saved(self, **data):
+        session = sessions.SessionStore()
+        session.update(data)
+        session.save()
+        return session.session_key
+
+    def test_pack_round_trips_small_and_compressed_values(self):
+        for payload in (b'{}', b'x' * 4096):
+            packed = sessions.pack(payload, 1234)
+            self.assertEqual(sessions.unpack(packed), (1234, payload))
+        self.assertEqual(sessions.pack(b'x' * 4096, 0)[:1], b'z')
+        self.assertEqual(sessions.SessionStore(self.saved(cart=[1, 2])).load(), {'cart': [1, 2]})
+
+    def test_unchanged_session_is_not_written(self):
+        session = sessions.SessionStore(self.saved(cart=[1]))
+        session['cart']
+        cache.delete(session.cache_key)
+        session.save()
+        self.assertIsNone(cache.get(session.cache_key))
+        session['cart'] = [1, 2]
+        session.save()
+        self.assertEqual(sessions.SessionStore(session.session_key).load(), {'cart': [1, 2]})
+
+    def test_unreadable_value_starts_a_new_session(self):
+        cache.set(sessions.SessionStore.cache_key_prefix + 'broken', b'znot zlib')
+        session = sessions.SessionStore('broken')
+        self.assertEqual(session.load(), {})
+        self.assertIsNone(session.session_key)
+
+    def test_middleware_refreshes_read_sessions_once_due(self):
+        key = self.saved(cart=[1])
+        middleware = sessions.SessionMiddleware(lambda request: HttpResponse())
+        request = RequestFactory().get('/')
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = key
+        middleware.process_request(request)
+        request.session['cart']
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, middleware.process_response(request, HttpResponse()).cookies)
+
+        request.session._refreshed -= sessions.refresh_interval()
+        self.assertTrue(request.session.refresh_due())
+        response = middleware.process_response(request, HttpResponse())
+        self.assertEqual(response.cookies[settings.SESSION_COOKIE_NAME].value, key)
+        refreshed = sessions.SessionStore(key)
+        refreshed.load()
+        self.assertFalse(refreshed.refresh_due())
+
+    @override_settings(SESSION_ANONYMOUS_COOKIES=True)
+    def test_anonymous_sessions_live_in_a_signed_cookie_until_login(self):
+        middleware = sessions.SessionMiddleware(lambda request: HttpResponse())
+        request = RequestFactory().get('/')
+        middleware.process_request(request)
+        request.session['cart'] = [1]
+        cookie = middleware.process_response(request, HttpResponse()).cookies[settings.SESSION_COOKIE_NAME].value
+        self.assertTrue(cookie.startswith(sessions.COOKIE_PREFIX))
+        self.assertEqual(sessions.AnonymousSessionStore(cookie).load(), {'cart': [1]})
+        self.assertEqual(sessions.AnonymousSessionStore(cookie[:-1] + 'x').load(), {})
+
+        request = RequestFactory().get('/')
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = cookie
+        middleware.process_request(request)
+        self.assertIsInstance(request.session, sessions.AnonymousSessionStore)
+        request.session[SESSION_KEY] = '1'
+        key = middleware.process_response(request, HttpResponse()).cookies[settings.SESSION_COOKIE_NAME].value
+        self.assertFalse(key.startswith(sessions.COOKIE_PREFIX))
+        self.assertEqual(sessions.SessionStore(key).load(), {'cart': [1], SESSION_KEY: '1'})
+
+
+@override_settings(SESSION_ENGINE=sessions.__name__)
+class MigrateSessionsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def database_session(self, **data):
+        session = DatabaseSessionStore()
+        session.update(data)
+        session.create()
+        return session.session_key
+
+    def migrate(self, **options):
+        stdout = six.StringIO()
+        migrate_sessions.Command(stdout=stdout).handle(**dict(dict(batch_size=2, delete=False), **options))
+        return stdout.getvalue().splitlines()
+
+    def test_copies_every_batch_keeping_keys(self):
+        keys = [self.database_session(n=n) for n in range(5)]
+        self.database_session()
+        live = sessions.SessionStore(keys[0])
+        live.restore({'n': 'live'}, 60)
+
+        self.assertEqual(self.migrate(delete=True)[-1], 'Done: 4 copied, 2 skipped')
+        self.assertEqual([sessions.SessionStore(key).load() for key in keys],
+                         [{'n': 'live'}] + [{'n': n} for n in range(1, 5)])
+        self.assertFalse(Session.objects.exists())
+
+    def test_expired_sessions_are_left_behind(self):
+        key = self.database_session(n=1)
+        Session.objects.filter(session_key=key).update(expire_date=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.migrate(), ['Done: 0 copied, 0 skipped'])
+        self.assertEqual(sessions.SessionStore(key).load(), {})
+
+
+def cached_templates(*dirs):
+    """The project's TEMPLATES behind the cached loader, plus ``dirs``."""
+    options = dict(settings.TEMPLATES[0]['OPTIONS'], loaders=[('django.template.loaders.cached.Loader', [
+        'django.template.loaders.filesystem.Loader', 'django.template.loaders.app_directories.Loader'])])
+    project_dir = os.path.join(os.path.dirname(templating.__file__), 'templates')
+    return [dict(settings.TEMPLATES[0], DIRS=[project_dir] + list(dirs), APP_DIRS=False, OPTIONS=options)]
+
+
+class CompileTemplatesTests(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def command(self, **options):
+        command = compile_templates.Command(stdout=six.StringIO(), stderr=six.StringIO())
+        command.handle(**dict(dict(limit=0), **options))
+        return command
+
+    def test_project_templates_compile_into_the_cached_loader(self):
+        with override_settings(TEMPLATES=cached_templates()):
+            engine, = templating.django_engines()
+            names = templating.template_names(engine)
+            self.assertIn('admin/base.html', names)
+            output = self.command().stdout.getvalue()
+            self.assertIn('{} templates compiled'.format(len(names)), output)
+            loader, = engine.template_loaders
+            for name in names:
+                self.assertIsInstance(loader.get_template_cache.get(name), Template, name)
+
+    def test_broken_template_fails_the_command(self):
+        with open(os.path.join(self.dir, 'broken.html'), 'w') as f:
+            # Split so startproject leaves the tag alone.
+            f.write('{' + '% if %' + '}')
+        with override_settings(TEMPLATES=cached_templates(self.dir)):
+            with self.assertRaises(CommandError):
+                self.command()
+            logger = logging.getLogger(templating.__name__)
+            self.addCleanup(setattr, logger, 'disabled', logger.disabled)
+            logger.disabled = True
+            results = dict((name, error) for name, _, error in templating.warm())
+        self.assertIsNotNone(results['broken.html'])
+        self.assertIsNone(results['admin/base.html'])
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+from ...instrumentation import prometheus
+
+
+def metrics(request):
+    """Outbound-call histograms for a Prometheus scraper.
+
+    Open to ``METRICS_TOKEN`` as a bearer token and to staff users; with no
+    token configured, only staff.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    auth = request.META.get('HTTP_AUTHORIZATION', '')
+    scraper = bool(token) and constant_time_compare(auth, 'Bearer {}'.format(token))
+    user = getattr(request, 'user', None)
+    if not (scraper or (user is not None and user.is_staff)):
+        return HttpResponseForbidden()
+    return HttpResponse(prometheus(), content_type='text/plain; version=0.0.4')
@@ -0,0 +1,44 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from redis_cache import RedisCache
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class Command(BaseCommand):
+    help = ('Compare get/get_many latency of the default cache against a plain '
+            'redis_cache.RedisCache on the same server.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keys', type=int, default=50)
+        parser.add_argument('--iterations', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        conf = dict(settings.CACHES['default'])
+        plain = RedisCache(conf['LOCATION'], conf)
+        candidates = [('plain redis', plain), ('default', caches['default'])]
+
+        keys = ['bench:{}'.format(i) for i in range(options['keys'])]
+        caches['default'].set_many(dict((key, {'value': key}) for key in keys), 300)
+
+        self.stdout.write('{:<12} {:<9} {:>10} {:>10}'.format('backend', 'call', 'p50 us', 'p99 us'))
+        for name, backend in candidates:
+            for call in ('get', 'get_many'):
+                samples = []
+                for i in range(options['iterations']):
+                    started = time.time()
+                    if call == 'get':
+                        backend.get(keys[i % len(keys)])
+                    else:
+                        backend.get_many(keys)
+                    samples.append(time.time() - started)
+                self.stdout.write('{:<12} {:<9} {:>10.1f} {:>10.1f}'.format(
+                    name, call, percentile(samples, 0.5) * 1e6, percentile(samples, 0.99) * 1e6))
+
+        caches['default'].delete_many(keys)
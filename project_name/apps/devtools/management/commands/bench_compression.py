@@ -0,0 +1,53 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from .....imaging.compression import (
+    PIL_FORMATS, PillowBackend, TinifyBackend, get_compression_backend)
+
+
+BACKENDS = {
+    'pillow': PillowBackend,
+    'tinify': TinifyBackend,
+}
+
+
+class Command(BaseCommand):
+    help = 'Compare compression backends on a directory of fixture images.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('corpus', help='Directory of .jpg/.png images.')
+        parser.add_argument(
+            '--backend', action='append', dest='backends',
+            help='pillow, tinify or a dotted backend path; repeatable. '
+                 'Defaults to pillow and tinify.')
+
+    def handle(self, *args, **options):
+        corpus = options['corpus']
+        if not os.path.isdir(corpus):
+            raise CommandError('{} is not a directory'.format(corpus))
+
+        fixtures = []
+        for name in sorted(os.listdir(corpus)):
+            ext = name.split('.')[-1].lower()
+            if ext in PIL_FORMATS:
+                with open(os.path.join(corpus, name), 'rb') as f:
+                    fixtures.append((name, ext, f.read()))
+        if not fixtures:
+            raise CommandError('No images found in {}'.format(corpus))
+
+        self.stdout.write('{:<10} {:>8} {:>14} {:>14} {:>8} {:>10}'.format(
+            'backend', 'images', 'bytes in', 'bytes out', 'saved', 'ms/image'))
+
+        for name in options['backends'] or ['pillow', 'tinify']:
+            backend = BACKENDS[name]() if name in BACKENDS else get_compression_backend(name)
+            bytes_in = bytes_out = 0
+            started = time.time()
+            for _, ext, data in fixtures:
+                bytes_in += len(data)
+                bytes_out += len(backend.compress_bytes(data, ext))
+            elapsed = time.time() - started
+            self.stdout.write('{:<10} {:>8} {:>14} {:>14} {:>7.1%} {:>10.1f}'.format(
+                name, len(fixtures), bytes_in, bytes_out,
+                1 - float(bytes_out) / bytes_in, elapsed * 1000 / len(fixtures)))
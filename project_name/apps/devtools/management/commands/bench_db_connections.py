@@ -0,0 +1,61 @@
+import time
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.core.signals import request_started, request_finished
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test import RequestFactory
+
+from ..... import dbconnections
+
+
+class Command(BaseCommand):
+    help = ('Measure requests/sec with connections closed after every request '
+            'against the persistent, health-checked production profile.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--path',
+                            help='Serve this path through the WSGI handler instead of '
+                                 'a bare request cycle running one query.')
+
+    def handle(self, *args, **options):
+        connection = connections[DEFAULT_DB_ALIAS]
+        conn_max_age = connection.settings_dict.get('CONN_MAX_AGE') or 600
+        if options['path']:
+            handler = WSGIHandler()
+            environ = RequestFactory().get(
+                options['path'], HTTP_HOST=(settings.ALLOWED_HOSTS or ['localhost'])[0]).environ
+
+            def cycle():
+                response = handler(environ, lambda status, headers: None)
+                for _ in response:
+                    pass
+                response.close()
+        else:
+            def cycle():
+                request_started.send(sender=self.__class__)
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                request_finished.send(sender=self.__class__)
+
+        self.stdout.write('{:<24} {:>10} {:>8} {:>8}'.format('profile', 'req/s', 'opened', 'reused'))
+        for name, max_age, checked in (('close per request', 0, False),
+                                       ('persistent', conn_max_age, True)):
+            connection.close()
+            connection.settings_dict['CONN_MAX_AGE'] = max_age
+            if not checked:
+                request_started.disconnect(dispatch_uid='dbconnections.check')
+            before = dict(dbconnections.stats.counts)
+            started = time.time()
+            for _ in range(options['requests']):
+                cycle()
+            elapsed = time.time() - started
+            if not checked:
+                request_started.connect(dbconnections.check_connections,
+                                        dispatch_uid='dbconnections.check')
+            counts = dbconnections.stats.counts
+            self.stdout.write('{:<24} {:>10.1f} {:>8} {:>8}'.format(
+                name, options['requests'] / elapsed,
+                counts['opened'] - before['opened'], counts['reused'] - before['reused']))
@@ -0,0 +1,40 @@
+import time
+
+from django.core.mail import EmailMessage
+from django.core.mail.backends.smtp import EmailBackend
+from django.core.management.base import BaseCommand
+
+from .....mail import PooledEmailBackend, send_bulk
+
+
+class Command(BaseCommand):
+    help = ('Compare messages/sec for a connection per message against the '
+            'pooled backend. Point it at a local sink, e.g. '
+            '`python -m smtpd -n -c DebuggingServer localhost:1025`.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='localhost')
+        parser.add_argument('--port', type=int, default=1025)
+        parser.add_argument('--count', type=int, default=200)
+
+    def handle(self, *args, **options):
+        host, port, count = options['host'], options['port'], options['count']
+        recipients = ['bench{}@example.com'.format(i) for i in range(count)]
+        smtp = dict(host=host, port=port, username='', password='',
+                    use_tls=False, use_ssl=False)
+
+        single = EmailBackend(**smtp)
+        started = time.time()
+        for recipient in recipients:
+            # Not opened beforehand, so each call connects and quits.
+            single.send_messages([EmailMessage('bench', 'body', None, [recipient])])
+        single_rate = count / (time.time() - started)
+
+        pooled = PooledEmailBackend(**smtp)
+        started = time.time()
+        send_bulk('bench', 'body', recipients, connection=pooled)
+        pooled_rate = count / (time.time() - started)
+
+        self.stdout.write('single connection per message: {:8.1f} msg/s'.format(single_rate))
+        self.stdout.write('pooled bulk send:              {:8.1f} msg/s'.format(pooled_rate))
+        self.stdout.write('speedup:                       {:8.2f}x'.format(pooled_rate / single_rate))
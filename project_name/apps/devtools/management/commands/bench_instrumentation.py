@@ -0,0 +1,51 @@
+import time
+import threading
+
+from django.core.management.base import BaseCommand
+
+from .....instrumentation import Recorder, timed
+
+
+class Command(BaseCommand):
+    help = 'Measure the per-call overhead of outbound-call recording.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=200000)
+        parser.add_argument('--threads', type=int, default=4)
+
+    def handle(self, *args, **options):
+        calls, threads = options['calls'], options['threads']
+        # Never flushes, so only the in-process path is measured.
+        recorder = Recorder(flush_interval=float('inf'))
+
+        started = time.time()
+        for _ in range(calls):
+            pass
+        baseline = time.time() - started
+
+        started = time.time()
+        for i in range(calls):
+            recorder.record('bench', 'call', (i % 5000) / 1000000.0)
+        record = (time.time() - started - baseline) / calls
+
+        started = time.time()
+        for _ in range(calls):
+            with timed('bench', 'timed'):
+                pass
+        context = (time.time() - started - baseline) / calls
+
+        def worker():
+            for i in range(calls // threads):
+                recorder.record('bench', 'threaded', (i % 5000) / 1000000.0)
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        started = time.time()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        threaded = (time.time() - started) / calls
+
+        self.stdout.write('record():             {:6.2f} us/call'.format(record * 1e6))
+        self.stdout.write('timed() block:        {:6.2f} us/call'.format(context * 1e6))
+        self.stdout.write('record(), {} threads: {:6.2f} us/call'.format(threads, threaded * 1e6))
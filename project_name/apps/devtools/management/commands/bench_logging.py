@@ -0,0 +1,68 @@
+import os
+import time
+import logging
+import threading
+
+from django.core.management.base import BaseCommand
+
+from .....logutils import AsyncStreamHandler, ContextFilter, JSONFormatter
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class Command(BaseCommand):
+    help = ('Measure the per-call cost of logger.info under concurrency, '
+            'writing JSON synchronously against through AsyncStreamHandler.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--records', type=int, default=5000,
+                            help='Records logged by each thread.')
+        parser.add_argument('--output', default=os.devnull,
+                            help='Where records are written; a file or pipe shows I/O cost.')
+
+    def handle(self, *args, **options):
+        self.stdout.write('{:<10} {:>10} {:>10} {:>10} {:>12}'.format(
+            'handler', 'p50 us', 'p99 us', 'max us', 'records/s'))
+        with open(options['output'], 'w') as stream:
+            for name, handler in (('sync', logging.StreamHandler(stream)),
+                                  ('async', AsyncStreamHandler(stream))):
+                handler.setFormatter(JSONFormatter())
+                handler.addFilter(ContextFilter())
+                logger = logging.getLogger('bench.logging.{}'.format(name))
+                logger.propagate = False
+                logger.setLevel(logging.INFO)
+                logger.addHandler(handler)
+                samples = self.run(logger, options['threads'], options['records'])
+                started = time.time()
+                handler.flush()
+                drained = time.time() - started
+                logger.removeHandler(handler)
+                handler.close()
+                total = sum(samples) + drained
+                self.stdout.write('{:<10} {:>10.1f} {:>10.1f} {:>10.1f} {:>12.0f}'.format(
+                    name, percentile(samples, 0.5) * 1e6, percentile(samples, 0.99) * 1e6,
+                    max(samples) * 1e6, len(samples) / (total / options['threads'])))
+
+    def run(self, logger, threads, records):
+        samples = []
+        lock = threading.Lock()
+
+        def work(n):
+            local = []
+            for i in range(records):
+                started = time.time()
+                logger.info('bench record %d from %d', i, n, extra={'user_id': i})
+                local.append(time.time() - started)
+            with lock:
+                samples.extend(local)
+
+        workers = [threading.Thread(target=work, args=(n,)) for n in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return samples
@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import time
+import subprocess
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+PACKAGE = __name__.split('.')[0]
+ROOT = os.path.dirname(settings.BASE_DIR())
+
+IMPORT_SCRIPT = """
+import django
+django.setup()
+import {package}.utils
+"""
+
+# Prints seconds from importing wsgi to the end of the first response.
+FIRST_REQUEST_SCRIPT = """
+import time
+started = time.time()
+import json, sys
+import wsgi
+from django.test import RequestFactory
+environ = RequestFactory().get(sys.argv[1], HTTP_HOST=sys.argv[2]).environ
+body = wsgi.application(environ, lambda status, headers, exc_info=None: None)
+for chunk in body:
+    pass
+if hasattr(body, 'close'):
+    body.close()
+print(json.dumps({'first_request': time.time() - started}))
+"""
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def parse_importtime(stderr):
+    """Cumulative microseconds per top-level package from ``-X importtime``."""
+    totals = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        cumulative = cumulative.strip()
+        # Nested imports are indented two spaces per level under their parent.
+        if not cumulative.isdigit() or name.startswith('   '):
+            continue
+        package = name.strip().split('.')[0]
+        totals[package] = totals.get(package, 0) + int(cumulative)
+    return totals
+
+
+class Command(BaseCommand):
+    help = ('Measure cold-start costs: import time by package, manage.py '
+            'startup and time to first request, against a stored baseline.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Runs per measurement; the median is reported.')
+        parser.add_argument('--baseline', default=os.path.join(ROOT, 'startup_baseline.json'))
+        parser.add_argument('--save', action='store_true',
+                            help='Write these results as the new baseline.')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed slowdown over the baseline, as a fraction.')
+        parser.add_argument('--path', default='/')
+        parser.add_argument('--host', default=(settings.ALLOWED_HOSTS or ['localhost'])[0])
+        parser.add_argument('--top', type=int, default=15,
+                            help='Packages listed in the import breakdown.')
+
+    def run(self, args):
+        env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+        started = time.time()
+        process = subprocess.Popen(
+            [sys.executable] + args, cwd=ROOT, env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        stdout, stderr = process.communicate()
+        elapsed = time.time() - started
+        if process.returncode:
+            raise CommandError('{} failed:\n{}'.format(' '.join(args), stderr[-2000:]))
+        return elapsed, stdout, stderr
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        results = {}
+
+        results['import_utils'] = median(
+            [self.run(['-c', IMPORT_SCRIPT.format(package=PACKAGE)])[0] for _ in range(repeat)])
+        results['manage_help'] = median(
+            [self.run(['manage.py', 'help'])[0] for _ in range(repeat)])
+        results['first_request'] = median([
+            json.loads(self.run(['-c', FIRST_REQUEST_SCRIPT, options['path'],
+                                 options['host']])[1].strip().splitlines()[-1])['first_request']
+            for _ in range(repeat)])
+
+        self.stdout.write('{:<16} {:>10} {:>10} {:>8}'.format('measurement', 'seconds',
+                                                             'baseline', 'change'))
+        baseline = {}
+        if os.path.exists(options['baseline']) and not options['save']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+        regressions = []
+        for name, value in sorted(results.items()):
+            base = baseline.get(name)
+            change = '' if not base else '{:+.0%}'.format(value / base - 1)
+            self.stdout.write('{:<16} {:>10.3f} {:>10} {:>8}'.format(
+                name, value, '{:.3f}'.format(base) if base else '-', change))
+            if base and value > base * (1 + options['tolerance']):
+                regressions.append(name)
+
+        if sys.version_info >= (3, 7):
+            stderr = self.run(['-X', 'importtime', '-c', IMPORT_SCRIPT.format(package=PACKAGE)])[2]
+            totals = parse_importtime(stderr)
+            self.stdout.write('\n{:<28} {:>10}'.format('package', 'import ms'))
+            for package, us in sorted(totals.items(), key=lambda item: -item[1])[:options['top']]:
+                self.stdout.write('{:<28} {:>10.1f}'.format(package, us / 1000.0))
+        else:
+            self.stdout.write('\n-X importtime needs Python 3.7+; breakdown skipped.')
+
+        if options['save']:
+            with open(options['baseline'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write('\nBaseline written to {}'.format(options['baseline']))
+        elif regressions:
+            raise CommandError('Slower than baseline by more than {:.0%}: {}'.format(
+                options['tolerance'], ', '.join(regressions)))
@@ -0,0 +1,49 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+
+from .....staticfiles import StaticFilesApp
+
+
+def not_found(environ, start_response):
+    start_response('404 Not Found', [('Content-Type', 'text/plain')])
+    return [b'']
+
+
+class Command(BaseCommand):
+    help = ('Compare static requests/sec and bytes on the wire between '
+            'dj_static.Cling and StaticFilesApp over everything in STATIC_ROOT.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rounds', type=int, default=20)
+        parser.add_argument('--accept-encoding', default='gzip, deflate, br')
+
+    def handle(self, *args, **options):
+        from dj_static import Cling
+
+        static = StaticFilesApp(not_found)
+        paths = sorted(static.files)
+        if not paths:
+            raise CommandError('Nothing in STATIC_ROOT ({}); run collectstatic first.'.format(
+                settings.STATIC_ROOT))
+        factory = RequestFactory()
+        environs = [factory.get(path, HTTP_ACCEPT_ENCODING=options['accept_encoding']).environ
+                    for path in paths]
+
+        self.stdout.write('{} files, {} rounds'.format(len(paths), options['rounds']))
+        self.stdout.write('{:<16} {:>10} {:>14}'.format('server', 'req/s', 'bytes/round'))
+        for name, app in (('Cling', Cling(not_found)), ('StaticFilesApp', static)):
+            sent = 0
+            started = time.time()
+            for _ in range(options['rounds']):
+                for environ in environs:
+                    body = app(dict(environ), lambda status, headers, exc_info=None: None)
+                    for chunk in body:
+                        sent += len(chunk)
+                    if hasattr(body, 'close'):
+                        body.close()
+            elapsed = time.time() - started
+            self.stdout.write('{:<16} {:>10.1f} {:>14}'.format(
+                name, options['rounds'] * len(environs) / elapsed, sent // options['rounds']))
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from .....imaging.thumbnails import generate, get_specs
+
+
+class Command(BaseCommand):
+    help = 'Time one multi-size pass against one decode per size.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('image', help='Path to a source image.')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        with open(options['image'], 'rb') as f:
+            data = f.read()
+        ext = options['image'].split('.')[-1]
+        specs = get_specs()
+        repeat = options['repeat']
+
+        started = time.time()
+        for _ in range(repeat):
+            generate(data, specs, ext)
+        single = (time.time() - started) / repeat
+
+        started = time.time()
+        for _ in range(repeat):
+            for name, spec in specs.items():
+                generate(data, {name: spec}, ext)
+        separate = (time.time() - started) / repeat
+
+        self.stdout.write('{} sizes'.format(len(specs)))
+        self.stdout.write('single decode:    {:8.1f} ms'.format(single * 1000))
+        self.stdout.write('decode per size:  {:8.1f} ms'.format(separate * 1000))
+        self.stdout.write('speedup:          {:8.2f}x'.format(separate / single))
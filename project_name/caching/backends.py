@@ -0,0 +1,232 @@
+import os
+import time
+import uuid
+import logging
+import threading
+
+from django.utils import six
+from django.utils.encoding import force_text
+from django.utils.six.moves import cPickle as pickle
+from redis_cache import RedisCache
+
+from ..lru import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Returned as-is from the local tier; anything else is stored pickled so a
+# caller mutating a cached dict can't change what the next caller sees.
+IMMUTABLE = (type(None), bool, float, bytes, six.text_type) + six.integer_types
+
+MISSING = object()
+
+
+class TwoTierRedisCache(RedisCache):
+    """``redis_cache.RedisCache`` with a size-bounded in-process LRU in front.
+
+    Every write evicts the key locally and publishes it on a Redis pub/sub
+    channel; a daemon thread in each process evicts whatever its peers
+    publish. Reads fetch each key's remaining TTL in the same round trip, so
+    a local copy never outlives the Redis key, and ``LOCAL_TIMEOUT`` caps
+    how long it can live, which bounds staleness if an invalidation is ever
+    missed. ``get(..., local=False)`` and ``get_many(..., local=False)``
+    always read from Redis.
+
+    OPTIONS:
+        ``LOCAL_MAX_ENTRIES``: size of the local tier (default 1000).
+        ``LOCAL_TIMEOUT``: seconds a value may be served locally (default 5).
+        ``LOCAL_EXCLUDE``: key prefixes that always go to Redis.
+    """
+
+    def __init__(self, server, params):
+        super(TwoTierRedisCache, self).__init__(server, params)
+        options = params.get('OPTIONS', {})
+        self.local_timeout = options.get('LOCAL_TIMEOUT', 5)
+        self.local_exclude = tuple(options.get('LOCAL_EXCLUDE', ()))
+        self.local_max_entries = options.get('LOCAL_MAX_ENTRIES', 1000)
+        self.channel = '{}:invalidate'.format(self.key_prefix or 'cache')
+        self._local = LRUCache(self.local_max_entries)
+        self._origin = uuid.uuid4().hex
+        self._listener_pid = None
+        self._lock = threading.Lock()
+
+    # ######### LOCAL TIER
+
+    def _is_local(self, key):
+        return not key.startswith(self.local_exclude) if self.local_exclude else True
+
+    def _local_get(self, key):
+        value = self._local.get(key, MISSING)
+        if value is MISSING or isinstance(value, IMMUTABLE):
+            return value
+        return pickle.loads(value.pickled)
+
+    def _local_set(self, key, value, timeout=None):
+        ttl = self.local_timeout if timeout is None else min(timeout, self.local_timeout)
+        if ttl <= 0:
+            return
+        if not isinstance(value, IMMUTABLE):
+            value = Pickled(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self._local.set(key, value, time.time() + ttl)
+
+    def _invalidate(self, *keys):
+        if keys == ('*',):
+            self._local.clear()
+        for key in keys:
+            self._local.delete(key)
+        # make_key returns CacheKey objects; only their text goes on the wire.
+        try:
+            self.get_master_client().publish(self.channel, '{} {}'.format(
+                self._origin, '\n'.join(force_text(key) for key in keys)))
+        except Exception:
+            logger.exception('Could not publish cache invalidation')
+
+    def _ensure_listener(self):
+        if self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            # A fork inherits the parent's entries but not its thread.
+            self._local.clear()
+            self._origin = uuid.uuid4().hex
+            thread = threading.Thread(target=self._listen, name='cache-invalidation')
+            thread.daemon = True
+            thread.start()
+            self._listener_pid = os.getpid()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.get_master_client().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # Anything published while we were disconnected is lost.
+                self._local.clear()
+                for message in pubsub.listen():
+                    self._handle(message['data'])
+            except Exception:
+                logger.exception('Cache invalidation listener failed; reconnecting')
+                self._local.clear()
+                time.sleep(1)
+
+    def _handle(self, data):
+        """Apply one invalidation published by a peer."""
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        origin, _, keys = data.partition(' ')
+        if origin == self._origin:
+            return
+        if keys == '*':
+            self._local.clear()
+        else:
+            for key in keys.split('\n'):
+                self._local.delete(key)
+
+    # ######### CACHE API
+
+    def _get_with_ttl(self, client, keys, version=None):
+        """``{key: (value, seconds left or None)}`` for ``keys`` in Redis.
+
+        GET and PTTL for every key go in one pipelined round trip.
+        """
+        cache_keys = self.make_keys(keys, version=version)
+        pipe = client.pipeline(transaction=False)
+        for cache_key in cache_keys:
+            pipe.get(cache_key)
+            pipe.pttl(cache_key)
+        results = pipe.execute()
+        found = {}
+        for key, value, pttl in zip(keys, results[::2], results[1::2]):
+            if value is not None:
+                # PTTL is -1 for a key without an expiry.
+                found[key] = (self.get_value(value), pttl / 1000.0 if pttl >= 0 else None)
+        return found
+
+    def get(self, key, default=None, version=None, local=True, **kwargs):
+        self._ensure_listener()
+        if not (local and self._is_local(key)):
+            return super(TwoTierRedisCache, self).get(key, default, version=version, **kwargs)
+        cache_key = self.make_key(key, version=version)
+        value = self._local_get(cache_key)
+        if value is not MISSING:
+            return value
+        fetched = self._get_with_ttl(self.get_client(key), [key], version=version)
+        if key not in fetched:
+            return default
+        value, ttl = fetched[key]
+        self._local_set(cache_key, value, ttl)
+        return value
+
+    def get_many(self, keys, version=None, local=True, **kwargs):
+        """Serve what the local tier has; fetch the rest in one round trip."""
+        self._ensure_listener()
+        if not local:
+            return super(TwoTierRedisCache, self).get_many(keys, version=version, **kwargs)
+        found = {}
+        remote = []
+        for key in keys:
+            cache_key = self.make_key(key, version=version)
+            value = self._local_get(cache_key) if self._is_local(key) else MISSING
+            if value is MISSING:
+                remote.append(key)
+            else:
+                found[key] = value
+        if remote:
+            fetched = self._get_with_ttl(self.master_client, remote, version=version)
+            for key, (value, ttl) in fetched.items():
+                if self._is_local(key):
+                    self._local_set(self.make_key(key, version=version), value, ttl)
+                found[key] = value
+        return found
+
+    def set(self, key, value, *args, **kwargs):
+        result = super(TwoTierRedisCache, self).set(key, value, *args, **kwargs)
+        self._invalidate(self.make_key(key, version=kwargs.get('version')))
+        return result
+
+    def add(self, key, value, *args, **kwargs):
+        result = super(TwoTierRedisCache, self).add(key, value, *args, **kwargs)
+        if result:
+            self._invalidate(self.make_key(key, version=kwargs.get('version')))
+        return result
+
+    def set_many(self, data, *args, **kwargs):
+        result = super(TwoTierRedisCache, self).set_many(data, *args, **kwargs)
+        version = kwargs.get('version')
+        if data:
+            self._invalidate(*[self.make_key(key, version=version) for key in data])
+        return result
+
+    def delete(self, key, *args, **kwargs):
+        result = super(TwoTierRedisCache, self).delete(key, *args, **kwargs)
+        self._invalidate(self.make_key(key, version=kwargs.get('version')))
+        return result
+
+    def delete_many(self, keys, *args, **kwargs):
+        keys = list(keys)
+        result = super(TwoTierRedisCache, self).delete_many(keys, *args, **kwargs)
+        version = kwargs.get('version')
+        if keys:
+            self._invalidate(*[self.make_key(key, version=version) for key in keys])
+        return result
+
+    def incr(self, key, *args, **kwargs):
+        result = super(TwoTierRedisCache, self).incr(key, *args, **kwargs)
+        self._invalidate(self.make_key(key, version=kwargs.get('version')))
+        return result
+
+    def decr(self, key, *args, **kwargs):
+        result = super(TwoTierRedisCache, self).decr(key, *args, **kwargs)
+        self._invalidate(self.make_key(key, version=kwargs.get('version')))
+        return result
+
+    def clear(self, *args, **kwargs):
+        result = super(TwoTierRedisCache, self).clear(*args, **kwargs)
+        self._invalidate('*')
+        return result
+
+
+class Pickled(object):
+    __slots__ = ('pickled',)
+
+    def __init__(self, pickled):
+        self.pickled = pickled
@@ -0,0 +1,267 @@
+import io
+import os
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import connections
+from django.http import HttpResponse, HttpResponseNotModified
+
+from .stampede import acquire_lock, counters, release_lock
+
+logger = logging.getLogger(__name__)
+
+# Set in the environ of a background refresh to the entry's key and the
+# lock token it holds. Not a header, so clients can't send it.
+REFRESH_TOKEN = 'response_cache.refresh'
+
+
+class ResponsePolicy(object):
+
+    def __init__(self, name, timeout, stale, vary, tags, per_user, cache_alias):
+        self.name = name
+        self.timeout = timeout
+        self.stale = stale
+        self.vary = tuple(vary)
+        self.tags = tuple(tags)
+        self.per_user = per_user
+        self.cache_alias = cache_alias
+
+    def key(self, request):
+        parts = [request.get_host(), request.get_full_path()]
+        parts.extend(request.META.get('HTTP_' + header.upper().replace('-', '_'), '')
+                     for header in self.vary)
+        if self.per_user:
+            user = getattr(request, 'user', None)
+            parts.append(str(user.pk) if user is not None and user.is_authenticated else 'anon')
+        digest = hashlib.md5('\n'.join(parts).encode('utf-8')).hexdigest()
+        return 'resp:{}:{}'.format(self.name, digest)
+
+
+def cache_response(timeout=60, stale=None, vary=(), tags=(), per_user=True, name=None,
+                   cache_alias='default'):
+    """Let ``ResponseCacheMiddleware`` cache this view's GET responses.
+
+    :param int stale: seconds past ``timeout`` a response may still be
+        served while the view re-runs in the background; defaults to
+        ``STAMPEDE_STALE_TIMEOUT``.
+    :param vary: request headers the response depends on, e.g.
+        ``('Accept-Language',)``.
+    :param tags: names for ``invalidate``, formatted with the view's URL
+        kwargs, e.g. ``('article:{pk}',)``.
+    :param bool per_user: key on the logged-in user, or "anonymous", so
+        nobody is served another user's page. Requests with an
+        ``Authorization`` header are never cached then, since token
+        authentication happens after the middleware. Only turn off for pages
+        that look the same to everyone.
+    """
+    def decorator(view):
+        view.response_cache = ResponsePolicy(
+            name or '{}.{}'.format(view.__module__, view.__name__), timeout,
+            stale if stale is not None else getattr(settings, 'STAMPEDE_STALE_TIMEOUT', 300),
+            vary, tags, per_user, cache_alias)
+        return view
+    return decorator
+
+
+def tag_key(tag):
+    return 'resptag:{}'.format(tag)
+
+
+def invalidate(*tags, **kwargs):
+    """Expire every cached response carrying any of ``tags``.
+
+    Each tag maps to a random version that cached responses record; a new
+    version makes them all misses without finding or deleting them.
+    """
+    caches[kwargs.get('cache_alias', 'default')].set_many(
+        dict((tag_key(tag), uuid.uuid4().hex) for tag in tags), None)
+
+
+class CacheState(object):
+    __slots__ = ('policy', 'key', 'tags', 'lock_token')
+
+    def __init__(self, policy, key, tags, lock_token=None):
+        self.policy = policy
+        self.key = key
+        self.tags = tags
+        self.lock_token = lock_token
+
+
+_lock = threading.Lock()
+_executors = {}
+
+
+def get_executor():
+    """Threads for background refreshes, rebuilt in each forked worker."""
+    pid = os.getpid()
+    executor = _executors.get(pid)
+    if executor is None:
+        with _lock:
+            executor = _executors.get(pid)
+            if executor is None:
+                _executors.clear()
+                executor = _executors[pid] = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'RESPONSE_CACHE_REFRESH_WORKERS', 2))
+    return executor
+
+
+def refresh_in_background(middleware, request, key, token):
+    """Re-run ``request`` through ``middleware`` on another thread.
+
+    The copy has no body but keeps the user and session the middleware
+    above set, and carries ``key`` and ``token``, so it skips the cache,
+    stores its response under ``key`` and releases the lock.
+    """
+    environ = dict(request.META)
+    environ['wsgi.input'] = io.BytesIO(b'')
+    environ[REFRESH_TOKEN] = (key, token)
+    copy = WSGIRequest(environ)
+    for attr in ('user', 'session'):
+        if hasattr(request, attr):
+            setattr(copy, attr, getattr(request, attr))
+
+    def refresh():
+        try:
+            middleware(copy)
+        except Exception:
+            logger.exception('Refreshing %s failed', key)
+        finally:
+            # Connections are per thread; don't leave this one's open.
+            connections.close_all()
+
+    return get_executor().submit(refresh)
+
+
+class ResponseCacheMiddleware(object):
+    """Serve views decorated with ``cache_response`` from the cache.
+
+    A fresh entry is returned without running the view, as a 304 when the
+    client already holds its ETag, which is computed once when the entry is
+    stored. Past ``timeout`` every request gets the stale copy, and the one
+    that takes the entry's lock queues the view to re-run on a background
+    thread. On a miss, including an entry whose tags were invalidated, one
+    request runs the view while the rest wait up to ``STAMPEDE_WAIT``
+    seconds for its result. Responses that set cookies, use a CSRF token,
+    modify the session or say ``no-store`` are never stored. Hits, stale
+    serves, waits and recomputes are counted with the ``caching.stampede``
+    statistics.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        state = getattr(request, '_response_cache', None)
+        if state is None:
+            return response
+        cache = caches[state.policy.cache_alias]
+        try:
+            if self.cacheable(request, response):
+                response = self.store(request, response, state, cache)
+        finally:
+            if state.lock_token is not None:
+                release_lock(state.policy.cache_alias, state.key + ':lock', state.lock_token)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        policy = getattr(view_func, 'response_cache', None)
+        if policy is None or request.method not in ('GET', 'HEAD'):
+            return None
+        if policy.per_user and 'HTTP_AUTHORIZATION' in request.META:
+            # Token-authenticated clients look anonymous here.
+            return None
+        cache = caches[policy.cache_alias]
+        key = policy.key(request)
+        tag_keys = [tag_key(tag.format(**view_kwargs)) for tag in policy.tags]
+        # One round trip for the entry and the current tag versions.
+        found = cache.get_many([key] + tag_keys)
+        tags = dict((k, found.get(k)) for k in tag_keys)
+        entry = found.get(key)
+
+        refresh = request.META.get(REFRESH_TOKEN)
+        if refresh is not None:
+            request._response_cache = CacheState(policy, refresh[0], tags, refresh[1])
+            return None
+
+        lock_timeout = getattr(settings, 'STAMPEDE_LOCK_TIMEOUT', 30)
+        if entry is not None and entry['tags'] == tags:
+            if time.time() < entry['expires']:
+                counters.incr(policy.name, 'hit')
+                return self.respond(request, entry, 'HIT')
+            counters.incr(policy.name, 'stale')
+            token = acquire_lock(policy.cache_alias, key + ':lock', lock_timeout)
+            if token is not None:
+                refresh_in_background(self, request, key, token)
+            return self.respond(request, entry, 'STALE')
+
+        token = acquire_lock(policy.cache_alias, key + ':lock', lock_timeout)
+        if token is None:
+            counters.incr(policy.name, 'wait')
+            entry = self.wait(cache, key, tag_keys)
+            if entry is not None:
+                return self.respond(request, entry, 'HIT')
+        request._response_cache = CacheState(policy, key, tags, token)
+        return None
+
+    def wait(self, cache, key, tag_keys):
+        """The entry the lock holder stores, if it does within ``STAMPEDE_WAIT``."""
+        deadline = time.time() + getattr(settings, 'STAMPEDE_WAIT', 2)
+        while time.time() < deadline:
+            time.sleep(0.05)
+            found = cache.get_many([key] + tag_keys)
+            entry = found.get(key)
+            if entry is not None and entry['tags'] == dict(
+                    (k, found.get(k)) for k in tag_keys):
+                return entry
+        return None
+
+    def cacheable(self, request, response):
+        session = getattr(request, 'session', None)
+        return (response.status_code == 200
+                and not response.streaming
+                and not response.cookies
+                and not request.META.get('CSRF_COOKIE_USED')
+                and not (session is not None and session.modified)
+                and 'no-store' not in response.get('Cache-Control', ''))
+
+    def store(self, request, response, state, cache):
+        policy = state.policy
+        etag = '"{}"'.format(hashlib.md5(response.content).hexdigest())
+        response['ETag'] = etag
+        entry = {
+            'status': response.status_code,
+            'headers': list(response.items()),
+            'content': response.content,
+            'etag': etag,
+            'tags': state.tags,
+            'expires': time.time() + policy.timeout,
+        }
+        cache.set(state.key, entry, policy.timeout + policy.stale)
+        counters.incr(policy.name, 'recompute')
+        if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            return self.not_modified(etag)
+        response['X-Cache'] = 'MISS'
+        return response
+
+    def not_modified(self, etag):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    def respond(self, request, entry, status):
+        if entry['etag'] in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            response = self.not_modified(entry['etag'])
+        else:
+            response = HttpResponse(entry['content'], status=entry['status'])
+            for header, value in entry['headers']:
+                response[header] = value
+        response['X-Cache'] = status
+        return response
@@ -0,0 +1,185 @@
+import math
+import time
+import uuid
+import random
+import hashlib
+import logging
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+
+from ..redis_utils import HashCounters, get_redis
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY = 'stampede:stats'
+EVENTS = ('hit', 'stale', 'recompute', 'wait')
+
+
+class Counters(object):
+    """Per-process event counts by key prefix, folded into one Redis hash."""
+
+    def __init__(self, flush_interval=10):
+        self.counts = HashCounters('cache stampede', flush_interval)
+
+    def incr(self, prefix, event):
+        self.counts.incr(STATS_KEY, '{}:{}'.format(prefix, event))
+        self.counts.maybe_flush()
+
+    def flush(self):
+        self.counts.flush()
+
+
+counters = Counters()
+
+
+def stats():
+    """``{prefix: {event: count}}`` across every process."""
+    counters.flush()
+    client = get_redis()
+    if client is None:
+        return {}
+    result = {}
+    for field, n in client.hgetall(caches['default'].make_key(STATS_KEY)).items():
+        field = field.decode('utf-8') if isinstance(field, bytes) else field
+        prefix, _, event = field.rpartition(':')
+        result.setdefault(prefix, dict((e, 0) for e in EVENTS))[event] = int(n)
+    return result
+
+
+def _prefix(key):
+    return key.split(':', 1)[0]
+
+
+# Delete the lock only while it still holds the caller's token, so a worker
+# whose lock expired mid-compute can't release the next owner's.
+RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def acquire_lock(cache_alias, key, timeout):
+    """Take the recompute lock ``key``; returns an owner token, or ``None``
+    if another worker holds it."""
+    cache = caches[cache_alias]
+    token = uuid.uuid4().hex
+    client = get_redis(cache_alias)
+    if client is not None:
+        # Raw SET NX: the cache would pickle the token, and the release
+        # script compares it byte for byte.
+        acquired = client.set(cache.make_key(key), token, nx=True,
+                              px=int(timeout * 1000))
+    else:
+        acquired = cache.add(key, token, timeout)
+    return token if acquired else None
+
+
+def release_lock(cache_alias, key, token):
+    """Release ``key`` if ``token`` still owns it."""
+    cache = caches[cache_alias]
+    client = get_redis(cache_alias)
+    try:
+        if client is not None:
+            client.register_script(RELEASE_LOCK)(keys=[cache.make_key(key)], args=[token])
+        elif cache.get(key) == token:
+            # Not atomic, but only in-process caches get here.
+            cache.delete(key)
+    except Exception:
+        # The lock expires on its own.
+        logger.exception('Could not release %s', key)
+
+
+def get_or_compute(key, compute, timeout=300, stale_timeout=None, beta=1.0,
+                   lock_timeout=None, wait=None, cache_alias='default'):
+    """Return the cached value for ``key``, recomputing it at most once.
+
+    Values are stored with the time their computation took. Each read
+    recomputes early with a probability that rises as expiry nears, scaled
+    by that cost (XFetch), so hot keys refresh before they expire rather
+    than all at once. Recomputation is single-flight: the worker that wins a
+    Redis ``SET NX`` lock recomputes, while every other worker keeps serving
+    the stale value for up to ``stale_timeout`` seconds past expiry. The
+    lock holds a random owner token and is only released by its owner.
+
+    :param str key: cache key; the part before the first ``:`` is the
+        prefix statistics are grouped by. ``KEY_PREFIX`` is applied by the
+        cache as usual.
+    :param compute: zero-argument callable producing the value.
+    :param float wait: on a cold miss with another worker computing, how long
+        to wait for its result before computing anyway.
+    """
+    cache = caches[cache_alias]
+    stale_timeout = stale_timeout if stale_timeout is not None else getattr(
+        settings, 'STAMPEDE_STALE_TIMEOUT', timeout)
+    lock_timeout = lock_timeout or getattr(settings, 'STAMPEDE_LOCK_TIMEOUT', 30)
+    wait = wait if wait is not None else getattr(settings, 'STAMPEDE_WAIT', 2)
+    prefix = _prefix(key)
+    lock_key = '{}:lock'.format(key)
+
+    entry = cache.get(key)
+    now = time.time()
+    if entry is not None:
+        value, delta, expires = entry
+        # XFetch: -log(U) is exponentially distributed, so recompute early
+        # with a probability that rises as ``expires`` approaches.
+        early = now - delta * beta * math.log(1.0 - random.random()) >= expires
+        if not early:
+            counters.incr(prefix, 'hit')
+            return value
+        token = acquire_lock(cache_alias, lock_key, lock_timeout)
+        if token is None:
+            counters.incr(prefix, 'stale')
+            return value
+    else:
+        token = acquire_lock(cache_alias, lock_key, lock_timeout)
+        if token is None:
+            counters.incr(prefix, 'wait')
+            deadline = now + wait
+            while time.time() < deadline:
+                time.sleep(0.05)
+                entry = cache.get(key)
+                if entry is not None:
+                    return entry[0]
+
+    try:
+        started = time.time()
+        value = compute()
+        delta = time.time() - started
+        cache.set(key, (value, delta, time.time() + timeout), timeout + stale_timeout)
+        counters.incr(prefix, 'recompute')
+        return value
+    finally:
+        if token is not None:
+            release_lock(cache_alias, lock_key, token)
+
+
+def cached(prefix=None, timeout=300, stale_timeout=None, beta=1.0, cache_alias='default'):
+    """Decorator form of ``get_or_compute``.
+
+    The key is ``<prefix>:<digest of the arguments>``; ``prefix`` defaults to
+    the function's module and name. Arguments are keyed by their ``repr``,
+    so they must render the same way in every process.
+    """
+    def decorator(fn):
+        key_prefix = prefix or '{}.{}'.format(fn.__module__, fn.__name__)
+
+        def make_key(args, kwargs):
+            signature = repr((args, sorted(kwargs.items()))).encode('utf-8')
+            return '{}:{}'.format(key_prefix, hashlib.md5(signature).hexdigest())
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            return get_or_compute(
+                make_key(args, kwargs), lambda: fn(*args, **kwargs), timeout=timeout,
+                stale_timeout=stale_timeout, beta=beta, cache_alias=cache_alias)
+
+        def invalidate(*args, **kwargs):
+            caches[cache_alias].delete(make_key(args, kwargs))
+
+        wrapper.invalidate = invalidate
+        return wrapper
+    return decorator
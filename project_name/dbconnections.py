@@ -0,0 +1,140 @@
+import os
+import time
+import socket
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started, request_finished
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from .redis_utils import HashCounters, get_redis
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY = 'dbconn:stats'
+COUNTERS = ('opened', 'reused', 'closed', 'unhealthy')
+
+
+class ConnectionStats(object):
+    """This worker's connection counts, added into one Redis hash.
+
+    Fields are ``<host>:<pid>:<counter>``, plus ``<host>:<pid>:seen`` with
+    the time of the worker's last report, so every worker's counts sit side
+    by side. ``counts`` holds this worker's own totals; a forked worker
+    notices the new pid on its first count and starts again from zero,
+    since ``os.register_at_fork`` is Python 3.7+.
+    """
+
+    def __init__(self, flush_interval=10):
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.counters = HashCounters('database connection', flush_interval)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def incr(self, counter):
+        if self._pid != os.getpid():
+            self.after_fork()
+        with self._lock:
+            self.counts[counter] += 1
+        self.counters.incr(STATS_KEY, '{}:{}'.format(self.worker(), counter))
+
+    def after_fork(self):
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def worker(self):
+        return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def flush(self, force=False):
+        self.counters.set(STATS_KEY, '{}:seen'.format(self.worker()), int(time.time()))
+        if force:
+            self.counters.flush()
+        else:
+            self.counters.maybe_flush()
+
+
+stats = ConnectionStats()
+
+
+def snapshot(max_age=300):
+    """``{worker: {counter: n}}`` for workers that reported within ``max_age`` seconds."""
+    stats.flush(force=True)
+    client = get_redis()
+    if client is None:
+        return {stats.worker(): dict(stats.counts)}
+    workers = {}
+    for field, n in client.hgetall(cache.make_key(STATS_KEY)).items():
+        field = field.decode('utf-8') if isinstance(field, bytes) else field
+        worker, _, counter = field.rpartition(':')
+        workers.setdefault(worker, {})[counter] = int(n)
+    cutoff = time.time() - max_age
+    return dict((worker, counts) for worker, counts in workers.items()
+                if counts.get('seen', 0) >= cutoff)
+
+
+def prune(max_age=300):
+    """Drop workers that haven't reported within ``max_age`` seconds."""
+    client = get_redis()
+    if client is None:
+        return
+    key = cache.make_key(STATS_KEY)
+    live = snapshot(max_age)
+    stale = []
+    for field in client.hkeys(key):
+        name = field.decode('utf-8') if isinstance(field, bytes) else field
+        if name.rpartition(':')[0] not in live:
+            stale.append(field)
+    if stale:
+        client.hdel(key, *stale)
+
+
+def on_connection_created(sender, connection, **kwargs):
+    stats.incr('opened')
+    if getattr(connection, '_close_counted', False):
+        return
+    close = connection._close
+
+    def counted_close():
+        if connection.connection is not None:
+            stats.incr('closed')
+        return close()
+
+    connection._close = counted_close
+    connection._close_counted = True
+
+
+def check_connections(**kwargs):
+    """Vet the connections a request is about to reuse.
+
+    Runs after Django's own ``close_old_connections``. A connection idle for
+    more than ``DATABASE_HEALTH_CHECK_AFTER`` seconds gets a ``SELECT 1``
+    first, so a link pgbouncer dropped is replaced here rather than failing
+    the request's first query.
+    """
+    check_after = getattr(settings, 'DATABASE_HEALTH_CHECK_AFTER', 30)
+    now = time.time()
+    for connection in connections.all():
+        if connection.connection is None:
+            continue
+        if now - getattr(connection, '_last_used', now) > check_after and not connection.is_usable():
+            stats.incr('unhealthy')
+            connection.close()
+        else:
+            stats.incr('reused')
+    stats.flush()
+
+
+def mark_used(**kwargs):
+    now = time.time()
+    for connection in connections.all():
+        if connection.connection is not None:
+            connection._last_used = now
+
+
+connection_created.connect(on_connection_created, dispatch_uid='dbconnections.created')
+request_started.connect(check_connections, dispatch_uid='dbconnections.check')
+request_finished.connect(mark_used, dispatch_uid='dbconnections.used')
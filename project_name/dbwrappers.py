@@ -0,0 +1,54 @@
+from functools import partial
+
+from django.db.backends.signals import connection_created
+from django.db.backends.utils import CursorWrapper, CursorDebugWrapper
+
+
+_wrappers = []
+
+
+def add_execute_wrapper(wrapper):
+    """Run ``wrapper`` around every query on every connection.
+
+    Same contract as ``connection.execute_wrapper`` in Django 2.0+: it is
+    called as ``wrapper(execute, sql, params, many, context)`` and must call
+    ``execute(sql, params, many, context)`` to run the query. ``context``
+    holds the ``connection`` and the ``cursor``.
+    """
+    if wrapper not in _wrappers:
+        _wrappers.append(wrapper)
+
+
+class ExecuteWrapperMixin(object):
+
+    def execute(self, sql, params=None):
+        return self._wrapped(super(ExecuteWrapperMixin, self).execute, sql, params, False)
+
+    def executemany(self, sql, param_list):
+        return self._wrapped(super(ExecuteWrapperMixin, self).executemany, sql, param_list, True)
+
+    def _wrapped(self, method, sql, params, many):
+        def execute(sql, params, many, context):
+            return method(sql, params)
+        for wrapper in reversed(_wrappers):
+            execute = partial(wrapper, execute)
+        return execute(sql, params, many, {'connection': self.db, 'cursor': self})
+
+
+class WrappedCursor(ExecuteWrapperMixin, CursorWrapper):
+    pass
+
+
+class WrappedDebugCursor(ExecuteWrapperMixin, CursorDebugWrapper):
+    pass
+
+
+def install(sender, connection, **kwargs):
+    if getattr(connection, '_execute_wrappers_installed', False):
+        return
+    connection.make_cursor = lambda cursor: WrappedCursor(cursor, connection)
+    connection.make_debug_cursor = lambda cursor: WrappedDebugCursor(cursor, connection)
+    connection._execute_wrappers_installed = True
+
+
+connection_created.connect(install, dispatch_uid='dbwrappers.install')
@@ -0,0 +1,19 @@
+def split_image_url(url):
+    """Split an uploaded image URL into its path after ``uploads`` and ext."""
+    filename = '.'.join(url.split('.')[:-1])
+    ext = url.split('.')[-1]
+    after_uploads = filename.split('uploads')[-1]
+    return after_uploads, ext
+
+
+def derivative_path(url, suffix, ext=None):
+    """Key for a derivative of ``url``, e.g. ``uploads/a/b_compressed.jpg``."""
+    after_uploads, source_ext = split_image_url(url)
+    return 'uploads{}_{}.{}'.format(after_uploads, suffix, ext or source_ext)
+
+
+def image_models():
+    """Installed models with a concrete ``image`` field."""
+    from django.apps import apps
+    return [model for model in apps.get_models()
+            if any(f.name == 'image' for f in model._meta.concrete_fields)]
@@ -0,0 +1,270 @@
+import io
+import os
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import simplejson as json
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from . import derivative_path
+from .fetch import check_decode_size, fetch
+from .manifest import Derivatives
+from .. import ratelimit, s3
+from ..instrumentation import timed
+
+
+PIL_FORMATS = {
+    'jpg': 'JPEG',
+    'jpeg': 'JPEG',
+    'png': 'PNG',
+    'webp': 'WEBP',
+    'avif': 'AVIF',
+}
+
+CONTENT_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    'AVIF': 'image/avif',
+}
+
+
+def _options():
+    return {
+        'jpeg_min_quality': getattr(settings, 'IMAGE_COMPRESSION_JPEG_MIN_QUALITY', 60),
+        'jpeg_max_quality': getattr(settings, 'IMAGE_COMPRESSION_JPEG_MAX_QUALITY', 90),
+        'jpeg_target_ratio': getattr(settings, 'IMAGE_COMPRESSION_JPEG_TARGET_RATIO', 0.6),
+        'extra_formats': getattr(settings, 'IMAGE_COMPRESSION_EXTRA_FORMATS', ()),
+        'extra_quality': getattr(settings, 'IMAGE_COMPRESSION_EXTRA_QUALITY', 75),
+    }
+
+
+def _save(im, fmt, **params):
+    output = io.BytesIO()
+    im.save(output, format=fmt, **params)
+    return output.getvalue()
+
+
+def _search_jpeg(im, budget, lo, hi):
+    # Binary search for the highest quality that fits the byte budget.
+    if im.mode not in ('RGB', 'L'):
+        im = im.convert('RGB')
+    best = smallest = None
+    while lo <= hi:
+        quality = (lo + hi) // 2
+        data = _save(im, 'JPEG', quality=quality, optimize=True, progressive=True)
+        if len(data) <= budget:
+            best = data
+            lo = quality + 1
+        else:
+            smallest = data
+            hi = quality - 1
+    # Nothing fit: the last miss was encoded at the minimum quality.
+    return best or smallest
+
+
+def _quantize_png(im):
+    if im.mode == 'P':
+        return _save(im, 'PNG', optimize=True)
+    if im.mode not in ('RGB', 'RGBA'):
+        im = im.convert('RGBA')
+    # Fast octree is the only quantizer Pillow supports for RGBA.
+    return _save(im.quantize(colors=256, method=2), 'PNG', optimize=True)
+
+
+def encode(data, ext, options):
+    """Compress ``data`` locally; runs inside the process pool.
+
+    :param bytes data: encoded source image.
+    :param str ext: source extension, which is kept for the primary output.
+    :param dict options: see ``_options``.
+    :return: dict of extension to encoded bytes. The primary output is never
+        larger than the source.
+    :raises SourceTooLarge: for a non-JPEG source above
+        ``IMAGE_DECODE_MAX_PIXELS``, before it is decoded.
+    """
+    from PIL import Image
+    im = Image.open(io.BytesIO(data))
+    check_decode_size(im)
+    im.load()
+    fmt = PIL_FORMATS.get(ext.lower())
+
+    if fmt == 'JPEG':
+        budget = int(len(data) * options['jpeg_target_ratio'])
+        primary = _search_jpeg(
+            im, budget, options['jpeg_min_quality'], options['jpeg_max_quality'])
+    elif fmt == 'PNG':
+        primary = _quantize_png(im)
+    else:
+        primary = data
+
+    outputs = {ext: primary if len(primary) < len(data) else data}
+
+    Image.init()
+    for extra in options['extra_formats']:
+        extra_fmt = PIL_FORMATS.get(extra)
+        if extra_fmt is None or extra_fmt not in Image.SAVE or extra == ext:
+            continue
+        frame = im if im.mode in ('RGB', 'RGBA') else im.convert('RGBA')
+        outputs[extra] = _save(frame, extra_fmt, quality=options['extra_quality'])
+    return outputs
+
+
+_lock = threading.Lock()
+_pool = {}
+_inline = threading.local()
+
+
+def encode_inline(enabled=True):
+    """Encode in the calling process, e.g. when it is already a pool worker."""
+    _inline.enabled = enabled
+
+
+def get_pool():
+    """Process pool for encoding, rebuilt in each forked worker."""
+    pid = os.getpid()
+    pool = _pool.get(pid)
+    if pool is None:
+        with _lock:
+            pool = _pool.get(pid)
+            if pool is None:
+                _pool.clear()
+                pool = ProcessPoolExecutor(
+                    max_workers=getattr(settings, 'IMAGE_COMPRESSION_PROCESSES', 2))
+                _pool[pid] = pool
+    return pool
+
+
+class BaseCompressionBackend(object):
+
+    # Whether ``compress`` reads the source; if not, it is never downloaded.
+    needs_source = True
+
+    def output_exts(self, ext):
+        """Extensions written for a source with extension ``ext``."""
+        return [ext]
+
+    def spec(self, ext):
+        """Manifest spec for the output with extension ``ext``."""
+        return 'compressed:{}:{}'.format(type(self).__name__, ext)
+
+    def compress_bytes(self, data, ext):
+        """Return the compressed primary output for ``data``."""
+        raise NotImplementedError
+
+    def compress(self, instance, data=None):
+        """Compress ``instance.image`` and store it at its ``_compressed`` key.
+
+        :param bytes data: the already fetched source, if the caller has it.
+        """
+        raise NotImplementedError
+
+
+class TinifyBackend(BaseCompressionBackend):
+    """Round trip through TinyPNG, which writes the result to S3 itself."""
+
+    needs_source = False
+
+    def _tinify(self):
+        ratelimit.bucket('tinify', 2, 5).acquire()
+        import tinify
+        if tinify.key != settings.TINYPNG:
+            tinify.key = settings.TINYPNG
+        return tinify
+
+    def compress_bytes(self, data, ext):
+        tinify = self._tinify()
+        with timed('tinify', 'from_buffer', len(data)):
+            return tinify.from_buffer(data).to_buffer()
+
+    def compress(self, instance, data=None):
+        # TinyPNG fetches the source itself; no point uploading ``data``.
+        tinify = self._tinify()
+        with timed('tinify', 'from_url'):
+            source = tinify.from_url(instance.image)
+            source.store(
+                service='s3',
+                aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                region=settings.S3DIRECT_REGION,
+                path='{}/{}'.format(settings.AWS_STORAGE_BUCKET_NAME,
+                                    derivative_path(instance.image, 'compressed'))
+            )
+
+
+class PillowBackend(BaseCompressionBackend):
+    """Compress locally: JPEG quality search, PNG quantization, optional
+    WebP/AVIF siblings, all encoded in a process pool."""
+
+    def output_exts(self, ext):
+        from PIL import Image
+        Image.init()
+        extras = [extra for extra in _options()['extra_formats']
+                  if extra != ext and PIL_FORMATS.get(extra) in Image.SAVE]
+        return [ext] + extras
+
+    def spec(self, ext):
+        # Changing any quality setting must miss the manifest.
+        options = json.dumps(_options(), sort_keys=True).encode('utf-8')
+        return '{}:{}'.format(super(PillowBackend, self).spec(ext),
+                              hashlib.md5(options).hexdigest()[:8])
+
+    def encode(self, data, ext):
+        if getattr(_inline, 'enabled', False) or not getattr(
+                settings, 'IMAGE_COMPRESSION_PROCESSES', 2):
+            return encode(data, ext, _options())
+        return get_pool().submit(encode, data, ext, _options()).result()
+
+    def compress_bytes(self, data, ext):
+        return self.encode(data, ext)[ext]
+
+    def compress(self, instance, data=None):
+        ext = instance.image.split('.')[-1]
+        if data is None:
+            source = fetch(instance.image)
+            try:
+                data = source.read()
+            finally:
+                source.close()
+        elif hasattr(data, 'read'):
+            # The pool pickles its arguments, so it needs the bytes.
+            data.seek(0)
+            data = data.read()
+        for out_ext, output in self.encode(data, ext).items():
+            fmt = PIL_FORMATS.get(out_ext.lower())
+            s3.upload(
+                output, derivative_path(instance.image, 'compressed', out_ext),
+                content_type=CONTENT_TYPES.get(fmt),
+            )
+
+
+def get_compression_backend(path=None):
+    path = path or getattr(settings, 'IMAGE_COMPRESSION_BACKEND', None)
+    return import_string(path)() if path else TinifyBackend()
+
+
+def targets(url, backend=None):
+    """``{manifest spec: key}`` of the compressed outputs of ``url``."""
+    backend = backend or get_compression_backend()
+    ext = url.split('.')[-1]
+    return dict((backend.spec(out_ext), derivative_path(url, 'compressed', out_ext))
+                for out_ext in backend.output_exts(ext))
+
+
+def compress(instance, backend=None, fetched=None):
+    """Compress ``instance.image`` unless the manifest already has it.
+
+    :param fetched: a :class:`~.fetch.SharedFetch` of the source, if other
+        derivatives are built from the same download.
+    :return: dict of manifest spec to stored key.
+    """
+    backend = backend or get_compression_backend()
+    with Derivatives(instance.image, targets(instance.image, backend),
+                     needs_source=backend.needs_source, fetched=fetched) as derivatives:
+        missing = derivatives.resolve()
+        if missing:
+            backend.compress(instance, derivatives.data)
+            derivatives.done(missing)
+    return derivatives.found
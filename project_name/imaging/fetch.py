@@ -0,0 +1,174 @@
+import os
+import hashlib
+import tempfile
+import threading
+
+from django.conf import settings
+
+from ..instrumentation import instrument_session
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class SourceTooLarge(ValueError):
+    pass
+
+
+def check_decode_size(im, max_pixels=None):
+    """Refuse a non-JPEG ``im`` above ``IMAGE_DECODE_MAX_PIXELS``.
+
+    Only JPEG can be draft-decoded at a fraction of its size; anything else
+    is decoded in full, so this bounds the memory a derivative can take.
+
+    :raises SourceTooLarge: before ``im`` has been decoded.
+    """
+    max_pixels = max_pixels or getattr(settings, 'IMAGE_DECODE_MAX_PIXELS', 25000000)
+    width, height = im.size
+    if im.format != 'JPEG' and width * height > max_pixels:
+        raise SourceTooLarge('{} source is {}x{} pixels, limit for a full decode is {}'.format(
+            im.format, width, height, max_pixels))
+
+
+class Source(object):
+    """A fetched source image.
+
+    ``file`` is positioned at the start and can be handed straight to
+    ``Image.open``; ``digest`` is the sha256 of the body, computed while it
+    streamed in.
+    """
+
+    def __init__(self, url, file, digest, size):
+        self.url = url
+        self.file = file
+        self.digest = digest
+        self.size = size
+
+    def read(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
+
+_lock = threading.Lock()
+_sessions = {}
+
+
+def get_session():
+    pid = os.getpid()
+    session = _sessions.get(pid)
+    if session is None:
+        with _lock:
+            session = _sessions.get(pid)
+            if session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                _sessions.clear()
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_maxsize=getattr(settings, 'IMAGE_FETCH_POOL_SIZE', 10))
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _sessions[pid] = instrument_session(session, 'image-fetch')
+    return session
+
+
+def head(url):
+    """The version of ``url``: its ETag and size from a HEAD request.
+
+    :return: ``'<etag>:<size>'``, or ``None`` if the server didn't give an
+        ETag or the request failed.
+    """
+    import requests
+    try:
+        response = get_session().head(
+            url, allow_redirects=True, timeout=getattr(settings, 'IMAGE_FETCH_TIMEOUT', 10))
+    except requests.RequestException:
+        return None
+    etag = response.headers.get('ETag')
+    if response.status_code != 200 or not etag:
+        return None
+    return '{}:{}'.format(etag, response.headers.get('Content-Length', ''))
+
+
+def fetch(url, max_bytes=None, max_pixels=None):
+    """Stream ``url`` into a spooled temporary file.
+
+    Bodies stay in memory up to ``IMAGE_FETCH_SPOOL_SIZE`` and spill to disk
+    beyond it. The byte limit is enforced from ``Content-Length`` and again
+    while streaming; the pixel limit is checked from the image header,
+    before anything is decoded.
+
+    :raises SourceTooLarge: when either limit is exceeded.
+    :rtype: Source
+    """
+    max_bytes = max_bytes or getattr(settings, 'IMAGE_FETCH_MAX_BYTES', 50 * 1024 * 1024)
+    max_pixels = max_pixels or getattr(settings, 'IMAGE_FETCH_MAX_PIXELS', 60000000)
+
+    spooled = tempfile.SpooledTemporaryFile(
+        max_size=getattr(settings, 'IMAGE_FETCH_SPOOL_SIZE', 5 * 1024 * 1024))
+    try:
+        response = get_session().get(
+            url, stream=True, timeout=getattr(settings, 'IMAGE_FETCH_TIMEOUT', 10))
+        try:
+            response.raise_for_status()
+            length = response.headers.get('Content-Length')
+            if length is not None and int(length) > max_bytes:
+                raise SourceTooLarge('{} is {} bytes, limit is {}'.format(url, length, max_bytes))
+
+            digest = hashlib.sha256()
+            size = 0
+            for chunk in response.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise SourceTooLarge('{} exceeds {} bytes'.format(url, max_bytes))
+                digest.update(chunk)
+                spooled.write(chunk)
+        finally:
+            response.close()
+
+        from PIL import Image
+        spooled.seek(0)
+        width, height = Image.open(spooled).size
+        if width * height > max_pixels:
+            raise SourceTooLarge('{} is {}x{} pixels, limit is {}'.format(
+                url, width, height, max_pixels))
+        spooled.seek(0)
+    except Exception:
+        # Spilled bodies are real files; don't leave them to the GC.
+        spooled.close()
+        raise
+    return Source(url, spooled, digest.hexdigest(), size)
+
+
+class SharedFetch(object):
+    """Fetches ``url`` once for every derivative built from it.
+
+    Calling it returns the :class:`Source`, fetched on the first call and
+    rewound on later ones. Whoever creates it closes it, e.g. with a
+    ``with`` block around the utils it is passed to.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self._source = None
+
+    def __call__(self):
+        if self._source is None:
+            self._source = fetch(self.url)
+        else:
+            self._source.file.seek(0)
+        return self._source
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._source is not None:
+            self._source.close()
+            self._source = None
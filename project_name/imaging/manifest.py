@@ -0,0 +1,213 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .fetch import fetch, head
+from .. import s3
+from ..apps.core.models import DerivativeManifest, SourceVersion
+
+
+HITS_KEY = 'manifest:hits'
+MISSES_KEY = 'manifest:misses'
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_inline(value):
+    return value.startswith('data:')
+
+
+def _count(key, n):
+    if not n:
+        return
+    try:
+        cache.incr(key, n)
+    except ValueError:
+        cache.set(key, n, None)
+
+
+def stats():
+    counts = cache.get_many([HITS_KEY, MISSES_KEY])
+    hits, misses = counts.get(HITS_KEY, 0), counts.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': float(hits) / total if total else 0.0,
+    }
+
+
+def version_hash(version):
+    """Stands in for the content hash of a source that was never fetched."""
+    return 'etag:' + hashlib.md5(version.encode('utf-8')).hexdigest()
+
+
+def lookup(digests, specs, source):
+    """Derivatives of these bytes: ``{spec: (value, recorded for source)}``.
+
+    One query over every hash in ``digests``. An entry recorded for
+    ``source`` itself wins over one recorded for another URL with the same
+    content.
+    """
+    rows = DerivativeManifest.objects.filter(
+        content_hash__in=list(digests), spec__in=list(specs),
+    ).values_list('spec', 'source', 'value')
+    found = {}
+    for spec, row_source, value in rows:
+        if spec not in found or row_source == source:
+            found[spec] = (value, row_source == source)
+    return found
+
+
+def lookup_many(sources, specs):
+    """Derivatives recorded for each of ``sources``: ``{source: {spec: value}}``.
+
+    Two queries however many sources there are, for bulk work such as
+    reprocessing. Only entries matching the content hash last stored for
+    their source count; unlike :meth:`Derivatives.resolve`, nothing checks
+    whether a source has changed since.
+    """
+    sources = list(sources)
+    digests = dict(SourceVersion.objects.filter(
+        source__in=sources).values_list('source', 'content_hash'))
+    found = dict((source, {}) for source in sources)
+    rows = DerivativeManifest.objects.filter(
+        source__in=list(digests), spec__in=list(specs),
+    ).values_list('source', 'content_hash', 'spec', 'value')
+    for source, digest, spec, value in rows:
+        if digests[source] == digest:
+            found[source][spec] = value
+    return found
+
+
+def current_digest(source, version):
+    """The content hash stored for ``source`` if it is still at ``version``."""
+    return SourceVersion.objects.filter(source=source, version=version).values_list(
+        'content_hash', flat=True).first()
+
+
+def remember(source, version, digest):
+    SourceVersion.objects.update_or_create(
+        source=source, defaults={'version': version, 'content_hash': digest})
+
+
+def record(source, digest, values):
+    """Store ``{spec: value}`` for ``source``."""
+    for spec, value in values.items():
+        DerivativeManifest.objects.update_or_create(
+            source=source, spec=spec,
+            defaults={'content_hash': digest, 'value': value},
+        )
+
+
+class Derivatives(object):
+    """The derivatives one util wants for a source image.
+
+    ``targets`` maps a spec string, which should encode every parameter that
+    affects the output, to the key the derivative is written under. After
+    ``resolve``, ``found`` holds what the manifest already had and
+    ``missing`` what still has to be built from ``data``, a file object
+    holding the fetched source, which is closed with the block. ``data`` is
+    ``None`` when nothing is missing and the source was not fetched.
+
+    With ``needs_source=False`` the source is never fetched: a source with
+    no current content hash is looked up, and recorded, by the hash of its
+    ETag and size instead. A :class:`~.fetch.SharedFetch` passed as
+    ``fetched`` lets several utils share one download, which its owner
+    closes::
+
+        with Derivatives(url, {'compressed:jpg': key}) as derivatives:
+            if derivatives.resolve():
+                ...build from derivatives.data...
+                derivatives.done({'compressed:jpg': key})
+    """
+
+    def __init__(self, source, targets, needs_source=True, fetched=None):
+        self.source = source
+        self.targets = dict(targets)
+        self.needs_source = needs_source
+        self.shared = fetched
+        self.found = {}
+        self.missing = {}
+        self.data = None
+        self.digest = None
+        self._fetched = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._fetched is not None:
+            if self.shared is None:
+                self._fetched.close()
+            self._fetched = self.data = None
+
+    def _fetch(self):
+        self._fetched = self.shared() if self.shared is not None else fetch(self.source)
+        self.data = self._fetched.file
+        self.digest = self._fetched.digest
+
+    def resolve(self):
+        """Fill ``found`` and ``missing``; returns ``missing``.
+
+        A HEAD request gets the source's ETag and size. While they match
+        what the source was last hashed at, the stored hash is used and the
+        source is only fetched if something is missing. A new or
+        overwritten source is fetched and hashed first, so it is rebuilt
+        rather than served the derivatives of its old bytes.
+        """
+        version = head(self.source)
+        self.digest = current_digest(self.source, version) if version else None
+        if self.digest is None and self.needs_source:
+            self._fetch()
+            if version:
+                remember(self.source, version, self.digest)
+        digests = [self.digest] if self.digest else []
+        if version:
+            digests.append(version_hash(version))
+            self.digest = self.digest or digests[-1]
+        known = lookup(digests, self.targets, self.source)
+        reused = {}
+        for spec, target in self.targets.items():
+            if spec not in known:
+                self.missing[spec] = target
+                continue
+            value, own = known[spec]
+            if own:
+                self.found[spec] = value
+                continue
+            if not is_inline(value) and target and value != target:
+                # Same bytes under a new URL: a server-side copy keeps
+                # the derivative at the key this source's scheme expects.
+                s3.get_client().copy_object(
+                    Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=target,
+                    CopySource={'Bucket': settings.AWS_STORAGE_BUCKET_NAME,
+                                'Key': value},
+                )
+                value = target
+            reused[spec] = value
+        if reused:
+            record(self.source, self.digest, reused)
+        self.found.update(reused)
+
+        _count(HITS_KEY, len(self.found))
+        _count(MISSES_KEY, len(self.missing))
+        if self.missing and self.needs_source and self._fetched is None:
+            self._fetch()
+        return self.missing
+
+    def done(self, values):
+        """Record freshly built ``{spec: value}`` derivatives.
+
+        Without a content hash or a version to key them on, they are kept
+        for this block only.
+        """
+        if self.digest:
+            record(self.source, self.digest, values)
+        self.found.update(values)
@@ -0,0 +1,100 @@
+import io
+import base64
+import logging
+
+from django.conf import settings
+
+from . import derivative_path
+from .compression import CONTENT_TYPES, PIL_FORMATS
+from .fetch import check_decode_size
+from .manifest import Derivatives
+from .. import s3
+
+logger = logging.getLogger(__name__)
+
+
+def render(data, width=42):
+    """Downscale to ``width`` pixels wide, then blur the small bitmap.
+
+    JPEG sources are draft-decoded close to the target size, so the full
+    resolution image is never decoded or filtered.
+    """
+    from PIL import Image, ImageFilter
+    im = Image.open(data if hasattr(data, 'read') else io.BytesIO(data))
+    check_decode_size(im)
+    if im.format == 'JPEG':
+        ratio = float(width) / im.size[0]
+        im.draft('RGB', (width, max(1, int(im.size[1] * ratio))))
+    im.load()
+    if im.mode not in ('RGB', 'RGBA', 'L'):
+        im = im.convert('RGBA' if 'transparency' in im.info else 'RGB')
+
+    ratio = float(width) / im.size[0]
+    height = max(1, int(im.size[1] * ratio))
+    im = im.resize((width, height), Image.ANTIALIAS)
+    return im.filter(ImageFilter.BLUR)
+
+
+def encode(im, fmt, quality=None):
+    if fmt == 'JPEG' and im.mode != 'RGB':
+        im = im.convert('RGB')
+    output = io.BytesIO()
+    im.save(output, format=fmt, optimize=True,
+            quality=quality or getattr(settings, 'PLACEHOLDER_QUALITY', 40))
+    return output
+
+
+def data_uri(im):
+    """Encode ``im`` as a compact inline ``data:`` URI (JPEG, or PNG with alpha)."""
+    fmt = 'PNG' if im.mode == 'RGBA' else 'JPEG'
+    payload = base64.b64encode(encode(im, fmt).getvalue()).decode('ascii')
+    return 'data:{};base64,{}'.format(CONTENT_TYPES[fmt], payload)
+
+
+def targets(url, width=42, mode=None):
+    """``{manifest spec: key}`` of the placeholder of ``url``; the key is
+    ``None`` for inline placeholders."""
+    mode = mode or getattr(settings, 'PLACEHOLDER_MODE', 'inline')
+    spec = 'placeholder:{}:{}:q{}'.format(
+        mode, width, getattr(settings, 'PLACEHOLDER_QUALITY', 40))
+    return {spec: derivative_path(url, 'placeholder') if mode == 's3' else None}
+
+
+def make_placeholder(instance, width=42, mode=None, fetched=None):
+    """Build a placeholder for ``instance.image``.
+
+    :param str mode: ``'inline'`` stores a data URI on the instance's
+        ``PLACEHOLDER_FIELD`` so clients receive it in the API response;
+        ``'s3'`` uploads a separate ``_placeholder`` object as before. A
+        model without the field gets ``'s3'`` whatever the mode.
+    :param fetched: a :class:`~.fetch.SharedFetch` of the source, as for
+        :func:`~.compression.compress`.
+    :return: the data URI or the object URL.
+    """
+    mode = mode or getattr(settings, 'PLACEHOLDER_MODE', 'inline')
+    field = getattr(settings, 'PLACEHOLDER_FIELD', 'placeholder')
+    model = type(instance)
+    if mode == 'inline' and field not in set(f.attname for f in model._meta.concrete_fields):
+        # Nowhere to keep a data URI; an object URL is better than nothing.
+        logger.warning('%s has no %s field for inline placeholders, uploading to S3',
+                       model.__name__, field)
+        mode = 's3'
+    (spec, path), = targets(instance.image, width, mode).items()
+    with Derivatives(instance.image, {spec: path}, fetched=fetched) as derivatives:
+        if derivatives.resolve():
+            im = render(derivatives.data, width)
+            if mode == 's3':
+                fmt = PIL_FORMATS.get(instance.image.split('.')[-1].lower(), 'PNG')
+                s3.upload(encode(im, fmt), path, content_type=CONTENT_TYPES.get(fmt))
+                derivatives.done({spec: path})
+            else:
+                derivatives.done({spec: data_uri(im)})
+
+    value = derivatives.found[spec]
+    if mode == 's3':
+        return s3.resolve_url(value)
+
+    setattr(instance, field, value)
+    if instance.pk is not None:
+        model._default_manager.filter(pk=instance.pk).update(**{field: value})
+    return value
@@ -0,0 +1,63 @@
+import logging
+
+from django.apps import apps
+
+from . import compression, placeholders, thumbnails
+from .compression import encode_inline
+from .fetch import SharedFetch
+from .manifest import lookup_many
+
+logger = logging.getLogger(__name__)
+
+TASKS = ('compress', 'placeholder', 'thumbnail')
+
+# task: url -> {manifest spec: key} with the settings the task runs with
+TARGETS = {
+    'compress': compression.targets,
+    'placeholder': placeholders.targets,
+    'thumbnail': thumbnails.targets,
+}
+
+
+def reprocess_chunk(label, pks, tasks=TASKS):
+    """Build the missing derivatives for one chunk of rows.
+
+    Runs in a process pool worker or as an RQ job, so it takes a model label
+    and primary keys rather than instances.
+
+    :return: ``(processed, failed)``: the row count and the primary keys
+        that failed, so the caller can retry them.
+    """
+    from .. import utils
+
+    handlers = {
+        'compress': utils.compress_image,
+        'placeholder': utils.make_placeholder_image,
+        'thumbnail': utils.make_thumbnail,
+    }
+    # Already inside a worker: don't fork a nested encoding pool.
+    encode_inline()
+
+    model = apps.get_model(label)
+    instances = list(model._default_manager.filter(pk__in=pks))
+    # One manifest lookup for the chunk; tasks with every derivative
+    # recorded are skipped without touching the source.
+    wanted = dict((instance.pk, dict((task, TARGETS[task](instance.image)) for task in tasks))
+                  for instance in instances)
+    found = lookup_many(
+        set(instance.image for instance in instances),
+        set(spec for targets in wanted.values() for specs in targets.values() for spec in specs))
+
+    failed = []
+    for instance in instances:
+        done = found[instance.image]
+        try:
+            # Every task builds from the same download of the source.
+            with SharedFetch(instance.image) as fetched:
+                for task in tasks:
+                    if any(spec not in done for spec in wanted[instance.pk][task]):
+                        handlers[task](instance, fetched=fetched)
+        except Exception:
+            failed.append(instance.pk)
+            logger.exception('Reprocessing %s %s failed', label, instance.pk)
+    return len(pks), failed
@@ -0,0 +1,159 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.utils import six
+
+from . import derivative_path
+from .compression import CONTENT_TYPES, PIL_FORMATS
+from .fetch import check_decode_size
+from .manifest import Derivatives
+from .. import s3
+
+
+# name: (width, height, mode); mode is 'crop' (fill the box) or 'fit' (inside it)
+DEFAULT_SIZES = {
+    'small': (150, 150, 'crop'),
+    'medium': (600, 600, 'fit'),
+    'large': (1200, 1200, 'fit'),
+}
+
+
+def get_specs(size=None):
+    """Resolve ``size`` to a dict of thumbnail specs.
+
+    :param size: ``None`` for every configured size, a configured name, an
+        iterable of names, or a dict of ``name: (width, height, mode)``.
+    """
+    sizes = getattr(settings, 'THUMBNAIL_SIZES', DEFAULT_SIZES)
+    if size is None:
+        return dict(sizes)
+    if isinstance(size, dict):
+        return size
+    if isinstance(size, six.string_types):
+        return {size: sizes[size]}
+    return dict((name, sizes[name]) for name in size)
+
+
+def decode(data, specs):
+    """Decode the source once, at the smallest scale all specs can use.
+
+    JPEG sources much larger than the biggest spec are decoded in draft mode,
+    which lets libjpeg downscale by up to 8x while decoding, so a 50MP
+    source never materialises at full resolution. Other formats are
+    decoded in full, so they are refused above ``IMAGE_DECODE_MAX_PIXELS``.
+    """
+    from PIL import Image
+    im = Image.open(data if hasattr(data, 'read') else io.BytesIO(data))
+    check_decode_size(im)
+    max_w = max(w for w, h, mode in specs.values())
+    max_h = max(h for w, h, mode in specs.values())
+    if im.format == 'JPEG' and im.size[0] >= 2 * max_w and im.size[1] >= 2 * max_h:
+        im.draft('RGB', (max_w, max_h))
+    im.load()
+    if im.mode not in ('RGB', 'RGBA', 'L'):
+        im = im.convert('RGBA' if 'transparency' in im.info else 'RGB')
+    return im
+
+
+def render(im, width, height, mode='fit'):
+    from PIL import Image, ImageOps
+    if mode == 'crop':
+        return ImageOps.fit(im, (width, height), Image.ANTIALIAS)
+    ratio = min(float(width) / im.size[0], float(height) / im.size[1], 1.0)
+    size = (max(1, int(im.size[0] * ratio)), max(1, int(im.size[1] * ratio)))
+    return im.resize(size, Image.ANTIALIAS)
+
+
+def output_ext(ext):
+    """Extension of the thumbnail for a source with extension ``ext``;
+    formats Pillow isn't asked to write, like GIF, become PNG."""
+    return ext if ext.lower() in PIL_FORMATS else 'png'
+
+
+def encode(im, ext):
+    fmt = PIL_FORMATS[output_ext(ext).lower()]
+    if fmt == 'JPEG' and im.mode != 'RGB':
+        im = im.convert('RGB')
+    output = io.BytesIO()
+    im.save(output, format=fmt, quality=getattr(settings, 'THUMBNAIL_QUALITY', 85),
+            optimize=True)
+    return output, fmt
+
+
+def generate(data, specs, ext):
+    """Render every spec from one decode; returns ``{name: (buffer, format)}``."""
+    im = decode(data, specs)
+    return dict((name, encode(render(im, w, h, mode), ext))
+                for name, (w, h, mode) in specs.items())
+
+
+def manifest_spec(name, spec, ext):
+    width, height, mode = spec
+    spec = 'thumbnail_{}:{}x{}:{}:q{}'.format(
+        name, width, height, mode, getattr(settings, 'THUMBNAIL_QUALITY', 85))
+    # Converted thumbnails used to be stored under the source's extension.
+    return spec if output_ext(ext) == ext else '{}:{}'.format(spec, output_ext(ext))
+
+
+def targets(url, size=None):
+    """``{manifest spec: key}`` of the thumbnails of ``url``; ``size`` as
+    for :func:`get_specs`."""
+    ext = url.split('.')[-1]
+    return dict((manifest_spec(name, spec, ext),
+                 derivative_path(url, 'thumbnail_{}'.format(name), output_ext(ext)))
+                for name, spec in get_specs(size).items())
+
+
+def make_thumbnails(instance, size=None, fetched=None):
+    """Generate, upload and record thumbnails for ``instance.image``.
+
+    Sizes already in the derivative manifest are skipped. Renders and
+    uploads run concurrently; URLs are written to any ``<name>_thumbnail``
+    fields (see ``THUMBNAIL_FIELD``) in a single UPDATE.
+
+    :param fetched: a :class:`~.fetch.SharedFetch` of the source, as for
+        :func:`~.compression.compress`.
+    :return: dict of spec name to URL.
+    """
+    specs = get_specs(size)
+    ext = instance.image.split('.')[-1]
+    names = dict((manifest_spec(name, spec, ext), name) for name, spec in specs.items())
+    with Derivatives(instance.image, targets(instance.image, specs),
+                     fetched=fetched) as derivatives:
+        missing = derivatives.resolve()
+
+        if missing:
+            pending = dict((names[key], specs[names[key]]) for key in missing)
+            im = decode(derivatives.data, pending)
+
+            def work(item):
+                key, path = item
+                w, h, mode = specs[names[key]]
+                output, fmt = encode(render(im, w, h, mode), ext)
+                s3.upload(output, path, content_type=CONTENT_TYPES.get(fmt))
+
+            workers = min(len(missing), getattr(settings, 'THUMBNAIL_WORKERS', 4))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(work, missing.items()))
+            derivatives.done(missing)
+
+    paths = dict((names[key], path) for key, path in derivatives.found.items())
+
+    resolved = s3.resolve_urls(paths.values())
+    urls = dict((name, resolved[path]) for name, path in paths.items())
+
+    field_format = getattr(settings, 'THUMBNAIL_FIELD', '{name}_thumbnail')
+    model = type(instance)
+    attnames = set(f.attname for f in model._meta.concrete_fields)
+    fields = {}
+    for name, url in urls.items():
+        field = field_format.format(name=name)
+        if field in attnames:
+            fields[field] = url
+            setattr(instance, field, url)
+    if fields and instance.pk is not None:
+        # queryset.update() skips post_save, so signal handlers calling
+        # make_thumbnail don't recurse.
+        model._default_manager.filter(pk=instance.pk).update(**fields)
+    return urls
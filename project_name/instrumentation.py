@@ -0,0 +1,237 @@
+import time
+import atexit
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.six.moves.urllib import parse as urlparse
+
+from .redis_utils import HashCounters, get_redis
+
+INDEX_KEY = 'instr:index'
+
+# Log-linear buckets over microseconds: 8 sub-buckets per power of two, so a
+# recorded value is never more than 12.5% off, HDR-histogram style.
+SUB_BUCKETS = 8
+
+
+def bucket_index(us):
+    if us < SUB_BUCKETS:
+        return us
+    shift = us.bit_length() - 4
+    return (shift + 1) * SUB_BUCKETS + ((us >> shift) & (SUB_BUCKETS - 1))
+
+
+def bucket_value(index):
+    """Upper bound, in microseconds, of the bucket at ``index``."""
+    if index < SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return ((SUB_BUCKETS + index % SUB_BUCKETS + 1) << shift) - 1
+
+
+class Recorder(object):
+    """Per-process latency histograms, flushed into Redis hashes.
+
+    ``record`` only touches in-process counters; every
+    ``INSTRUMENTATION_FLUSH_INTERVAL`` seconds one pipelined HINCRBY batch
+    folds them into ``instr:<provider>:<endpoint>`` so every web and
+    worker process aggregates into the same histograms. Hashes nobody
+    records into for ``INSTRUMENTATION_TTL`` seconds expire.
+    """
+
+    def __init__(self, flush_interval=None):
+        self.counters = HashCounters(
+            'outbound call',
+            flush_interval if flush_interval is not None else getattr(
+                settings, 'INSTRUMENTATION_FLUSH_INTERVAL', 10),
+            index=INDEX_KEY,
+            ttl=getattr(settings, 'INSTRUMENTATION_TTL', 7 * 24 * 3600))
+        # Called as listener(provider, endpoint, seconds) for every record.
+        self.listeners = []
+
+    def record(self, provider, endpoint, seconds, ok=True, bytes_in=0, bytes_out=0):
+        us = int(seconds * 1000000)
+        self.counters.add('instr:{}:{}'.format(provider, endpoint), {
+            'b{}'.format(bucket_index(us)): 1,
+            'count': 1,
+            'errors': 0 if ok else 1,
+            'total_us': us,
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+        })
+        for listener in self.listeners:
+            listener(provider, endpoint, seconds)
+        self.counters.maybe_flush()
+
+    def flush(self):
+        self.counters.flush()
+
+
+recorder = Recorder()
+atexit.register(recorder.flush)
+
+
+@contextmanager
+def timed(provider, endpoint, bytes_out=0):
+    """Record the enclosed call; exceptions count as errors and propagate."""
+    started = time.time()
+    ok = True
+    try:
+        yield
+    except Exception:
+        ok = False
+        raise
+    finally:
+        recorder.record(provider, endpoint, time.time() - started, ok, 0, bytes_out)
+
+
+def instrument_session(session, provider, endpoint=None):
+    """Record every request made through a ``requests.Session``.
+
+    Calls are labelled by method and ``endpoint``, or the URL's host when
+    it isn't given; never by path, which would make a series per URL.
+    """
+    request = session.request
+
+    def instrumented(method, url, *args, **kwargs):
+        label = '{} {}'.format(method.upper(), endpoint or urlparse.urlsplit(url).netloc)
+        started = time.time()
+        try:
+            response = request(method, url, *args, **kwargs)
+        except Exception:
+            recorder.record(provider, label, time.time() - started, False)
+            raise
+        body = response.request.body
+        recorder.record(
+            provider, label, time.time() - started, response.status_code < 400,
+            int(response.headers.get('Content-Length') or 0),
+            len(body) if isinstance(body, (bytes, str)) else 0,
+        )
+        return response
+
+    session.request = instrumented
+    return session
+
+
+def instrument_boto3(client, provider):
+    """Record every API call made through a boto3 client."""
+    service = client.meta.service_model.service_name
+
+    def before_call(model, params, context, **kwargs):
+        context['instr_started'] = time.time()
+        body = params.get('body')
+        context['instr_bytes_out'] = len(body) if isinstance(body, (bytes, str)) else 0
+
+    def after_call(http_response, parsed, model, context, **kwargs):
+        started = context.get('instr_started')
+        if started is None:
+            return
+        status = parsed.get('ResponseMetadata', {}).get('HTTPStatusCode', 200)
+        recorder.record(
+            provider, model.name, time.time() - started, status < 400,
+            int(http_response.headers.get('Content-Length') or 0) if http_response is not None else 0,
+            context.get('instr_bytes_out', 0),
+        )
+
+    def after_call_error(model, context, **kwargs):
+        started = context.get('instr_started')
+        if started is not None:
+            recorder.record(provider, model.name, time.time() - started, False)
+
+    client.meta.events.register('before-call.{}'.format(service), before_call)
+    client.meta.events.register('after-call.{}'.format(service), after_call)
+    client.meta.events.register('after-call-error.{}'.format(service), after_call_error)
+    return client
+
+
+def snapshot():
+    """Aggregated stats from Redis: ``{(provider, endpoint): summary}``."""
+    client = get_redis()
+    if client is None:
+        return {}
+    index = cache.make_key(INDEX_KEY)
+    summaries = {}
+    for key in sorted(client.smembers(index)):
+        key = key.decode('utf-8') if isinstance(key, bytes) else key
+        raw = client.hgetall(cache.make_key(key))
+        if not raw:
+            # Expired.
+            client.srem(index, key)
+            continue
+        fields = dict(((k.decode('utf-8') if isinstance(k, bytes) else k), int(v))
+                      for k, v in raw.items())
+        buckets = sorted((int(k[1:]), n) for k, n in fields.items() if k[0] == 'b' and k[1:].isdigit())
+        provider, endpoint = key[len('instr:'):].split(':', 1)
+        summaries[(provider, endpoint)] = summarize(fields, buckets)
+    return summaries
+
+
+def summarize(fields, buckets):
+    count = fields.get('count', 0)
+    summary = {
+        'count': count,
+        'errors': fields.get('errors', 0),
+        'bytes_in': fields.get('bytes_in', 0),
+        'bytes_out': fields.get('bytes_out', 0),
+        'total_us': fields.get('total_us', 0),
+        'mean_ms': fields.get('total_us', 0) / 1000.0 / count if count else 0.0,
+        'buckets': buckets,
+    }
+    for name, q in (('p50_ms', 0.5), ('p90_ms', 0.9), ('p99_ms', 0.99), ('max_ms', 1.0)):
+        target = q * count
+        seen = 0
+        value = 0
+        for index, n in buckets:
+            seen += n
+            value = bucket_value(index)
+            if seen >= target:
+                break
+        summary[name] = value / 1000.0
+    return summary
+
+
+def reset():
+    client = get_redis()
+    if client is None:
+        return
+    index = cache.make_key(INDEX_KEY)
+    keys = [cache.make_key(key.decode('utf-8') if isinstance(key, bytes) else key)
+            for key in client.smembers(index)]
+    if keys:
+        client.delete(*keys)
+    client.delete(index)
+
+
+def sample(name, labels, value):
+    """One exposition line. Braces are concatenated rather than escaped by
+    doubling, which ``startproject`` would try to render as a variable."""
+    return name + '{' + labels + '} ' + str(value)
+
+
+def prometheus(summaries=None):
+    """Render ``snapshot()`` in the Prometheus text exposition format."""
+    summaries = snapshot() if summaries is None else summaries
+    lines = [
+        '# TYPE outbound_request_duration_seconds histogram',
+        '# TYPE outbound_request_errors_total counter',
+        '# TYPE outbound_bytes_in_total counter',
+        '# TYPE outbound_bytes_out_total counter',
+    ]
+    for (provider, endpoint), summary in sorted(summaries.items()):
+        labels = 'provider="{}",endpoint="{}"'.format(
+            provider, endpoint.replace('\\', '\\\\').replace('"', '\\"'))
+        seen = 0
+        for index, n in summary['buckets']:
+            seen += n
+            lines.append(sample('outbound_request_duration_seconds_bucket',
+                                labels + ',le="{}"'.format(bucket_value(index) / 1000000.0), seen))
+        lines.append(sample('outbound_request_duration_seconds_bucket', labels + ',le="+Inf"',
+                            summary['count']))
+        lines.append(sample('outbound_request_duration_seconds_sum', labels,
+                            summary['total_us'] / 1000000.0))
+        lines.append(sample('outbound_request_duration_seconds_count', labels, summary['count']))
+        lines.append(sample('outbound_request_errors_total', labels, summary['errors']))
+        lines.append(sample('outbound_bytes_in_total', labels, summary['bytes_in']))
+        lines.append(sample('outbound_bytes_out_total', labels, summary['bytes_out']))
+    return '\n'.join(lines) + '\n'
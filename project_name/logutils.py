@@ -0,0 +1,216 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import atexit
+import logging
+import threading
+
+from django.utils.six.moves import queue
+
+_local = threading.local()
+
+# Attributes every LogRecord has; anything else was passed in ``extra``.
+RESERVED = frozenset((
+    'args', 'asctime', 'created', 'exc_info', 'exc_text', 'filename', 'funcName',
+    'levelname', 'levelno', 'lineno', 'message', 'module', 'msecs', 'msg', 'name',
+    'pathname', 'process', 'processName', 'relativeCreated', 'stack_info', 'thread',
+    'threadName', 'request_id', 'suppressed', 'taskName',
+))
+
+REQUEST_ID_RE = re.compile(r'^[\w.:-]{1,200}$')
+
+
+def get_request_id():
+    return getattr(_local, 'request_id', None)
+
+
+class RequestIDMiddleware(object):
+    """Tag the request, its log records and its response with one id.
+
+    Heroku's router already sends ``X-Request-ID``; it is reused when it
+    looks sane so router and application logs line up.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request_id = request.META.get('HTTP_X_REQUEST_ID', '')
+        if not REQUEST_ID_RE.match(request_id):
+            request_id = uuid.uuid4().hex
+        request.request_id = _local.request_id = request_id
+        try:
+            response = self.get_response(request)
+        finally:
+            _local.request_id = None
+        response['X-Request-ID'] = request_id
+        return response
+
+
+class ContextFilter(logging.Filter):
+    """Set ``record.request_id``: the current request's id, else ``job:<id>``
+    inside an RQ job."""
+
+    def filter(self, record):
+        request_id = get_request_id()
+        if request_id is None:
+            # Only a worker has rq loaded, and only inside a job is there a
+            # current one; the web process never asks.
+            rq = sys.modules.get('rq')
+            try:
+                job = rq.get_current_job() if rq is not None else None
+            except Exception:
+                job = None
+            request_id = 'job:{}'.format(job.id) if job is not None else None
+        record.request_id = request_id
+        return True
+
+
+class DuplicateFilter(logging.Filter):
+    """Let identical messages through at most ``burst`` times per ``window``
+    seconds; the next one let through carries ``suppressed``, the count
+    dropped in between."""
+
+    def __init__(self, burst=10, window=60, max_keys=10000):
+        super(DuplicateFilter, self).__init__()
+        self.burst = burst
+        self.window = window
+        self.max_keys = max_keys
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        # Merged once here, so neither the key nor the formatter redo it.
+        record.msg = record.getMessage()
+        record.args = None
+        key = (record.name, record.levelno, record.pathname, record.lineno, record.msg)
+        now = time.time()
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry is None or now - entry[0] > self.window:
+                if len(self._seen) >= self.max_keys:
+                    self._seen.clear()
+                if entry is not None and entry[2]:
+                    record.suppressed = entry[2]
+                self._seen[key] = [now, 1, 0]
+                return True
+            entry[1] += 1
+            if entry[1] > self.burst:
+                entry[2] += 1
+                return False
+            return True
+
+
+class JSONFormatter(logging.Formatter):
+    """One compact JSON object per line, ``extra`` fields included."""
+
+    def format(self, record):
+        data = {
+            'ts': '{}.{:03d}Z'.format(
+                time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)), int(record.msecs)),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+            'pid': record.process,
+        }
+        suppressed = getattr(record, 'suppressed', None)
+        if suppressed:
+            data['suppressed'] = suppressed
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        for key, value in record.__dict__.items():
+            if key not in RESERVED and key not in data:
+                data[key] = value
+        return json.dumps(data, separators=(',', ':'), default=str)
+
+
+class AsyncStreamHandler(logging.Handler):
+    """A stream handler whose writes happen on a background thread.
+
+    ``emit`` merges the message and renders any traceback in the calling
+    thread, so the record no longer refers to mutable state, then puts it
+    on a bounded queue without blocking. Formatting and I/O happen on one
+    writer thread per process. When the queue is full, records are dropped
+    and counted rather than stalling a request.
+    """
+
+    def __init__(self, stream=None, maxsize=10000):
+        super(AsyncStreamHandler, self).__init__()
+        self.stream = stream or sys.stderr
+        self.maxsize = maxsize
+        self.queue = None
+        self.dropped = 0
+        self._pid = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def _ensure_writer(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # A forked child gets the parent's queue but not its thread.
+            self.queue = queue.Queue(self.maxsize)
+            self.dropped = 0
+            self._thread = threading.Thread(target=self._write, args=(self.queue,),
+                                            name='log-writer')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def emit(self, record):
+        try:
+            self._ensure_writer()
+            if record.args:
+                record.msg = record.getMessage()
+                record.args = None
+            if record.exc_info:
+                record.exc_text = self.format_exception(record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def format_exception(self, exc_info):
+        return (self.formatter or logging.Formatter()).formatException(exc_info)
+
+    def _write(self, records):
+        while True:
+            record = records.get()
+            try:
+                if record is None:
+                    return
+                self.stream.write(self.format(record) + '\n')
+                if self.dropped:
+                    dropped, self.dropped = self.dropped, 0
+                    self.stream.write(json.dumps({
+                        'level': 'WARNING', 'logger': __name__, 'pid': os.getpid(),
+                        'msg': 'Log queue full; dropped {} records'.format(dropped),
+                    }, separators=(',', ':')) + '\n')
+                if records.empty():
+                    self.stream.flush()
+            except Exception:
+                self.handleError(record)
+            finally:
+                records.task_done()
+
+    def flush(self):
+        """Block until this process's queued records are written."""
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        self.flush()
+        if self._pid == os.getpid() and self._thread is not None:
+            self.queue.put(None)
+        super(AsyncStreamHandler, self).close()
@@ -0,0 +1,185 @@
+import os
+import time
+import smtplib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.backends.smtp import EmailBackend as SMTPBackend
+from django.utils.six.moves import queue
+
+
+class ConnectionPool(object):
+    """A LIFO pool of open SMTP backends, so the warmest connection is reused.
+
+    Connections idle for longer than ``check_after`` seconds are probed with
+    a NOOP before use and reopened if the server has dropped them.
+    """
+
+    def __init__(self, size, factory, check_after=30):
+        self.size = size
+        self.factory = factory
+        self.check_after = check_after
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def get(self, timeout=None):
+        """Check out a connected backend, waiting up to ``timeout`` seconds.
+
+        :raises smtplib.SMTPException: if none is free in time, or the
+            connection can't be (re)opened. The pool slot is kept either way.
+        """
+        try:
+            backend, last_used = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                grow = self._created < self.size
+                if grow:
+                    self._created += 1
+            if grow:
+                try:
+                    backend = self.factory()
+                    backend.open()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+                return backend
+            try:
+                backend, last_used = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                raise smtplib.SMTPException(
+                    'No pooled SMTP connection free after {}s'.format(timeout))
+
+        try:
+            if backend.connection is None:
+                backend.open()
+            elif time.time() - last_used > self.check_after:
+                try:
+                    backend.connection.noop()
+                except (smtplib.SMTPException, AttributeError, OSError):
+                    backend.close()
+                    backend.open()
+        except Exception:
+            # Back in the pool disconnected; the next checkout reopens it.
+            backend.close()
+            self.put(backend)
+            raise
+        return backend
+
+    def put(self, backend):
+        self._idle.put((backend, time.time()))
+
+
+_lock = threading.Lock()
+_pools = {}
+
+
+def get_pool(host, port, username, password, use_tls, use_ssl, timeout):
+    key = (os.getpid(), host, port, username)
+    pool = _pools.get(key)
+    if pool is None:
+        with _lock:
+            pool = _pools.get(key)
+            if pool is None:
+                # Sockets must not be shared across a fork.
+                for stale in [k for k in _pools if k[0] != os.getpid()]:
+                    del _pools[stale]
+
+                def factory():
+                    return SMTPBackend(
+                        host=host, port=port, username=username, password=password,
+                        use_tls=use_tls, use_ssl=use_ssl, timeout=timeout,
+                        fail_silently=False,
+                    )
+
+                pool = _pools[key] = ConnectionPool(
+                    getattr(settings, 'EMAIL_POOL_SIZE', 4), factory,
+                    getattr(settings, 'EMAIL_POOL_CHECK_AFTER', 30))
+    return pool
+
+
+class PooledEmailBackend(BaseEmailBackend):
+    """SMTP backend that keeps authenticated connections open per worker.
+
+    Django's SMTP backend connects, authenticates and quits around every
+    ``send_mail``; this one borrows a connection from a per-process pool and
+    sends every message in the call over it. If the server drops the
+    connection mid-batch, only the messages not yet sent are retried.
+    """
+
+    def __init__(self, host=None, port=None, username=None, password=None,
+                 use_tls=None, use_ssl=None, timeout=None, **kwargs):
+        super(PooledEmailBackend, self).__init__(**kwargs)
+        self.pool = get_pool(
+            host or settings.EMAIL_HOST,
+            port or settings.EMAIL_PORT,
+            settings.EMAIL_HOST_USER if username is None else username,
+            settings.EMAIL_HOST_PASSWORD if password is None else password,
+            settings.EMAIL_USE_TLS if use_tls is None else use_tls,
+            settings.EMAIL_USE_SSL if use_ssl is None else use_ssl,
+            settings.EMAIL_TIMEOUT if timeout is None else timeout,
+        )
+
+    def send_messages(self, email_messages):
+        email_messages = list(email_messages)
+        if not email_messages:
+            return 0
+        backend = self.pool.get(getattr(settings, 'EMAIL_POOL_TIMEOUT', 30))
+        sent = index = 0
+        reconnected = False
+        try:
+            while index < len(email_messages):
+                try:
+                    sent += backend.send_messages(email_messages[index:index + 1])
+                except smtplib.SMTPServerDisconnected:
+                    if reconnected:
+                        raise
+                    # The server hung up between the health check and the
+                    # send: reconnect and carry on from the unsent message.
+                    reconnected = True
+                    backend.close()
+                    backend.open()
+                    continue
+                reconnected = False
+                index += 1
+        except Exception:
+            # Reopened on next checkout.
+            backend.close()
+            if not self.fail_silently:
+                raise
+        finally:
+            self.pool.put(backend)
+        return sent
+
+
+def send_bulk(subject, body, recipients, from_email=None, chunk_size=None, connection=None):
+    """Send one message per recipient, a chunk per pooled connection.
+
+    Chunks are sent concurrently, up to ``EMAIL_POOL_SIZE`` at a time.
+
+    :return: number of messages sent.
+    """
+    connection = connection or PooledEmailBackend()
+    chunk_size = chunk_size or getattr(settings, 'EMAIL_BULK_CHUNK_SIZE', 100)
+    recipients = list(recipients)
+    chunks = [recipients[i:i + chunk_size] for i in range(0, len(recipients), chunk_size)]
+
+    def send_chunk(chunk):
+        return connection.send_messages([
+            EmailMessage(subject, body, from_email, [recipient]) for recipient in chunk
+        ])
+
+    workers = min(len(chunks), getattr(settings, 'EMAIL_POOL_SIZE', 4)) or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(send_chunk, chunks))
+
+
+def send_bulk_async(subject, body, recipients, from_email=None, chunk_size=None):
+    """Queue ``send_bulk`` on the default RQ queue."""
+    import django_rq
+    return django_rq.enqueue(send_bulk, subject, body, list(recipients),
+                             from_email, chunk_size)
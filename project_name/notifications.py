@@ -0,0 +1,171 @@
+import os
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import simplejson as json
+from django.conf import settings
+
+from . import ratelimit
+from .instrumentation import instrument_session
+
+
+ONE_SIGNAL_URL = getattr(
+    settings, 'ONE_SIGNAL_API_URL', 'https://onesignal.com/api/v1/notifications')
+
+# OneSignal caps include_player_ids at 2000 entries per call.
+MAX_PLAYER_IDS = 2000
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+TARGET_KEYS = ('included_segments', 'include_player_ids')
+
+
+class OneSignalDispatcher(object):
+    """Sends OneSignal notifications over a pooled keep-alive session.
+
+    The session and thread pool are created lazily and rebuilt after a fork,
+    so the dispatcher is safe to create at import time under
+    ``gunicorn --preload``.
+    """
+
+    def __init__(self, url=None, pool_size=None, max_retries=None,
+                 backoff=None, max_backoff=None, timeout=None, rate_limit=None):
+        self.url = url or ONE_SIGNAL_URL
+        self.pool_size = pool_size or getattr(settings, 'ONE_SIGNAL_POOL_SIZE', 4)
+        self.max_retries = max_retries if max_retries is not None else getattr(
+            settings, 'ONE_SIGNAL_MAX_RETRIES', 3)
+        self.backoff = backoff if backoff is not None else getattr(
+            settings, 'ONE_SIGNAL_BACKOFF', 0.2)
+        self.max_backoff = max_backoff if max_backoff is not None else getattr(
+            settings, 'ONE_SIGNAL_MAX_BACKOFF', 2.0)
+        self.timeout = timeout or getattr(settings, 'ONE_SIGNAL_TIMEOUT', 5)
+        self.rate_limit = rate_limit or getattr(settings, 'ONE_SIGNAL_RATE_LIMIT', (10, 20))
+        self._lock = threading.Lock()
+        self._pid = None
+        self._session = None
+        self._executor = None
+
+    def _setup(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({
+                'Content-Type': 'application/json; charset=utf-8',
+                'Authorization': 'Basic {}'.format(settings.ONE_SIGNAL_REST_KEY),
+            })
+            self._session = instrument_session(session, 'onesignal')
+            self._executor = ThreadPoolExecutor(max_workers=self.pool_size)
+            self._pid = os.getpid()
+
+    def _sleep(self, attempt):
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def send(self, payload):
+        """POST a single payload, retrying transient failures.
+
+        :param dict payload: OneSignal notification body.
+        :return: the final ``requests.Response``.
+        """
+        import requests
+        self._setup()
+        body = json.dumps(payload)
+        attempt = 0
+        while True:
+            ratelimit.bucket('onesignal', *self.rate_limit).acquire(timeout=self.timeout)
+            try:
+                response = self._session.post(
+                    self.url, data=body, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    return response
+            self._sleep(attempt)
+            attempt += 1
+
+    def send_many(self, payloads, return_exceptions=False):
+        """Send several payloads concurrently and return responses in order.
+
+        :param bool return_exceptions: put a send's exception in its slot
+            instead of raising it, so one failure doesn't hide the rest.
+        """
+        self._setup()
+        send = self.send
+        if return_exceptions:
+            def send(payload):
+                try:
+                    return self.send(payload)
+                except Exception as e:
+                    return e
+        payloads = list(payloads)
+        if len(payloads) == 1:
+            return [send(payloads[0])]
+        return list(self._executor.map(send, payloads))
+
+    def send_batch(self, payloads):
+        """Merge compatible payloads and send the fewest calls possible."""
+        return self.send_many(merge_payloads(payloads))
+
+
+def payload_key(payload):
+    """Everything but the targeting; payloads with equal keys can be merged."""
+    body = dict((k, v) for k, v in payload.items() if k not in TARGET_KEYS)
+    return json.dumps(body, sort_keys=True)
+
+
+def merge_payloads(payloads):
+    """Collapse payloads that differ only in their targeting.
+
+    Payloads sharing every field except ``included_segments`` and
+    ``include_player_ids`` are merged into one, with segment lists unioned and
+    player ids chunked to OneSignal's per-call limit.
+
+    :param list payloads: OneSignal notification bodies.
+    :return: list of merged payloads, in first-seen order.
+    """
+    groups = {}
+    order = []
+    for payload in payloads:
+        key = (payload_key(payload), 'include_player_ids' in payload)
+        if key not in groups:
+            body = dict((k, v) for k, v in payload.items() if k not in TARGET_KEYS)
+            groups[key] = (body, [], set())
+            order.append(key)
+        merged, player_ids, seen = groups[key]
+        for segment in payload.get('included_segments', ()):
+            segments = merged.setdefault('included_segments', [])
+            if segment not in segments:
+                segments.append(segment)
+        for player_id in payload.get('include_player_ids', ()):
+            if player_id not in seen:
+                seen.add(player_id)
+                player_ids.append(player_id)
+
+    merged_payloads = []
+    for key in order:
+        merged, player_ids, _ = groups[key]
+        if not player_ids:
+            merged_payloads.append(merged)
+            continue
+        for start in range(0, len(player_ids), MAX_PLAYER_IDS):
+            chunk = dict(merged)
+            chunk['include_player_ids'] = player_ids[start:start + MAX_PLAYER_IDS]
+            merged_payloads.append(chunk)
+    return merged_payloads
+
+
+dispatcher = OneSignalDispatcher()
@@ -0,0 +1,255 @@
+import re
+import time
+import random
+import logging
+import threading
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache, caches
+
+from .dbwrappers import add_execute_wrapper
+from .instrumentation import recorder
+from .redis_utils import HashCounters, get_redis
+
+logger = logging.getLogger(__name__)
+
+INDEX_KEY = 'prof:index'
+
+# Query shape: literals and IN lists collapsed, so the same query for a
+# different row matches.
+SHAPE_PATTERNS = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\((?:\s*(?:%s|\?)\s*,)+\s*(?:%s|\?)\s*\)'), '(...)'),
+)
+
+_local = threading.local()
+
+
+def query_shape(sql):
+    for pattern, replacement in SHAPE_PATTERNS:
+        sql = pattern.sub(replacement, sql)
+    return sql
+
+
+class Profile(object):
+    """What one sampled request spent its time on."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.wall = 0.0
+        self.db_count = 0
+        self.db_time = 0.0
+        self.cache_count = 0
+        self.cache_time = 0.0
+        self.http_count = 0
+        self.http_time = 0.0
+        self.shapes = {}
+
+    def repeated(self, threshold):
+        """Query shapes run at least ``threshold`` times: likely N+1s."""
+        return dict((shape, n) for shape, n in self.shapes.items() if n >= threshold)
+
+    def server_timing(self):
+        return ', '.join([
+            'db;dur={:.1f};desc="{} queries"'.format(self.db_time * 1000, self.db_count),
+            'cache;dur={:.1f};desc="{} round trips"'.format(self.cache_time * 1000, self.cache_count),
+            'http;dur={:.1f};desc="{} calls"'.format(self.http_time * 1000, self.http_count),
+            'total;dur={:.1f}'.format(self.wall * 1000),
+        ])
+
+
+def current():
+    return getattr(_local, 'profile', None)
+
+
+def profile_queries(execute, sql, params, many, context):
+    profile = current()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.time()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.db_time += time.time() - started
+        profile.db_count += 1
+        shape = query_shape(sql)
+        profile.shapes[shape] = profile.shapes.get(shape, 0) + 1
+
+
+def note_outbound(provider, endpoint, seconds):
+    profile = current()
+    # Queries are already timed by profile_queries.
+    if profile is not None and provider != 'db':
+        profile.http_count += 1
+        profile.http_time += seconds
+
+
+def _timed_checkout(get_connection):
+    @wraps(get_connection)
+    def wrapper(*args, **kwargs):
+        connection = get_connection(*args, **kwargs)
+        if current() is not None:
+            _local.checked_out = time.time()
+        return connection
+    return wrapper
+
+
+def _timed_release(release):
+    @wraps(release)
+    def wrapper(connection):
+        started = getattr(_local, 'checked_out', None)
+        profile = current()
+        if started is not None and profile is not None:
+            profile.cache_count += 1
+            profile.cache_time += time.time() - started
+        _local.checked_out = None
+        return release(connection)
+    return wrapper
+
+
+def instrument_cache(alias='default'):
+    """Time Redis round trips made through the cache ``alias``.
+
+    A command or pipeline holds a pooled connection from sending until its
+    reply is read, so checkout to release is one round trip. Only the
+    pools behind this cache are wrapped; every other Redis user in the
+    process is left alone.
+    """
+    backend = caches[alias]
+    clients = list(getattr(backend, 'clients', {}).values()) or [get_redis(alias)]
+    for client in clients:
+        pool = getattr(client, 'connection_pool', None)
+        if pool is not None:
+            instrument_pool(pool)
+
+
+def instrument_pool(pool):
+    """Count and time checkouts from a redis-py connection pool; idempotent."""
+    if getattr(pool, 'profiled', False):
+        return
+    pool.get_connection = _timed_checkout(pool.get_connection)
+    pool.release = _timed_release(pool.release)
+    pool.profiled = True
+
+
+def install():
+    """Hook queries, cache round trips and outbound calls; idempotent."""
+    if getattr(install, 'done', False):
+        return
+    add_execute_wrapper(profile_queries)
+    recorder.listeners.append(note_outbound)
+    instrument_cache()
+    install.done = True
+
+
+class Aggregator(object):
+    """Per-process sums by endpoint, folded into ``prof:<endpoint>`` hashes.
+
+    Repeated query shapes go to ``prof:nplusone:<endpoint>``, counting how
+    many sampled requests repeated each.
+    """
+
+    def __init__(self, flush_interval=10):
+        self.totals = HashCounters('profiler', flush_interval, index=INDEX_KEY)
+        self.shapes = HashCounters('profiler N+1', flush_interval)
+
+    def add(self, endpoint, profile, repeated):
+        self.totals.add('prof:{}'.format(endpoint), {
+            'samples': 1,
+            'wall_us': int(profile.wall * 1000000),
+            'db_count': profile.db_count,
+            'db_us': int(profile.db_time * 1000000),
+            'cache_count': profile.cache_count,
+            'cache_us': int(profile.cache_time * 1000000),
+            'http_count': profile.http_count,
+            'http_us': int(profile.http_time * 1000000),
+            'nplusone': 1 if repeated else 0,
+        })
+        if repeated:
+            self.shapes.add('prof:nplusone:{}'.format(endpoint), dict.fromkeys(repeated, 1))
+        self.totals.maybe_flush()
+        self.shapes.maybe_flush()
+
+    def flush(self):
+        self.totals.flush()
+        self.shapes.flush()
+
+
+aggregator = Aggregator()
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def snapshot():
+    """``{endpoint: {field: total, 'nplusone_shapes': {shape: n}}}`` from Redis."""
+    aggregator.flush()
+    client = get_redis()
+    if client is None:
+        return {}
+    result = {}
+    for key in client.smembers(cache.make_key(INDEX_KEY)):
+        endpoint = _decode(key)[len('prof:'):]
+        fields = dict((_decode(k), int(v)) for k, v in
+                      client.hgetall(cache.make_key('prof:{}'.format(endpoint))).items())
+        fields['nplusone_shapes'] = dict(
+            (_decode(k), int(v)) for k, v in
+            client.hgetall(cache.make_key('prof:nplusone:{}'.format(endpoint))).items())
+        result[endpoint] = fields
+    return result
+
+
+def reset():
+    client = get_redis()
+    if client is None:
+        return
+    index = cache.make_key(INDEX_KEY)
+    keys = []
+    for key in client.smembers(index):
+        endpoint = _decode(key)[len('prof:'):]
+        keys.append(cache.make_key('prof:{}'.format(endpoint)))
+        keys.append(cache.make_key('prof:nplusone:{}'.format(endpoint)))
+    if keys:
+        client.delete(*keys)
+    client.delete(index)
+
+
+class ProfilerMiddleware(object):
+    """Profile a ``PROFILER_SAMPLE_RATE`` fraction of requests.
+
+    Unsampled requests cost one random number. Sampled ones count and time
+    their queries, Redis round trips and outbound provider calls, get a
+    ``Server-Timing`` header when ``PROFILER_SERVER_TIMING`` is on, and log
+    a warning for any query shape repeated ``PROFILER_NPLUSONE_THRESHOLD``
+    times. Totals per endpoint are flushed to Redis for ``profile_top``.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PROFILER_SAMPLE_RATE', 0.01)
+        self.threshold = getattr(settings, 'PROFILER_NPLUSONE_THRESHOLD', 5)
+        self.server_timing = getattr(settings, 'PROFILER_SERVER_TIMING', True)
+        install()
+
+    def __call__(self, request):
+        if random.random() >= self.sample_rate:
+            return self.get_response(request)
+        profile = _local.profile = Profile()
+        try:
+            response = self.get_response(request)
+        finally:
+            _local.profile = None
+        profile.wall = time.time() - profile.started
+
+        match = getattr(request, 'resolver_match', None)
+        endpoint = '{} {}'.format(request.method, match.view_name if match else 'unresolved')
+        repeated = profile.repeated(self.threshold)
+        for shape, n in repeated.items():
+            logger.warning('Possible N+1 in %s: %d x %s', endpoint, n, shape)
+        aggregator.add(endpoint, profile, repeated)
+        if self.server_timing:
+            response['Server-Timing'] = profile.server_timing()
+        return response
@@ -0,0 +1,151 @@
+import time
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .redis_utils import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Refill, take and report in one round trip. Timestamps come from the caller
+# so the script stays deterministic for replication.
+TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+    allowed = 1
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return {allowed, tostring(wait)}
+"""
+
+
+class RateLimited(Exception):
+
+    def __init__(self, name, wait):
+        super(RateLimited, self).__init__(
+            '{} rate limit exceeded, retry in {:.3f}s'.format(name, wait))
+        self.name = name
+        self.wait = wait
+
+
+class TokenBucket(object):
+    """A token bucket shared by every process through one Redis hash.
+
+    Tokens are leased from Redis ``lease`` at a time and handed out locally
+    until they run out or ``lease_ttl`` passes, so most calls never leave
+    the process. Unused leased tokens are simply dropped, which bounds the
+    overshoot to one lease per process. Without a Redis cache the bucket is
+    kept in-process.
+    """
+
+    def __init__(self, name, rate, capacity=None, lease=None, lease_ttl=1.0):
+        self.name = name
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        # A tenth of the burst: large enough to keep most calls local, small
+        # enough that every process dropping a lease stays within the burst.
+        self.lease = lease or max(1, int(self.capacity * 0.1))
+        self.lease_ttl = lease_ttl
+        self.key = cache.make_key('ratelimit:{}'.format(name))
+        self._local = 0
+        self._lease_expires = 0
+        self._lock = threading.Lock()
+        self._script = None
+        self._tokens = self.capacity
+        self._ts = time.time()
+
+    def _take_local(self, tokens):
+        with self._lock:
+            if self._local >= tokens and time.time() < self._lease_expires:
+                self._local -= tokens
+                return True
+        return False
+
+    def _take_shared(self, tokens):
+        now = time.time()
+        if self._script is None:
+            client = get_redis()
+            self._script = client.register_script(TOKEN_BUCKET) if client is not None else False
+        if self._script is False:
+            return self._take_process(tokens, now)
+        try:
+            allowed, wait = self._script(
+                keys=[self.key], args=[self.rate, self.capacity, now, tokens])
+        except Exception:
+            # Don't take the caller down with Redis; limit per process instead.
+            logger.exception('Rate limiter %s: Redis unavailable', self.name)
+            return self._take_process(tokens, now)
+        return bool(int(allowed)), float(wait)
+
+    def _take_process(self, tokens, now):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+            self._ts = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True, 0.0
+            return False, (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1, block=True, timeout=None):
+        """Take ``tokens``, waiting for them if ``block``.
+
+        :param float timeout: give up once the wait would pass this many seconds.
+        :raises RateLimited: when not blocking, or the timeout would be exceeded.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            if self._take_local(tokens):
+                return
+
+            lease = max(tokens, self.lease)
+            allowed, wait = self._take_shared(lease)
+            if allowed:
+                with self._lock:
+                    self._local = lease - tokens
+                    self._lease_expires = time.time() + self.lease_ttl
+                return
+            if lease > tokens:
+                allowed, wait = self._take_shared(tokens)
+                if allowed:
+                    return
+
+            if not block or (deadline is not None and time.time() + wait > deadline):
+                raise RateLimited(self.name, wait)
+            time.sleep(wait)
+
+
+_lock = threading.Lock()
+_buckets = {}
+
+
+def bucket(name, rate, capacity=None):
+    """The shared bucket for provider ``name``.
+
+    ``rate`` (tokens per second) and ``capacity`` are the provider's declared
+    budget; ``RATE_LIMITS[name] = (rate, capacity[, lease])`` overrides them
+    and optionally sets how many tokens a process leases at a time.
+    """
+    limiter = _buckets.get(name)
+    if limiter is None:
+        with _lock:
+            limiter = _buckets.get(name)
+            if limiter is None:
+                limits = tuple(getattr(settings, 'RATE_LIMITS', {}).get(name, (rate, capacity)))
+                rate, capacity, lease = (limits + (None,))[:3]
+                limiter = _buckets[name] = TokenBucket(name, rate, capacity, lease)
+    return limiter
@@ -0,0 +1,121 @@
+import os
+import time
+import logging
+import threading
+
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+
+def get_redis(alias='default'):
+    """Raw redis-py client behind a Redis cache backend.
+
+    Works with django-redis-cache (``redis_cache.RedisCache``) and
+    django-redis. Returns ``None`` when the cache is not Redis-backed, e.g.
+    the local-memory default in development.
+    """
+    backend = caches[alias]
+    if hasattr(backend, 'get_master_client'):
+        return backend.get_master_client()
+    if hasattr(backend, 'get_client'):
+        return backend.get_client(None, write=True)
+    client = getattr(backend, 'client', None)
+    if client is not None and hasattr(client, 'get_client'):
+        return client.get_client(write=True)
+    return None
+
+
+class HashCounters(object):
+    """Per-process counters folded into Redis hashes.
+
+    ``incr`` and ``set`` only touch in-process dicts. ``flush`` sends what
+    accumulated as one pipelined batch of HINCRBY (and HMSET for values
+    that overwrite), so every web and worker process adds into the same
+    hashes; ``maybe_flush`` does so at most every ``flush_interval``
+    seconds. Keys get the cache's ``KEY_PREFIX``. With ``index``, each key
+    is also added, unprefixed, to that set, and with ``ttl`` the hashes and
+    index expire once nothing writes to them.
+
+    Counts a fork inherits belong to the parent and are dropped, noticed by
+    pid since ``os.register_at_fork`` is Python 3.7+. A failed flush is
+    logged and its counts are lost.
+    """
+
+    def __init__(self, name, flush_interval=10, index=None, ttl=None, alias='default'):
+        self.name = name
+        self.flush_interval = flush_interval
+        self.index = index
+        self.ttl = ttl
+        self.alias = alias
+        self._counts = {}
+        self._values = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._last_flush = time.time()
+
+    def add(self, key, fields):
+        """Add each of ``fields`` (``{field: n}``) to the hash ``key``."""
+        if self._pid != os.getpid():
+            self.after_fork()
+        with self._lock:
+            counts = self._counts.setdefault(key, {})
+            for field, n in fields.items():
+                counts[field] = counts.get(field, 0) + n
+
+    def incr(self, key, field, n=1):
+        if self._pid != os.getpid():
+            self.after_fork()
+        with self._lock:
+            counts = self._counts.setdefault(key, {})
+            counts[field] = counts.get(field, 0) + n
+
+    def set(self, key, field, value):
+        """Overwrite ``field`` at the next flush rather than adding to it."""
+        if self._pid != os.getpid():
+            self.after_fork()
+        with self._lock:
+            self._values.setdefault(key, {})[field] = value
+
+    def maybe_flush(self):
+        if time.time() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._counts = {}
+        self._values = {}
+
+    def flush(self):
+        if self._pid != os.getpid():
+            self.after_fork()
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            values, self._values = self._values, {}
+            self._last_flush = time.time()
+        if not counts and not values:
+            return
+        client = get_redis(self.alias)
+        if client is None:
+            return
+        cache = caches[self.alias]
+        index = cache.make_key(self.index) if self.index else None
+        pipe = client.pipeline(transaction=False)
+        for key in set(counts) | set(values):
+            cache_key = cache.make_key(key)
+            for field, n in counts.get(key, {}).items():
+                if n:
+                    pipe.hincrby(cache_key, field, n)
+            if key in values:
+                pipe.hmset(cache_key, values[key])
+            if index:
+                pipe.sadd(index, key)
+            if self.ttl:
+                pipe.expire(cache_key, self.ttl)
+        if index and self.ttl:
+            pipe.expire(index, self.ttl)
+        try:
+            pipe.execute()
+        except Exception:
+            logger.exception('Could not flush %s counters to Redis', self.name)
@@ -0,0 +1,204 @@
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .dbwrappers import add_execute_wrapper
+from .instrumentation import recorder
+
+logger = logging.getLogger(__name__)
+
+# Postgres reports no replay timestamp progress while the primary is idle,
+# so a replica streaming from it that has replayed everything it received
+# counts as current. Once its WAL receiver stops streaming, receive and
+# replay positions agree however far behind it is, so only the age of the
+# last replayed transaction tells; NULL (nothing replayed yet) means unknown.
+LAG_SQL = """
+    SELECT CASE WHEN pg_last_xlog_receive_location() = pg_last_xlog_replay_location()
+                AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN 0
+           ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END
+"""
+LAG_SQL_10 = """
+    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+                AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN 0
+           ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END
+"""
+# Before 9.6 there is no pg_stat_wal_receiver to tell a streaming replica.
+LAG_SQL_95 = """
+    SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+"""
+
+_state = threading.local()
+
+
+def pin():
+    """Send this thread's reads to the primary until ``unpin``."""
+    _state.pinned = True
+
+
+def unpin():
+    _state.pinned = False
+
+
+def is_pinned():
+    return getattr(_state, 'pinned', False)
+
+
+@contextmanager
+def pinning_scope(pinned=False):
+    """Let writes pin this thread's reads to the primary until the block exits.
+
+    Outside any scope writes don't pin, so a thread never stays on the
+    primary for good. ``manage.py`` runs each command in a scope and
+    ``workers.PinningWorker`` each RQ job; other work that must read its own
+    writes runs inside ``pinning_scope`` or ``use_primary``.
+    """
+    saved = getattr(_state, 'scoped', False), is_pinned()
+    _state.scoped, _state.pinned = True, pinned
+    try:
+        yield
+    finally:
+        _state.scoped, _state.pinned = saved
+
+
+@contextmanager
+def use_primary():
+    pinned = is_pinned()
+    pin()
+    try:
+        yield
+    finally:
+        _state.pinned = pinned
+
+
+def replication_lag(alias, timeout=None):
+    """Seconds ``alias`` is behind its primary; 0 for non-Postgres databases.
+
+    ``None`` when Postgres can't tell. The check runs under a
+    ``statement_timeout`` of ``timeout`` seconds, so a stuck replica fails
+    it instead of holding up the request that happened to trigger it.
+    """
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0.0
+    if connection.pg_version >= 100000:
+        sql = LAG_SQL_10
+    elif connection.pg_version >= 90600:
+        sql = LAG_SQL
+    else:
+        sql = LAG_SQL_95
+    with connection.cursor() as cursor:
+        if timeout:
+            cursor.execute('SET statement_timeout = %s', [int(timeout * 1000)])
+        try:
+            cursor.execute(sql)
+            lag = cursor.fetchone()[0]
+        finally:
+            if timeout:
+                cursor.execute('RESET statement_timeout')
+    return None if lag is None else float(lag)
+
+
+def count_queries(execute, sql, params, many, context):
+    """Execute wrapper recording every query under ``db:<alias>``."""
+    started = time.time()
+    ok = True
+    try:
+        return execute(sql, params, many, context)
+    except Exception:
+        ok = False
+        raise
+    finally:
+        recorder.record('db', context['connection'].alias, time.time() - started, ok)
+
+
+class ReplicaRouter(object):
+    """Reads go to a random replica, writes and migrations to the primary.
+
+    Replicas are the ``DATABASES`` aliases starting with ``replica``. Once a
+    thread writes inside a ``pinning_scope`` (``PrimaryPinningMiddleware``
+    opens one per request), or while the primary has a transaction open,
+    its reads stay on the primary until the scope ends. Each process measures a replica's lag at most every
+    ``DATABASE_REPLICA_CHECK_INTERVAL`` seconds and skips it while the lag
+    exceeds ``DATABASE_REPLICA_MAX_LAG`` or the check fails or takes longer
+    than ``DATABASE_REPLICA_CHECK_TIMEOUT`` seconds.
+    """
+
+    def __init__(self):
+        self.replicas = sorted(alias for alias in settings.DATABASES if alias.startswith('replica'))
+        self.max_lag = getattr(settings, 'DATABASE_REPLICA_MAX_LAG', 5)
+        self.check_interval = getattr(settings, 'DATABASE_REPLICA_CHECK_INTERVAL', 5)
+        self.check_timeout = getattr(settings, 'DATABASE_REPLICA_CHECK_TIMEOUT', 0.5)
+        self._lag = {}
+        self._lock = threading.Lock()
+        add_execute_wrapper(count_queries)
+
+    def lag(self, alias):
+        """Last measured lag of ``alias``, re-measured when stale; ``None`` if down."""
+        checked, lag = self._lag.get(alias, (0, None))
+        if time.time() - checked < self.check_interval:
+            return lag
+        with self._lock:
+            checked, lag = self._lag.get(alias, (0, None))
+            if time.time() - checked < self.check_interval:
+                return lag
+            # Claim the check so concurrent threads keep the old reading.
+            self._lag[alias] = (time.time(), lag)
+        try:
+            lag = replication_lag(alias, self.check_timeout)
+        except Exception:
+            logger.warning('Replica %s failed its lag check', alias, exc_info=True)
+            lag = None
+        if lag is None or lag > self.max_lag:
+            logger.warning('Replica %s out of rotation (lag %s)', alias, lag)
+        self._lag[alias] = (time.time(), lag)
+        return lag
+
+    def healthy(self):
+        healthy = []
+        for alias in self.replicas:
+            lag = self.lag(alias)
+            if lag is not None and lag <= self.max_lag:
+                healthy.append(alias)
+        return healthy
+
+    def stats(self):
+        return dict((alias, self._lag.get(alias, (0, None))[1]) for alias in self.replicas)
+
+    def db_for_read(self, model, **hints):
+        if not self.replicas or is_pinned() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        healthy = self.healthy()
+        return random.choice(healthy) if healthy else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        if getattr(_state, 'scoped', False):
+            pin()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Every alias holds the same data.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class PrimaryPinningMiddleware(object):
+    """Scope primary pinning to a request.
+
+    Unsafe methods read from the primary throughout, since they usually
+    validate against the rows they are about to change.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with pinning_scope(request.method not in ('GET', 'HEAD', 'OPTIONS')):
+            return self.get_response(request)
+
@@ -0,0 +1,195 @@
+import io
+import os
+import time
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.six.moves.urllib.parse import quote
+
+from . import ratelimit
+from .instrumentation import instrument_boto3
+from .lru import LRUCache
+
+
+MB = 1024 * 1024
+
+URL_CACHE_PREFIX = 's3url:'
+
+_lock = threading.Lock()
+_clients = {}
+_urls = LRUCache(getattr(settings, 'S3_URL_CACHE_SIZE', 4096))
+
+
+def get_client():
+    """Return the S3 client for this process.
+
+    boto3 clients are thread-safe but must not cross a fork, so the cache is
+    keyed by pid: a client built in the gunicorn master under ``--preload``
+    is simply ignored by the workers, each of which builds its own once.
+    """
+    pid = os.getpid()
+    client = _clients.get(pid)
+    if client is None:
+        with _lock:
+            client = _clients.get(pid)
+            if client is None:
+                # boto3 and botocore take longer to import than the rest of
+                # the project together; only pay for them when S3 is used.
+                import boto3
+                from botocore.config import Config
+
+                _clients.clear()
+                session = boto3.session.Session(
+                    aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                    region_name=getattr(settings, 'S3DIRECT_REGION', None),
+                )
+                client = session.client('s3', config=Config(
+                    max_pool_connections=getattr(settings, 'AWS_S3_MAX_POOL_CONNECTIONS', 10),
+                ))
+                _clients[pid] = instrument_boto3(client, 's3')
+    return client
+
+
+def get_transfer_config():
+    from boto3.s3.transfer import TransferConfig
+    concurrency = getattr(settings, 'AWS_S3_MAX_CONCURRENCY', 4)
+    config = TransferConfig(
+        multipart_threshold=getattr(settings, 'AWS_S3_MULTIPART_THRESHOLD', 8 * MB),
+        multipart_chunksize=getattr(settings, 'AWS_S3_MULTIPART_CHUNKSIZE', 8 * MB),
+        max_concurrency=concurrency,
+    )
+    # s3transfer reads up to ten parts ahead by default, which holds most of
+    # a large body in memory; only read as many as are being sent.
+    config.max_in_memory_upload_chunks = concurrency
+    return config
+
+
+class BufferReader(io.RawIOBase):
+    """Read-only file object over a buffer that never copies it whole.
+
+    Only the chunk handed back by each ``read`` call is materialised, so
+    streaming a memoryview costs one chunk of memory rather than a full copy.
+    """
+
+    def __init__(self, buf):
+        self._view = memoryview(buf).cast('B') if hasattr(memoryview, 'cast') else memoryview(buf)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        else:
+            pos = len(self._view) + offset
+        self._pos = max(0, pos)
+        return self._pos
+
+    def readinto(self, b):
+        chunk = self._view[self._pos:self._pos + len(b)]
+        n = len(chunk)
+        b[:n] = chunk
+        self._pos += n
+        return n
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self._view) - self._pos
+        chunk = self._view[self._pos:self._pos + size]
+        self._pos += len(chunk)
+        return chunk.tobytes()
+
+
+def as_fileobj(data):
+    """Adapt bytes, buffers and file-like objects for streaming upload."""
+    if hasattr(data, 'read'):
+        if hasattr(data, 'seek'):
+            data.seek(0)
+        return data
+    return BufferReader(data)
+
+
+def upload(data, path, bucket=None, content_type=None):
+    """Stream ``data`` to ``path`` in the storage bucket.
+
+    Payloads above ``AWS_S3_MULTIPART_THRESHOLD`` are sent as a parallel
+    multipart upload.
+
+    :param data: file-like object, bytes, bytearray or memoryview.
+    :param str path: object key.
+    """
+    extra_args = {'ContentType': content_type} if content_type else None
+    ratelimit.bucket('s3', 100, 200).acquire()
+    get_client().upload_fileobj(
+        as_fileobj(data), bucket or settings.AWS_STORAGE_BUCKET_NAME, path,
+        ExtraArgs=extra_args, Config=get_transfer_config(),
+    )
+
+
+def resolve_urls(keys):
+    """Map object keys to URLs, signing only what no cache tier holds.
+
+    Lookups go to the in-process LRU, then a single ``get_many`` against the
+    default cache, and only the remaining keys are signed. Cached URLs
+    expire ``S3_URL_CACHE_MARGIN`` seconds before their signature does; if
+    the margin leaves no time, URLs are signed on every call and not cached.
+    When ``AWS_QUERYSTRING_AUTH`` is off, plain ``S3_URL`` URLs are returned.
+
+    :param list keys: object keys.
+    :return: dict of key to URL.
+    """
+    keys = list(keys)
+    if not getattr(settings, 'AWS_QUERYSTRING_AUTH', True):
+        return dict((key, settings.S3_URL + quote(key)) for key in keys)
+
+    expire = getattr(settings, 'AWS_QUERYSTRING_EXPIRE', 3600)
+    timeout = expire - getattr(settings, 'S3_URL_CACHE_MARGIN', 300)
+    now = time.time()
+    expires = now + timeout
+
+    urls = _urls.get_many(keys) if timeout > 0 else {}
+    missing = [key for key in keys if key not in urls]
+    if not missing:
+        return urls
+
+    if timeout > 0:
+        shared = cache.get_many([URL_CACHE_PREFIX + key for key in missing])
+        for key in missing:
+            entry = shared.get(URL_CACHE_PREFIX + key)
+            if entry is not None and entry[1] > now:
+                urls[key] = entry[0]
+                _urls.set(key, entry[0], entry[1])
+
+    client = get_client()
+    signed = {}
+    for key in missing:
+        if key in urls:
+            continue
+        url = client.generate_presigned_url(
+            ClientMethod='get_object',
+            Params={'Bucket': settings.AWS_STORAGE_BUCKET_NAME, 'Key': key},
+            ExpiresIn=expire,
+        )
+        urls[key] = url
+        if timeout > 0:
+            _urls.set(key, url, expires)
+            signed[URL_CACHE_PREFIX + key] = (url, expires)
+
+    if signed:
+        cache.set_many(signed, timeout)
+    return urls
+
+
+def resolve_url(key):
+    return resolve_urls([key])[key]
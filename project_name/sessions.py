@@ -0,0 +1,145 @@
+import time
+import zlib
+import struct
+import hashlib
+import logging
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.contrib.sessions.backends import signed_cookies
+from django.contrib.sessions.backends.base import CreateError
+from django.contrib.sessions.backends.cache import SessionStore as CacheSessionStore
+from django.contrib.sessions.middleware import SessionMiddleware as BaseSessionMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Payloads past this size are zlib-compressed before they go to Redis.
+COMPRESS_MIN = 512
+
+# Marks a session cookie holding signed data rather than a Redis key.
+COOKIE_PREFIX = 'c.'
+
+
+def pack(payload, refreshed):
+    body = struct.pack('!I', int(refreshed)) + payload
+    if len(body) > COMPRESS_MIN:
+        return b'z' + zlib.compress(body)
+    return b'r' + body
+
+
+def unpack(value):
+    """``(refreshed timestamp, serialized session)`` from a stored value."""
+    body = zlib.decompress(value[1:]) if value[:1] == b'z' else value[1:]
+    return struct.unpack('!I', body[:4])[0], body[4:]
+
+
+def refresh_interval():
+    return getattr(settings, 'SESSION_REFRESH_INTERVAL', 3600)
+
+
+class SessionStore(CacheSessionStore):
+    """Sessions in ``CACHES[SESSION_CACHE_ALIAS]``, one compact value per key.
+
+    The value is the session serialized with ``SESSION_SERIALIZER``, behind
+    a 4-byte timestamp of its last write, compressed once it is large.
+    ``save`` skips the write when the data is byte-for-byte what was loaded
+    and the last write is less than ``SESSION_REFRESH_INTERVAL`` seconds
+    old. Like Django's cache engine, it writes without checking the key
+    still exists, so a session deleted mid-request can be written back.
+    """
+
+    cache_key_prefix = 'session:'
+
+    def __init__(self, session_key=None):
+        super(SessionStore, self).__init__(session_key)
+        self._digest = None
+        self._refreshed = 0
+
+    def load(self):
+        try:
+            value = self._cache.get(self.cache_key)
+        except Exception:
+            value = None
+        if isinstance(value, bytes):
+            try:
+                refreshed, payload = unpack(value)
+                data = self.serializer().loads(payload)
+            except Exception:
+                logger.warning('Discarding unreadable session %s', self._session_key)
+            else:
+                self._digest = hashlib.sha1(payload).hexdigest()
+                self._refreshed = refreshed
+                return data
+        self._session_key = None
+        return {}
+
+    def refresh_due(self):
+        return bool(self._refreshed) and time.time() - self._refreshed >= refresh_interval()
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        payload = self.serializer().dumps(self._get_session(no_load=must_create))
+        digest = hashlib.sha1(payload).hexdigest()
+        if not must_create and digest == self._digest and not self.refresh_due():
+            return
+        now = time.time()
+        func = self._cache.add if must_create else self._cache.set
+        result = func(self.cache_key, pack(payload, now), self.get_expiry_age())
+        if must_create and not result:
+            raise CreateError
+        self._digest = digest
+        self._refreshed = now
+
+    def restore(self, data, expiry_age):
+        """Write ``data`` under this key unless the cache already has it."""
+        payload = self.serializer().dumps(data)
+        return self._cache.add(self.cache_key, pack(payload, time.time()), expiry_age)
+
+
+class AnonymousSessionStore(signed_cookies.SessionStore):
+    """Signed-cookie session for a visitor who hasn't logged in.
+
+    Its key is the signed data itself, prefixed with ``COOKIE_PREFIX`` so
+    the middleware can tell it from a cache key. Cookies are capped at 4kB,
+    so only small anonymous sessions belong here.
+    """
+
+    def load(self):
+        if self._session_key and self._session_key.startswith(COOKIE_PREFIX):
+            self._session_key = self._session_key[len(COOKIE_PREFIX):]
+        return super(AnonymousSessionStore, self).load()
+
+    def _get_session_key(self):
+        return COOKIE_PREFIX + super(AnonymousSessionStore, self)._get_session_key()
+
+
+class SessionMiddleware(BaseSessionMiddleware):
+    """``SessionMiddleware`` with lazy expiry refresh and cookie sessions.
+
+    A session that was read but not changed has its cookie and server-side
+    expiry pushed back once ``refresh_due``, rather than on every request
+    as ``SESSION_SAVE_EVERY_REQUEST`` would. With
+    ``SESSION_ANONYMOUS_COOKIES`` on, visitors without a session start in
+    an ``AnonymousSessionStore`` and move to ``SESSION_ENGINE`` on login.
+    """
+
+    def process_request(self, request):
+        session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        if getattr(settings, 'SESSION_ANONYMOUS_COOKIES', False) and (
+                session_key is None or session_key.startswith(COOKIE_PREFIX)):
+            request.session = AnonymousSessionStore(session_key)
+        else:
+            request.session = self.SessionStore(session_key)
+
+    def process_response(self, request, response):
+        session = getattr(request, 'session', None)
+        if isinstance(session, AnonymousSessionStore):
+            if session.modified and SESSION_KEY in session._session:
+                promoted = self.SessionStore()
+                promoted.update(session._session)
+                request.session = promoted
+        elif session is not None and session.accessed and not session.modified:
+            if getattr(session, 'refresh_due', lambda: False)():
+                session.modified = True
+        return super(SessionMiddleware, self).process_response(request, response)
@@ -25,6 +25,13 @@ AWS_S3_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
 AWS_STORAGE_BUCKET_NAME = os.environ.get('AWS_STORAGE_BUCKET_NAME')
 S3DIRECT_REGION = os.environ.get('S3DIRECT_REGION')
 AWS_S3_HOST = os.environ.get('AWS_S3_HOST')
+# Names expected by django-storages and utils.py
+AWS_ACCESS_KEY_ID = AWS_S3_ACCESS_KEY_ID
+AWS_SECRET_ACCESS_KEY = AWS_S3_SECRET_ACCESS_KEY
+AWS_S3_MAX_POOL_CONNECTIONS = 10
+AWS_S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+AWS_S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+AWS_S3_MAX_CONCURRENCY = 4
 
 # HEROKU
 HEROKU_STAGING_APP = os.environ.get('HEROKU_STAGING_APP')
@@ -37,10 +44,55 @@ SECRET_KEY = os.environ.get('SECRET_KEY')
 
 # IMAGE COMPRESSION & RESIZING
 TINYPNG = os.environ.get('TINYPNG')
+# TinifyBackend round-trips through TinyPNG; PillowBackend compresses locally
+IMAGE_COMPRESSION_BACKEND = '{{project_name}}.imaging.compression.TinifyBackend'
+IMAGE_COMPRESSION_PROCESSES = 2
+IMAGE_COMPRESSION_JPEG_MIN_QUALITY = 60
+IMAGE_COMPRESSION_JPEG_MAX_QUALITY = 90
+IMAGE_COMPRESSION_JPEG_TARGET_RATIO = 0.6
+# Sibling formats written next to the primary output, e.g. ('webp', 'avif')
+IMAGE_COMPRESSION_EXTRA_FORMATS = ()
+IMAGE_COMPRESSION_EXTRA_QUALITY = 75
+# Source downloads spill to disk past the spool size and are refused past the limits
+IMAGE_FETCH_MAX_BYTES = 50 * 1024 * 1024
+IMAGE_FETCH_MAX_PIXELS = 60000000
+IMAGE_FETCH_SPOOL_SIZE = 5 * 1024 * 1024
+IMAGE_FETCH_POOL_SIZE = 10
+IMAGE_FETCH_TIMEOUT = 10
+# Only JPEG decodes at a reduced scale; thumbnails and placeholders refuse
+# other formats above this many pixels
+IMAGE_DECODE_MAX_PIXELS = 25000000
+# name: (width, height, 'crop' | 'fit'); URLs land on '<name>_thumbnail' fields
+THUMBNAIL_SIZES = {
+    'small': (150, 150, 'crop'),
+    'medium': (600, 600, 'fit'),
+    'large': (1200, 1200, 'fit'),
+}
+THUMBNAIL_FIELD = '{name}_thumbnail'
+THUMBNAIL_QUALITY = 85
+THUMBNAIL_WORKERS = 4
+# 'inline' stores a data URI on PLACEHOLDER_FIELD; 's3' uploads a _placeholder object
+PLACEHOLDER_MODE = 'inline'
+PLACEHOLDER_FIELD = 'placeholder'
+PLACEHOLDER_QUALITY = 40
 
 # PUSH NOTIFICATION SERVICE
 ONE_SIGNAL_REST_KEY = os.environ.get('ONE_SIGNAL_REST_KEY')
 ONE_SIGNAL_APP_ID = os.environ.get('ONE_SIGNAL_APP_ID')
+ONE_SIGNAL_POOL_SIZE = 4
+ONE_SIGNAL_MAX_RETRIES = 3
+ONE_SIGNAL_BACKOFF = 0.2
+ONE_SIGNAL_MAX_BACKOFF = 2.0
+ONE_SIGNAL_TIMEOUT = 5
+# (requests per second, burst) shared by every process; RATE_LIMITS can override
+ONE_SIGNAL_RATE_LIMIT = (10, 20)
+# Seconds the outbox drain waits so bursts coalesce into one send
+NOTIFICATION_OUTBOX_WINDOW = 2
+NOTIFICATION_OUTBOX_BATCH_SIZE = 500
+# A drain holds the rows it claimed this long; failed rows are retried with
+# exponential backoff up to NOTIFICATION_OUTBOX_MAX_ATTEMPTS sends
+NOTIFICATION_OUTBOX_CLAIM_TIMEOUT = 60
+NOTIFICATION_OUTBOX_MAX_ATTEMPTS = 5
 
 # SMS PROVIDER
 TWILIO_ACCOUND_SID = os.environ.get('TWILIO_ACCOUND_SID')
@@ -51,11 +103,88 @@ PLIVO_AUTH_ID = os.environ.get('PLIVO_AUTH_ID')
 PLIVO_AUTH_TOKEN = os.environ.get('PLIVO_AUTH_TOKEN')
 PLIVO_PHONE_NUMBER = os.environ.get('PLIVO_PHONE_NUMBER')
 
+# Tried in order; a provider is skipped while its circuit breaker is open
+SMS_PROVIDERS = ('twilio', 'plivo')
+SMS_TIMEOUT = 5
+SMS_WORKERS = 4
+SMS_BREAKER_ERROR_RATE = 0.5
+SMS_BREAKER_SLOW = 2.0
+SMS_BREAKER_MIN_CALLS = 5
+SMS_BREAKER_COOLDOWN = 30
+
 # EMAIL PROVIDER
 SENDGRID_HOST = os.environ.get('SENDGRID_HOST')
 SENDGRID_HOST_USER = os.environ.get('SENDGRID_HOST_USER')
 SENDGRID_HOST_PASSWORD = os.environ.get('SENDGRID_HOST_PASSWORD')
 
+# Open SMTP connections kept per worker process, and how long a send waits
+# for one to come free
+EMAIL_POOL_SIZE = 4
+EMAIL_POOL_TIMEOUT = 30
+EMAIL_POOL_CHECK_AFTER = 30
+EMAIL_BULK_CHUNK_SIZE = 100
+
+
+# OUTBOUND RATE LIMITS
+# Overrides for provider budgets as name: (tokens per second, burst capacity),
+# shared across web and worker processes through CACHES['default']. An optional
+# third item sets the tokens each process leases at once (default: burst / 10)
+RATE_LIMITS = {
+    # 'tinify': (2, 5),
+    # 'twilio': (1, 5),
+    # 'plivo': (5, 10),
+    # 's3': (100, 200),
+}
+
+
+# OUTBOUND CALL INSTRUMENTATION
+# Seconds between each worker folding its histograms into Redis
+INSTRUMENTATION_FLUSH_INTERVAL = 10
+# Seconds a histogram nobody records into is kept
+INSTRUMENTATION_TTL = 7 * 24 * 3600
+# Bearer token for scraping /metrics/; without it only staff can read it
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+
+# CACHED COMPUTATIONS
+# Defaults for caching.stampede: seconds a stale value may be served while
+# one worker recomputes, how long that worker holds the lock, and how long
+# a cold miss waits for it
+STAMPEDE_STALE_TIMEOUT = 300
+STAMPEDE_LOCK_TIMEOUT = 30
+STAMPEDE_WAIT = 2
+
+
+# SESSIONS
+# With the cache-backed SESSION_ENGINE from production.py, a session that is
+# read but unchanged has its expiry pushed back at most once per
+# SESSION_REFRESH_INTERVAL seconds
+SESSION_REFRESH_INTERVAL = 3600
+# Keep the sessions of visitors who haven't logged in in a signed cookie
+SESSION_ANONYMOUS_COOKIES = False
+
+
+# DATABASE REPLICAS
+# Comma-separated URLs, added to DATABASES as replica1, replica2, ... Reads
+# go to a replica whose lag, checked every DATABASE_REPLICA_CHECK_INTERVAL
+# seconds with a DATABASE_REPLICA_CHECK_TIMEOUT second statement timeout,
+# is under DATABASE_REPLICA_MAX_LAG; everything else to default
+DATABASE_REPLICA_URLS = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+DATABASE_REPLICA_MAX_LAG = 5
+DATABASE_REPLICA_CHECK_INTERVAL = 5
+DATABASE_REPLICA_CHECK_TIMEOUT = 0.5
+DATABASE_ROUTERS = ['{{project_name}}.routers.ReplicaRouter']
+
+
+# REQUEST PROFILING
+# Fraction of requests whose queries, Redis round trips and outbound calls
+# are timed and aggregated for `manage.py profile_top`
+PROFILER_SAMPLE_RATE = 0.01
+# A query shape repeated this many times in one request is logged as an N+1
+PROFILER_NPLUSONE_THRESHOLD = 5
+# Add a Server-Timing header to sampled responses
+PROFILER_SERVER_TIMING = True
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/1.7/howto/deployment/checklist/
@@ -90,10 +219,12 @@ THIRD_PARTY_APPS = (
     # 'storages',
     # 's3direct',
     # 'import_export',
-    # 'django_rq'
+    # Outbox drains, bulk email and SMS run on the RQ worker
+    'django_rq',
 )
 
 LOCAL_APPS = (
+    '{{project_name}}.apps.core',
     '{{project_name}}.apps.users',
 )
 
@@ -104,12 +235,19 @@ INSTALLED_APPS = DJANGO_APPS + THIRD_PARTY_APPS + LOCAL_APPS
 # ######### MIDDLEWARE CONFIGURATION
 
 MIDDLEWARE = [
+    # Sets the request id log records carry, so it comes first
+    '{{project_name}}.logutils.RequestIDMiddleware',
+    # Outermost, so a sampled request's wall time covers every other middleware
+    '{{project_name}}.profiling.ProfilerMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    '{{project_name}}.routers.PrimaryPinningMiddleware',
+    '{{project_name}}.sessions.SessionMiddleware',
     #'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # Caches views decorated with caching.responses.cache_response; needs request.user
+    '{{project_name}}.caching.responses.ResponseCacheMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -165,6 +303,12 @@ STATICFILES_STORAGE = DEFAULT_FILE_STORAGE = 'storages.backends.s3boto.S3BotoSto
 
 AWS_S3_SECURE_URLS = False
 AWS_QUERYSTRING_AUTH = False
+AWS_QUERYSTRING_EXPIRE = 3600
+
+# Resolved object URLs are cached in-process and in CACHES['default'],
+# expiring S3_URL_CACHE_MARGIN seconds before the signature does
+S3_URL_CACHE_SIZE = 4096
+S3_URL_CACHE_MARGIN = 300
 
 
 S3_URL = 'https://%s.s3.amazonaws.com/' % AWS_STORAGE_BUCKET_NAME
@@ -181,38 +325,48 @@ TEST_RUNNER = 'django.test.runner.DiscoverRunner'
 
 ########## LOGGING CONFIGURATION
 # See: https://docs.djangoproject.com/en/dev/ref/settings/#logging
-# LOGGING = {
-#     'version': 1,
-#     'disable_existing_loggers': False,
-#     'formatters': {
-#         'verbose': {
-#             'format': "[%(asctime)s] %(levelname)s [%(name)s:%(lineno)s] %(message)s",
-#             'datefmt': "%d/%b/%Y %H:%M:%S"
-#         },
-#         'simple': {
-#             'format': '%(levelname)s %(message)s'
-#         },
-#     },
-#     'handlers': {
-#         'file': {
-#             'level': 'DEBUG',
-#             'class': 'logging.FileHandler',
-#             'filename': BASE_DIR('logs', '{{project_name}}.log'),
-#             'formatter': 'verbose'
-#         },
-#     },
-#     'loggers': {
-#         'django': {
-#             'handlers': ['file'],
-#             'propagate': True,
-#             'level': 'DEBUG',
-#         },
-#         '{{project_name}}': {
-#             'handlers': ['file'],
-#             'level': 'DEBUG',
-#         },
-#     }
-# }
+# JSON lines on stdout for web and worker dynos alike. Records are queued and
+# written by a background thread, tagged with the request id (or RQ job id),
+# and identical messages are let through at most 10 times a minute
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'context': {
+            '()': '{{project_name}}.logutils.ContextFilter',
+        },
+        'dedupe': {
+            '()': '{{project_name}}.logutils.DuplicateFilter',
+            'burst': 10,
+            'window': 60,
+        },
+    },
+    'formatters': {
+        'json': {
+            '()': '{{project_name}}.logutils.JSONFormatter',
+        },
+    },
+    'handlers': {
+        'console': {
+            'level': 'INFO',
+            'class': '{{project_name}}.logutils.AsyncStreamHandler',
+            'stream': 'ext://sys.stdout',
+            'formatter': 'json',
+            'filters': ['context', 'dedupe'],
+        },
+    },
+    'root': {
+        'handlers': ['console'],
+        'level': 'INFO',
+    },
+    'loggers': {
+        'django': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
 ########## END LOGGING CONFIGURATION
 
 
@@ -11,7 +11,6 @@ https://docs.djangoproject.com/en/1.7/ref/settings/
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 
 from base import *
-import yaml
 
 # Honor the 'X-Forwarded-Proto' header for request.is_secure()
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
@@ -34,7 +33,12 @@ THIRD_PARTY_APPS = (
     # 'storages',
     # 's3direct',
     # 'import_export',
-    # 'django_rq'
+    'django_rq',
+)
+
+# bench_* management commands; never installed on staging or production
+LOCAL_APPS += (
+    '{{project_name}}.apps.devtools',
 )
 
 INSTALLED_APPS = DJANGO_APPS + THIRD_PARTY_APPS + LOCAL_APPS
@@ -51,6 +55,12 @@ DATABASES = {
     'default': dj_database_url.config(default=DATABASE_URL)
 }
 
+# Replicas mirror default under test rather than getting databases of their own
+DATABASES.update(
+    ('replica{}'.format(index), dict(dj_database_url.parse(url), TEST={'MIRROR': 'default'}))
+    for index, url in enumerate(DATABASE_REPLICA_URLS, 1)
+)
+
 # ######### DJANGO RQ CONFIGURATION
 # See: https://docs.djangoproject.com/en/dev/ref/settings/#caches
 
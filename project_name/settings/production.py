@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/1.7/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 from base import *
+from django.utils.six.moves.urllib import parse as urlparse
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/1.7/howto/deployment/checklist/
@@ -35,7 +36,7 @@ THIRD_PARTY_APPS = (
     # 'storages',
     # 's3direct',
     # 'import_export',
-    # 'django_rq'
+    'django_rq',
 )
 
 INSTALLED_APPS = DJANGO_APPS + THIRD_PARTY_APPS + LOCAL_APPS
@@ -51,66 +52,96 @@ DATABASES = {
     'default': dj_database_url.config(default=DATABASE_URL)
 }
 
-# ######### LOGGING CONFIGURATION
-# See: https://docs.djangoproject.com/en/dev/ref/settings/#logging
-# LOGGING = {
-#     'version': 1,
-#     'disable_existing_loggers': False,
-#     'formatters': {
-#         'verbose': {
-#             'format': "[%(asctime)s] %(levelname)s [%(name)s:%(lineno)s] %(message)s",
-#             'datefmt': "%d/%b/%Y %H:%M:%S"
-#         },
-#         'simple': {
-#             'format': '%(levelname)s %(message)s'
-#         },
-#     },
-#     'handlers': {
-#         'file': {
-#             'level': 'DEBUG',
-#             'class': 'logging.FileHandler',
-#             'filename': BASE_DIR('logs', '{{project_name}}.log'),
-#             'formatter': 'verbose'
-#         },
-#     },
-#     'loggers': {
-#         'django': {
-#             'handlers': ['file'],
-#             'propagate': True,
-#             'level': 'DEBUG',
-#         },
-#         '{{project_name}}': {
-#             'handlers': ['file'],
-#             'level': 'DEBUG',
-#         },
-#     }
-# }
-# ######### END LOGGING CONFIGURATION
+# Replicas mirror default under test rather than getting databases of their own
+DATABASES.update(
+    ('replica{}'.format(index), dict(dj_database_url.parse(url), TEST={'MIRROR': 'default'}))
+    for index, url in enumerate(DATABASE_REPLICA_URLS, 1)
+)
 
+# bin/start-pgbouncer-stunnel puts pgbouncer, in transaction pooling mode,
+# between the dyno and Postgres. Connections to it are kept across requests;
+# server-side cursors are off because pgbouncer can hand the next
+# transaction to a different server connection
+DATABASE_CONN_MAX_AGE = int(os.environ.get('DATABASE_CONN_MAX_AGE', 600))
+DATABASES = dict(
+    (alias, dict(database, CONN_MAX_AGE=DATABASE_CONN_MAX_AGE, DISABLE_SERVER_SIDE_CURSORS=True))
+    for alias, database in DATABASES.items()
+)
+# A reused connection idle for longer than this is pinged before the request uses it
+DATABASE_HEALTH_CHECK_AFTER = 30
+
+# ######### TEMPLATE CONFIGURATION
+# Templates are parsed once per process and kept; wsgi.py compiles them all
+# at import when TEMPLATE_WARMUP is set, which --preload makes once per dyno.
+# `manage.py compile_templates` reports compile times and broken templates
+TEMPLATES = [dict(
+    TEMPLATES[0],
+    APP_DIRS=False,
+    OPTIONS=dict(TEMPLATES[0]['OPTIONS'], loaders=[
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]),
+)]
+TEMPLATE_WARMUP = True
+# ######### END TEMPLATE CONFIGURATION
+
+# ######### STATIC FILES CONFIGURATION
+# collectstatic writes content-hashed names, staticfiles.json and .br/.gz
+# variants; wsgi.py serves them from memory, hashed names as immutable.
+# Uploaded media stays on S3 through DEFAULT_FILE_STORAGE
+STATICFILES_STORAGE = '{{ project_name }}.staticfiles.CompressedManifestStaticFilesStorage'
+STATIC_URL = '/static/'
+STATIC_ROOT = BASE_DIR('staticfiles')
+# Cache lifetime of files collected under their original names
+STATIC_MAX_AGE = 60
+# Larger files are streamed from disk rather than held in every worker
+STATIC_MEMORY_MAX_SIZE = 256 * 1024
+# ######### END STATIC FILES CONFIGURATION
 
 # ######### CACHE CONFIGURATION
 # See: https://docs.djangoproject.com/en/dev/ref/settings/#caches
 
 redis_url = urlparse.urlparse(os.environ.get('REDIS_URL'))
 
+# Redis behind a per-process LRU; writes are broadcast over pub/sub so other
+# workers drop their copy. Prefixes in LOCAL_EXCLUDE always read from Redis.
 CACHES = {
     'default': {
-        'BACKEND': 'redis_cache.RedisCache',
+        'BACKEND': '{{ project_name }}.caching.backends.TwoTierRedisCache',
         'LOCATION': '{0}:{1}'.format(redis_url.hostname, redis_url.port),
         'KEY_PREFIX': '{{ project_name }}_prod',
         'OPTIONS': {
             'PASSWORD': redis_url.password,
             'DB': 0,
+            'LOCAL_MAX_ENTRIES': 1000,
+            'LOCAL_TIMEOUT': 5,
+            'LOCAL_EXCLUDE': ('session:',),
         }
     }
 }
 
+# Sessions live in Redis; `manage.py migrate_sessions` copies the
+# django_session table across when switching
+SESSION_ENGINE = '{{ project_name }}.sessions'
+SESSION_CACHE_ALIAS = 'default'
+
 REST_FRAMEWORK_EXTENSIONS = {
     'DEFAULT_CACHE_ERRORS': False
 }
 
 # ######### END CACHE CONFIGURATION
 
+# ######### EMAIL CONFIGURATION
+EMAIL_BACKEND = '{{project_name}}.mail.PooledEmailBackend'
+EMAIL_HOST = SENDGRID_HOST
+EMAIL_HOST_USER = SENDGRID_HOST_USER
+EMAIL_HOST_PASSWORD = SENDGRID_HOST_PASSWORD
+EMAIL_PORT = 587
+EMAIL_USE_TLS = True
+# ######### END EMAIL CONFIGURATION
+
 # ######### DJANGO RQ CONFIGURATION
 RQ_QUEUES = {
     'default': {
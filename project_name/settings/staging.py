@@ -39,7 +39,7 @@ THIRD_PARTY_APPS = (
     # 'storages',
     # 's3direct',
     # 'import_export',
-    # 'django_rq'
+    'django_rq',
 )
 
 INSTALLED_APPS = DJANGO_APPS + THIRD_PARTY_APPS + LOCAL_APPS
@@ -55,52 +55,21 @@ DATABASES = {
     'default': dj_database_url.config(default=DATABASE_URL)
 }
 
-# ######### LOGGING CONFIGURATION
-# See: https://docs.djangoproject.com/en/dev/ref/settings/#logging
-# LOGGING = {
-#     'version': 1,
-#     'disable_existing_loggers': False,
-#     'formatters': {
-#         'verbose': {
-#             'format': "[%(asctime)s] %(levelname)s [%(name)s:%(lineno)s] %(message)s",
-#             'datefmt': "%d/%b/%Y %H:%M:%S"
-#         },
-#         'simple': {
-#             'format': '%(levelname)s %(message)s'
-#         },
-#     },
-#     'handlers': {
-#         'file': {
-#             'level': 'DEBUG',
-#             'class': 'logging.FileHandler',
-#             'filename': BASE_DIR('logs', '{{project_name}}.log'),
-#             'formatter': 'verbose'
-#         },
-#     },
-#     'loggers': {
-#         'django': {
-#             'handlers': ['file'],
-#             'propagate': True,
-#             'level': 'DEBUG',
-#         },
-#         '{{project_name}}': {
-#             'handlers': ['file'],
-#             'level': 'DEBUG',
-#         },
-#     }
-# }
-# ######### END LOGGING CONFIGURATION
-
+# Replicas mirror default under test rather than getting databases of their own
+DATABASES.update(
+    ('replica{}'.format(index), dict(dj_database_url.parse(url), TEST={'MIRROR': 'default'}))
+    for index, url in enumerate(DATABASE_REPLICA_URLS, 1)
+)
 
 # ######### DJANGO RQ CONFIGURATION
 # See: https://docs.djangoproject.com/en/dev/ref/settings/#caches
 
-# RQ_QUEUES = {
-#     'default': {
-#         'URL': os.getenv('REDIS_URL', 'redis://localhost:6379/0'),  # If you're on Heroku
-#         'DEFAULT_TIMEOUT': 500,
-#     }
-# }
+RQ_QUEUES = {
+    'default': {
+        'URL': os.getenv('REDIS_URL', 'redis://localhost:6379/0'),  # If you're on Heroku
+        'DEFAULT_TIMEOUT': 500,
+    }
+}
 
 # ######### END DJANGO RQ CONFIGURATION
 
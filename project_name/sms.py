@@ -0,0 +1,276 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from . import ratelimit
+from .instrumentation import timed
+
+logger = logging.getLogger(__name__)
+
+
+class SMSError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """Tracks a provider's latency and error rate and decides whether to use it.
+
+    Latency and errors are exponentially weighted, so a provider that turns
+    slow is routed around once its average crosses ``slow`` seconds, before
+    requests start timing out. An open breaker lets a single trial call
+    through after ``cooldown`` seconds and closes again if it succeeds.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, error_rate=0.5, slow=2.0, min_calls=5, cooldown=30, alpha=0.2):
+        self.max_error_rate = error_rate
+        self.slow = slow
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self.state = self.CLOSED
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.calls = 0
+        self.opened = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened >= self.cooldown:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def release(self):
+        """Give back a trial call that :meth:`allow` granted but wasn't made."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record(self, latency, ok):
+        with self._lock:
+            self.calls += 1
+            self.latency += self.alpha * (latency - self.latency)
+            self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+
+            if self.state == self.HALF_OPEN:
+                if ok and latency < self.slow:
+                    self.state = self.CLOSED
+                    self.latency = latency
+                    self.error_rate = 0.0
+                else:
+                    self._open()
+            elif self.calls >= self.min_calls and (
+                    self.error_rate > self.max_error_rate or self.latency > self.slow):
+                self._open()
+
+    def _open(self):
+        if self.state != self.OPEN:
+            logger.warning('SMS circuit opened (latency %.3fs, error rate %.2f)',
+                           self.latency, self.error_rate)
+        self.state = self.OPEN
+        self.opened = time.time()
+
+
+class BaseProvider(object):
+    """An SMS provider with one client per process."""
+
+    name = None
+    # (messages per second, burst), shared across every worker.
+    budget = (1, 5)
+
+    def __init__(self):
+        self._pid = None
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._client = self.build_client()
+                    self._pid = os.getpid()
+        return self._client
+
+    @property
+    def limiter(self):
+        return ratelimit.bucket(self.name, *self.budget)
+
+    def build_client(self):
+        raise NotImplementedError
+
+    def send(self, destination, message):
+        """Send one message; returns the provider's message id.
+
+        :raises SMSError: on any provider failure.
+        """
+        raise NotImplementedError
+
+
+class TwilioProvider(BaseProvider):
+    name = 'twilio'
+
+    def build_client(self):
+        from twilio.rest import TwilioRestClient
+        return TwilioRestClient(
+            settings.TWILIO_ACCOUND_SID, settings.TWILIO_AUTH_TOKEN,
+            timeout=getattr(settings, 'SMS_TIMEOUT', 5))
+
+    def send(self, destination, message):
+        from twilio import TwilioRestException
+        try:
+            return self.client.messages.create(
+                to='{}'.format(destination), from_='{}'.format(settings.TWILIO_PHONE_NUMBER),
+                body=message,
+            ).sid
+        except TwilioRestException as e:
+            raise SMSError('twilio: {}'.format(e))
+
+
+class PlivoProvider(BaseProvider):
+    name = 'plivo'
+    budget = (5, 10)
+
+    def build_client(self):
+        import plivo
+        return plivo.RestAPI(settings.PLIVO_AUTH_ID, settings.PLIVO_AUTH_TOKEN)
+
+    def send(self, destination, message):
+        response_code, response = self.client.send_message({
+            'src': settings.PLIVO_PHONE_NUMBER,
+            'dst': u"{}".format(destination),
+            'text': u"{}".format(message),
+            'method': 'POST'
+        })
+        if int(response_code) >= 400:
+            raise SMSError('plivo: {} {}'.format(response_code, response))
+        return response.get('message_uuid', [None])[0]
+
+
+PROVIDERS = {
+    'twilio': TwilioProvider,
+    'plivo': PlivoProvider,
+}
+
+
+class SMSRouter(object):
+    """Sends through the first healthy provider, failing over in order."""
+
+    def __init__(self, providers=None):
+        if providers is None:
+            providers = getattr(settings, 'SMS_PROVIDERS', ('twilio', 'plivo'))
+        self.providers = [
+            PROVIDERS[name]() if name in PROVIDERS else import_string(name)()
+            for name in providers
+        ]
+        self.breakers = dict((provider.name, CircuitBreaker(
+            error_rate=getattr(settings, 'SMS_BREAKER_ERROR_RATE', 0.5),
+            slow=getattr(settings, 'SMS_BREAKER_SLOW', 2.0),
+            min_calls=getattr(settings, 'SMS_BREAKER_MIN_CALLS', 5),
+            cooldown=getattr(settings, 'SMS_BREAKER_COOLDOWN', 30),
+        )) for provider in self.providers)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def send(self, destination, message):
+        """Send one message.
+
+        Breakers are consulted one provider at a time, so a provider further
+        down the list only spends its trial call once the ones before it
+        have failed.
+
+        :return: ``(provider name, message id)``.
+        :raises SMSError: if every provider failed or is open.
+        """
+        errors = []
+        tried = False
+        for provider in self.providers:
+            if not self.breakers[provider.name].allow():
+                continue
+            tried = True
+            result = self._attempt(provider, destination, message, errors, trial=True)
+            if result is not None:
+                return result
+        if not tried:
+            # Everything is open: trying the best of a bad lot beats failing.
+            for provider in self.providers:
+                result = self._attempt(provider, destination, message, errors, trial=False)
+                if result is not None:
+                    return result
+        raise SMSError('All SMS providers failed: {}'.format(
+            '; '.join(str(e) for e in errors)))
+
+    def _attempt(self, provider, destination, message, errors, trial):
+        breaker = self.breakers[provider.name]
+        try:
+            # Out of budget is not the provider's fault: fail over without
+            # counting it against the breaker, and hand back a trial call.
+            provider.limiter.acquire(block=False)
+        except ratelimit.RateLimited as e:
+            if trial:
+                breaker.release()
+            errors.append(e)
+            return None
+        started = time.time()
+        try:
+            with timed(provider.name, 'send'):
+                message_id = provider.send(destination, message)
+        except Exception as e:
+            breaker.record(time.time() - started, False)
+            errors.append(e)
+            logger.warning('SMS via %s failed: %s', provider.name, e)
+            return None
+        breaker.record(time.time() - started, True)
+        return provider.name, message_id
+
+    def send_many(self, messages):
+        """Send ``(destination, message)`` pairs concurrently.
+
+        :return: list of ``(provider name, message id)`` or ``SMSError``, in order.
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=getattr(settings, 'SMS_WORKERS', 4))
+                    self._pid = os.getpid()
+
+        def attempt(item):
+            try:
+                return self.send(*item)
+            except SMSError as e:
+                return e
+
+        return list(self._executor.map(attempt, messages))
+
+    def stats(self):
+        return dict((name, {
+            'state': breaker.state,
+            'latency': breaker.latency,
+            'error_rate': breaker.error_rate,
+            'calls': breaker.calls,
+        }) for name, breaker in self.breakers.items())
+
+
+router = SMSRouter()
+
+
+def send_sms_job(destination, message):
+    return router.send(destination, message)
+
+
+def send_sms_async(destination, message):
+    """Queue an SMS on the default RQ queue instead of sending in-request."""
+    import django_rq
+    return django_rq.enqueue(send_sms_job, destination, message)
@@ -0,0 +1,201 @@
+import os
+import gzip
+import json
+import logging
+import mimetypes
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.utils.six.moves.urllib.parse import urlparse
+
+# Text-like formats worth compressing; images and fonts like woff2 already are.
+COMPRESSIBLE = ('.css', '.js', '.map', '.svg', '.html', '.txt', '.xml', '.json',
+                '.ico', '.eot', '.ttf', '.otf')
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+# A variant is only kept if it is at least this much smaller.
+MIN_SAVING = 0.05
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+logger = logging.getLogger(__name__)
+
+
+def gzip_bytes(data):
+    buf = BytesIO()
+    # mtime=0 makes the output, and so its ETag, reproducible across builds.
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def brotli_bytes(data):
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli.compress(data, quality=11)
+
+
+def write_variants(path):
+    """Write ``path.br`` and ``path.gz`` next to ``path`` where they pay off."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < 256:
+        return
+    for compress, suffix in ((brotli_bytes, '.br'), (gzip_bytes, '.gz')):
+        compressed = compress(data)
+        if compressed is not None and len(compressed) < len(data) * (1 - MIN_SAVING):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """Content-hashed names and a manifest, plus brotli and gzip variants.
+
+    Brotli variants are only written when the ``brotli`` package from
+    ``requirements/base.txt`` is installed; collectstatic warns otherwise.
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        for result in super(CompressedManifestStaticFilesStorage, self).post_process(
+                paths, dry_run, **options):
+            yield result
+        if dry_run:
+            return
+        if brotli_bytes(b'') is None:
+            logger.warning('brotli is not installed; only gzip variants will be written')
+        targets = []
+        for root, dirs, files in os.walk(self.location):
+            for filename in files:
+                if filename.lower().endswith(COMPRESSIBLE):
+                    targets.append(os.path.join(root, filename))
+        # zlib and brotli release the GIL.
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(write_variants, targets))
+
+
+def parse_accept_encoding(header):
+    accepted = set()
+    for part in header.split(','):
+        name, _, params = part.strip().partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+class StaticFile(object):
+    """One servable file: headers and, when small enough, the bytes of each encoding."""
+
+    __slots__ = ('variants',)
+
+    def __init__(self, path, immutable, max_age, max_memory):
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type in (
+                'application/javascript', 'application/json', 'image/svg+xml'):
+            content_type += '; charset=utf-8'
+        stat = os.stat(path)
+        encodings = [(encoding, path + suffix) for encoding, suffix in ENCODINGS
+                     if os.path.exists(path + suffix)]
+        encodings.append((None, path))
+
+        self.variants = {}
+        for encoding, variant_path in encodings:
+            size = os.path.getsize(variant_path)
+            etag = '"{:x}-{:x}{}"'.format(
+                int(stat.st_mtime), stat.st_size, '-' + encoding if encoding else '')
+            headers = [
+                ('Content-Type', content_type),
+                ('Content-Length', str(size)),
+                ('Cache-Control', IMMUTABLE if immutable else 'public, max-age={}'.format(max_age)),
+                ('ETag', etag),
+            ]
+            if len(encodings) > 1:
+                headers.append(('Vary', 'Accept-Encoding'))
+            if encoding:
+                headers.append(('Content-Encoding', encoding))
+            body = None
+            if size <= max_memory:
+                with open(variant_path, 'rb') as f:
+                    body = f.read()
+            self.variants[encoding] = (variant_path, etag, headers, body)
+
+    def choose(self, accept_encoding):
+        if len(self.variants) > 1 and accept_encoding:
+            accepted = parse_accept_encoding(accept_encoding)
+            for encoding, _ in ENCODINGS:
+                if encoding in self.variants and encoding in accepted:
+                    return self.variants[encoding]
+        return self.variants[None]
+
+
+class StaticFilesApp(object):
+    """WSGI middleware serving ``STATIC_ROOT`` at ``STATIC_URL`` from memory.
+
+    The index is built once, at import under gunicorn ``--preload``, so a
+    request is a dict lookup. Files named in the manifest's hashed form
+    are cached for a year as immutable; anything else for
+    ``STATIC_MAX_AGE`` seconds. Files larger than ``STATIC_MEMORY_MAX_SIZE``
+    are indexed but streamed from disk.
+    """
+
+    def __init__(self, application, root=None, prefix=None):
+        self.application = application
+        self.root = root or settings.STATIC_ROOT
+        self.prefix = prefix or urlparse(settings.STATIC_URL).path
+        self.max_age = getattr(settings, 'STATIC_MAX_AGE', 60)
+        self.max_memory = getattr(settings, 'STATIC_MEMORY_MAX_SIZE', 256 * 1024)
+        self.files = self.build_index() if self.root and os.path.isdir(self.root) else {}
+
+    def build_index(self):
+        hashed = set()
+        manifest = os.path.join(self.root, 'staticfiles.json')
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                hashed.update(json.load(f).get('paths', {}).values())
+
+        files = {}
+        for root, dirs, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if filename.endswith(('.br', '.gz')) and os.path.exists(path[:-3]):
+                    continue
+                name = os.path.relpath(path, self.root).replace(os.sep, '/')
+                files[self.prefix + name] = StaticFile(
+                    path, name in hashed, self.max_age, self.max_memory)
+        return files
+
+    def __call__(self, environ, start_response):
+        static = self.files.get(environ.get('PATH_INFO', ''))
+        if static is None or environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return self.application(environ, start_response)
+
+        path, etag, headers, body = static.choose(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if etag in environ.get('HTTP_IF_NONE_MATCH', ''):
+            start_response('304 Not Modified', [h for h in headers if h[0] != 'Content-Length'])
+            return []
+        start_response('200 OK', headers)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        if body is not None:
+            return [body]
+        f = open(path, 'rb')
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            return file_wrapper(f, 64 * 1024)
+        return stream(f)
+
+
+def stream(f, chunk_size=64 * 1024):
+    try:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
+    finally:
+        f.close()
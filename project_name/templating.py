@@ -0,0 +1,81 @@
+import os
+import time
+import logging
+
+from django.template import engines
+from django.template.backends.django import DjangoTemplates
+
+logger = logging.getLogger(__name__)
+
+
+def _loaders(engine):
+    for loader in engine.template_loaders:
+        # The cached loader wraps the ones that actually find files.
+        for inner in getattr(loader, 'loaders', [loader]):
+            yield inner
+
+
+def template_names(engine):
+    """Every template ``engine`` can load, by name, first match wins."""
+    seen = set()
+    names = []
+    for loader in _loaders(engine):
+        if not hasattr(loader, 'get_dirs'):
+            continue
+        for directory in loader.get_dirs():
+            for root, dirs, files in os.walk(directory):
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
+                for filename in files:
+                    if filename.startswith('.'):
+                        continue
+                    name = os.path.relpath(os.path.join(root, filename), directory)
+                    name = name.replace(os.sep, '/')
+                    if name not in seen:
+                        seen.add(name)
+                        names.append(name)
+    return sorted(names)
+
+
+def django_engines():
+    return [backend.engine for backend in engines.all() if isinstance(backend, DjangoTemplates)]
+
+
+def compile_all(reset=False):
+    """Load every template through its engine, filling the cached loaders.
+
+    :param bool reset: empty the cached loaders first, so timings measure
+        reading and parsing rather than cache hits.
+    :return: ``[(name, seconds, exception or None)]``.
+    """
+    results = []
+    for engine in django_engines():
+        if reset:
+            for loader in engine.template_loaders:
+                if hasattr(loader, 'reset'):
+                    loader.reset()
+        for name in template_names(engine):
+            started = time.time()
+            error = None
+            try:
+                engine.get_template(name)
+            except Exception as e:
+                error = e
+            results.append((name, time.time() - started, error))
+    return results
+
+
+def warm():
+    """Compile every template now, before gunicorn ``--preload`` forks.
+
+    Workers then share the parsed templates copy-on-write instead of each
+    compiling them on first render. Failures are logged, not raised, so one
+    broken template can't keep the app from booting; ``compile_templates``
+    is the place to catch those.
+    """
+    started = time.time()
+    results = compile_all()
+    for name, _, error in results:
+        if error is not None:
+            logger.warning('Template %s failed to compile: %s', name, error)
+    logger.info('Compiled %d templates in %.2fs', len(results), time.time() - started)
+    return results
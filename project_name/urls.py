@@ -3,10 +3,13 @@ from django.conf.urls import include, url
 from django.contrib import admin
 from django.conf import settings
 
+from .apps.core import views as core_views
+
 admin.autodiscover()
 
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
+    url(r'^metrics/$', core_views.metrics, name='metrics'),
     # url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
     # url(r'^api/v1.0/', include('', namespace='api')),
 ]
@@ -0,0 +1,15 @@
+from rq import Worker
+
+from .routers import pinning_scope
+
+
+class PinningWorker(Worker):
+    """RQ worker running each job in its own ``pinning_scope``.
+
+    A job reads its own writes from the primary, and the next job starts
+    back on the replicas.
+    """
+
+    def perform_job(self, job, queue, *args, **kwargs):
+        with pinning_scope():
+            return super(PinningWorker, self).perform_job(job, queue, *args, **kwargs)
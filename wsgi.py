@@ -9,8 +9,21 @@ https://docs.djangoproject.com/en/1.7/howto/deployment/wsgi/
 """
 
 import os
-from dj_static import Cling
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "{{ project_name }}.settings.production")
 
 from django.core.wsgi import get_wsgi_application
-application = Cling(get_wsgi_application())
+from django.utils.module_loading import import_string
+StaticFilesApp = import_string('{{ project_name }}.staticfiles.StaticFilesApp')
+application = StaticFilesApp(get_wsgi_application())
+
+from django.conf import settings
+if getattr(settings, 'TEMPLATE_WARMUP', False):
+    # Under gunicorn --preload this runs once in the master, so workers
+    # inherit the compiled templates instead of each parsing them again.
+    import_string('{{ project_name }}.templating.warm')()
+
+    import gc
+    if hasattr(gc, 'freeze'):
+        # Keep collections in the workers from writing to, and so copying,
+        # the pages the preloaded objects live on.
+        gc.freeze()